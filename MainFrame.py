@@ -4,15 +4,24 @@ MainFrame.py
 This script is called by app.py to display the landing page.
 
 """
+import queue
+import threading
+import traceback
+
 # GUI modules
 import tkinter
 
 import db_connection_manager as db_connect
+import instrumentation
+import plan_diff
 import qep_processor
 import query_plan_visualizer as visualiser
 
 import PlansFrame
 
+# How often the main thread checks for events from the worker thread
+WORKER_POLL_INTERVAL_MS = 100
+
 
 class LandingPage(tkinter.Frame):
     """
@@ -26,6 +35,12 @@ class LandingPage(tkinter.Frame):
         Connects to PostgreSQL database based on database information entered on the GUI, then
         generates explanation and QEPs to display.
 
+    onCancelQuery()
+        Callback function when "Cancel" is clicked on. Stops the running sweep.
+
+    closeConnections()
+        Disconnect from all database servers used so far
+
     """
 
     def onFrameConfigure(self, event):
@@ -85,11 +100,14 @@ class LandingPage(tkinter.Frame):
     def onExplainQuery(self):
         """
         Callback function when "Explain Query" is clicked on.
-        Connects to PostgreSQL database based on database information entered on the GUI, then
-        generates explanation and QEPs to display.
+        Starts a worker thread which connects to PostgreSQL database based on database information
+        entered on the GUI, then generates explanation and QEPs to display. The progress of the
+        worker is shown by _pollWorker().
 
         """
-        Communicator = self.connectDatabase()
+        if self.threadWorker is not None:
+            # Only one query is explained at a time
+            return
 
         # Check if query box is empty first
         if len(self.entry_query.get("1.0", "end-1c")) == 0:
@@ -99,40 +117,213 @@ class LandingPage(tkinter.Frame):
             return
 
         query = self.entry_query.get("1.0", "end-1c")
-        self.plan_trees = ""
+        try:
+            reductionThreshold = float(self.entryReduction.get())
+        except ValueError:
+            reductionThreshold = -1
+        if reductionThreshold < 0:
+            tkinter.messagebox.showwarning(
+                title="Invalid threshold", message="The plan reduction threshold must be a percentage of at least 0")
+            return
+        # Tkinter widgets must only be read from the main thread
+        dictDatabaseInfo = self.getDatabaseInfo()
+        # Plans and the selectivity map are shown on the PlansPage as soon as they are found
+        self.tk_root_window.getPage("PlansPage").clearPlans()
+        self.objMonitor = qep_processor.SweepMonitor(
+            callback=lambda dictProgress: self.queueWorker.put(("progress", dictProgress)),
+            planCallback=self._onPlanFound,
+            mapCallback=lambda selectivityMap: self.queueWorker.put(
+                ("map", qep_processor.formatSelectivityMap(selectivityMap))))
+        self.threadWorker = threading.Thread(
+            target=self._runWorker, args=(query, dictDatabaseInfo, self.objMonitor, reductionThreshold),
+            daemon=True)
+        self.button_query.configure(state="disabled")
+        self.button_cancel.configure(state="normal")
+        self.label_progress_text.set("Connecting to database...")
+        self.threadWorker.start()
+        self.after(WORKER_POLL_INTERVAL_MS, self._pollWorker)
+
+    def onCancelQuery(self):
+        """
+        Callback function when "Cancel" is clicked on. The sweep stops after the current batch of
+        QEPs, and the plans found so far are displayed.
+
+        """
+        if self.objMonitor is not None:
+            self.objMonitor.cancel()
+            self.button_cancel.configure(state="disabled")
+            self.label_progress_text.set("Cancelling...")
+
+    def _onPlanFound(self, planNumber, plan):
+        """
+        Runs in the worker thread whenever the sweep finds a new plan. Only the summary of the plan
+        is computed here, the PlansPage renders it when it is selected.
+
+        """
+        self.queueWorker.put(
+            ("plan", ("Plan {}".format(planNumber), plan, qep_processor.summarizeQEP(plan))))
+
+    def _runWorker(self, query, dictDatabaseInfo, objMonitor, reductionThreshold):
+        """
+        Runs in the worker thread. Only communicates with the main thread through queueWorker.
+
+        """
+        instrumentation.reset()
+        try:
+            with instrumentation.span("analysis"):
+                with instrumentation.span("connect"):
+                    Communicator = self.connectDatabase(dictDatabaseInfo)
+                dictResult = self.explainQuery(query, Communicator, objMonitor, reductionThreshold)
+            self.queueWorker.put(("done", dictResult))
+        except Exception as error:
+            traceback.print_exc()
+            self.queueWorker.put(("error", str(error)))
+        if instrumentation.isEnabled():
+            # Where the time of the analysis went, see instrumentation.TRACE_ENV_VARIABLE
+            print(instrumentation.formatSummary())
+            instrumentation.exportChromeTrace()
+
+    def _pollWorker(self):
+        """
+        Shows the events posted by the worker thread. Called periodically with after() until the
+        worker has finished.
+
+        """
+        while True:
+            try:
+                szEvent, value = self.queueWorker.get_nowait()
+            except queue.Empty:
+                break
+            if szEvent == "progress":
+                self.label_progress_text.set(_formatProgress(value))
+            elif szEvent == "plan":
+                self.tk_root_window.getPage("PlansPage").addPlan(*value)
+            elif szEvent == "map":
+                self.tk_root_window.getPage("PlansPage").displaySelectivityMap(value)
+            elif szEvent == "done":
+                self._onWorkerFinished()
+                explanationString, self.plan_trees, actualQEP, lstFamilies, lstFamilyExplanations = value
+                self.displayExplanation(explanationString)
+                objPlansPage = self.tk_root_window.getPage("PlansPage")
+                objPlansPage.displayFamilies(lstFamilies, lstFamilyExplanations)
+                if actualQEP is not None:
+                    objPlansPage.addPlan("Actual plan", actualQEP, qep_processor.summarizeQEP(actualQEP))
+                    # Show how every plan differs from the plan the query actually uses
+                    objPlansPage.compareWith("Actual plan")
+                return
+            elif szEvent == "error":
+                self._onWorkerFinished()
+                tkinter.messagebox.showerror(title="Error", message=value)
+                return
+        self.after(WORKER_POLL_INTERVAL_MS, self._pollWorker)
+
+    def _onWorkerFinished(self):
+        self.threadWorker = None
+        self.button_query.configure(state="normal")
+        self.button_cancel.configure(state="disabled")
+        if self.objMonitor is not None and self.objMonitor.isCancelled():
+            self.label_progress_text.set("Cancelled")
+        else:
+            self.label_progress_text.set("")
+
+    def explainQuery(self, query, Communicator, objMonitor=None,
+                     reductionThreshold=qep_processor.REDUCTION_THRESHOLD):
+        """
+        Generates the explanation and QEPs of a query. Does not access any Tkinter widget, so it
+        can run in the worker thread.
+
+        Parameters
+        ----------
+        query : String
+            A normal SQL query from user input
+
+        Communicator : Postgres_ConnectPool or Postgres_AsyncConnect object
+            For interfacing with database
+
+        objMonitor : qep_processor.SweepMonitor
+            Receives the progress of the sweep, and allows it to be cancelled. The reduced
+            selectivity map is sent to it once the sweep has finished.
+
+        reductionThreshold : float
+            Cost increase threshold of the plan diagram reduction, in percent. 0 keeps all plans.
+
+        Returns
+        -------
+        explanationString : String
+            The text to display on the LandingPage
+
+        szPlanSummary : String
+            The summary to display above the plan list of the PlansPage. The plans themselves
+            are sent to the PlansPage while the sweep runs.
+
+        actualQEP : plan_tree.PlanNode
+            The QEP of the query itself, or None if it could not be retrieved
+
+        lstFamilies : list
+            The plan numbers of every plan family, as given by qep_processor.clusterPlans()
+
+        lstFamilyExplanations : list
+            One line describing every plan family
+
+        """
+        szPlanSummary = ""
+        actualQEP = None
         lstAllQEPs = None
         lstPredicateAttributes = None
         selectivityMap = None
+        costMap = None
+        dictSweepInfo = None
         result = qep_processor.processQuery(
-            query, Communicator)
+            query, Communicator, objMonitor)
         if result[0] == qep_processor.RET_CONVERT_QUERY_ERR:
             szErrorMessage = "Error parsing query for predicates! Running actual query...\nView the actual QEP in the Plans page\n"
             res = qep_processor.getActualQEP(query, Communicator)
-            szQEPTree = visualiser.visualize_query_plan(res[1])
-            self.plan_trees += szQEPTree
+            actualQEP = res[1]
+            szQEPTree = visualiser.visualize_query_plan(actualQEP)
             print(szErrorMessage)
             print(szQEPTree)
-            self.displayExplanation(szErrorMessage)
-            return
+            return szErrorMessage, szErrorMessage, actualQEP, [], []
         elif result[0] == qep_processor.RET_ALL_QEPS:
             lstAllQEPs = result[1]
             lstPredicateAttributes = result[2]
             selectivityMap = result[3]
+            dictSweepInfo = result[4]
+            costMap = result[5]
 
         explanationString = "Number of QEPs found: {}\n".format(
             len(lstAllQEPs))
-        self.plan_trees = explanationString
-        string = str()
-        # Show the QEPs found. It is displayed as a normal Python string
+        # Plans that differ in a few operators only are shown as one plan family
+        familyMap, lstFamilies = qep_processor.clusterPlans(lstAllQEPs, selectivityMap)
+        lstFamilyExplanations = qep_processor.generateFamilyExplanation(lstFamilies, familyMap)
+        # Only show the plans that matter: small plans are replaced by a neighbour that costs
+        # at most reductionThreshold percent more
+        selectivityMap, dictSwallowedBy = qep_processor.reducePlanDiagram(
+            selectivityMap, costMap, reductionThreshold)
+        if len(dictSwallowedBy) > 0:
+            explanationString += ("Reduced to {} plans, allowing a cost increase of up to {:g} %.\n".format(
+                len(lstAllQEPs) - len(dictSwallowedBy), reductionThreshold))
+            if objMonitor is not None:
+                objMonitor.mapUpdated(selectivityMap, bFinal=True)
+        if len(lstFamilies) < len(lstAllQEPs):
+            explanationString += "The plans form {} plan families:\n".format(len(lstFamilies))
+            for string in lstFamilyExplanations:
+                explanationString += string
+        if dictSweepInfo["cancelled"]:
+            szReason = "reached its time limit" if dictSweepInfo["timed_out"] else "was cancelled"
+            explanationString = ("The search {} after {} of {} selectivity points, "
+                                 "so the results are partial.\n".format(
+                                     szReason, dictSweepInfo["done"], dictSweepInfo["total"])) + explanationString
+        if dictSweepInfo["unknown"] > 0:
+            explanationString += ("{} selectivity points timed out while planning, and their plan "
+                                  "is unknown.\n".format(dictSweepInfo["unknown"]))
+        szPlanSummary = explanationString
+        # List the QEPs found on the CLI without rendering them, which the Plans page only does
+        # for the plan selected
         print("\nNumber of QEPs found: {}".format(len(lstAllQEPs)))
         for index, plan in enumerate(lstAllQEPs):
-            string = ("Plan {}:\n\n".format(index+1))
-            print("Plan {}:".format(index+1))
-            print("@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@")
-            szQEPTree = visualiser.visualize_query_plan(plan)
-            self.plan_trees += string + szQEPTree
-            print(szQEPTree)
-            print("@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@\n")
+            dictSummary = qep_processor.summarizeQEP(plan)
+            print("Plan {:<6} cost {:>14.2f}   {:>4} nodes   {}".format(
+                index + 1, dictSummary["cost"], dictSummary["nodes"], dictSummary["fingerprint"][:12]))
 
         result = qep_processor.getActualQEP(query, Communicator)
         if result[0] == qep_processor.RET_ONLY_ACTUAL_QEP:
@@ -141,26 +332,36 @@ class LandingPage(tkinter.Frame):
             szQEPTree = visualiser.visualize_query_plan(actualQEP)
             string = "Actual plan:\n"
             print(string + szQEPTree)
-            self.plan_trees += string + szQEPTree
             # Compare actual QEP with predicted QEP
             result = qep_processor.compareActualQEP(actualQEP, lstAllQEPs)
             if result[0] == qep_processor.RET_QEP_FOUND:
                 lstSelectivityExplanations = qep_processor.generateFoundExplanation(
-                    lstPredicateAttributes, selectivityMap)
+                    lstPredicateAttributes, selectivityMap, dictSwallowedBy)
                 for string in lstSelectivityExplanations:
                     explanationString += string
                 string = ("The selectivity range of the query is closest to Plan {}.\n".format(
                     result[1]))
+                if len(lstFamilies) < len(lstAllQEPs):
+                    string += "Plan {} belongs to Family {}.\n".format(
+                        result[1], [result[1] in lstPlans for lstPlans in lstFamilies].index(True) + 1)
+                if result[1] in dictSwallowedBy:
+                    string += "Plan {} is replaced by Plan {} in the reduced plan diagram.\n".format(
+                        result[1], dictSwallowedBy[result[1]])
                 explanationString += string
-                self.plan_trees += "\n" + string
+                szPlanSummary += string
             elif result[0] == qep_processor.RET_QEP_NOT_FOUND:
                 string = (
                     """A different plan is seen because the DBMS may have considered other plans with different selectivity values 
                     which result in lower cost for the plan. 
                     """)
+                closestPlanIndex, dictDiff = qep_processor.findClosestQEP(actualQEP, lstAllQEPs)
+                if closestPlanIndex is not None:
+                    string = string.rstrip(" ") + "The closest plan found is Plan {}, which differs from the actual plan in:\n{}".format(
+                        closestPlanIndex, plan_diff.formatPlanDiff(dictDiff))
                 explanationString += string
+                szPlanSummary += string
 
-        self.displayExplanation(explanationString)
+        return explanationString, szPlanSummary, actualQEP, lstFamilies, lstFamilyExplanations
 
     def displayExplanation(self, explanationString):
         """
@@ -183,22 +384,51 @@ class LandingPage(tkinter.Frame):
         objPlansPage = self.tk_root_window.getPage("PlansPage")
         objPlansPage.displayPlans(self.plan_trees)
 
-    def connectDatabase(self):
+    def getDatabaseInfo(self):
+        """
+        Read the database information entered on the GUI
+
+        Returns
+        -------
+        dictDatabaseInfo : dict
+            The host, port, database, username and password
+
+        """
+        return {
+            "host": self.entryHost.get(),
+            "port": self.entryPort.get(),
+            "database": self.entryDatabaseName.get(),
+            "username": self.entryUser.get(),
+            "password": self.entryPassword.get(),
+        }
+
+    def connectDatabase(self, dictDatabaseInfo):
         """
-        Connect to PostgreSQL database
+        Connect to PostgreSQL database, reusing the connection of the previous analysis if the
+        database information has not changed and the connection is still usable
+
+        Parameters
+        ----------
+        dictDatabaseInfo : dict
+            The database information, as returned by getDatabaseInfo()
 
         """
-        host = self.entryHost.get()
-        port = self.entryPort.get()
-        database = self.entryDatabaseName.get()
-        username = self.entryUser.get()
-        password = self.entryPassword.get()
-
-        # Build Connections to the Server
-        Communicator = db_connect.Postgres_Connect()
-        Communicator.connect(host, database, port, username, password)
+        # Build several connections to the server so that EXPLAIN requests can be sent concurrently.
+        # The driver (thread pool or asyncio) is selected by db_connect.EXPLAIN_DRIVER
+        Communicator = self.objSessionManager.getCommunicator(
+            dictDatabaseInfo["host"], dictDatabaseInfo["database"], dictDatabaseInfo["port"],
+            dictDatabaseInfo["username"], dictDatabaseInfo["password"])
         return Communicator
 
+    def closeConnections(self):
+        """
+        Disconnect from all database servers used so far, cancelling the running sweep first
+
+        """
+        if self.objMonitor is not None:
+            self.objMonitor.cancel()
+        self.objSessionManager.closeAll()
+
     def __init__(self, tk_parent_frame, tk_root_window):
         """
         Constructor of the LandingPage class
@@ -217,6 +447,13 @@ class LandingPage(tkinter.Frame):
 
         tkinter.Frame.__init__(self, tk_parent_frame)
         self.tk_root_window = tk_root_window
+        # Keeps the connections open between clicks on "Explain Query"
+        self.objSessionManager = db_connect.SessionManager()
+        # The query is explained in a worker thread, which posts its events to queueWorker
+        self.threadWorker = None
+        self.queueWorker = queue.Queue()
+        self.objMonitor = None
+        self.plan_trees = ""
         self.canvas = tkinter.Canvas(self, width=300, height=300)
         self.canvas.pack(side=tkinter.LEFT, expand=True, fill=tkinter.BOTH)
         self.frame = tkinter.Frame(self.canvas)
@@ -320,14 +557,32 @@ class LandingPage(tkinter.Frame):
         self.frame_query.grid(
             column=0, row=6, columnspan=6, rowspan=1, sticky='W')
 
+        self.frame_query_buttons = tkinter.Frame(self.frame_query)
+        self.frame_query_buttons.pack(side=tkinter.BOTTOM, pady=(5, 5))
         self.button_query_text = tkinter.StringVar()
         self.button_query = tkinter.Button(
-            self.frame_query,
+            self.frame_query_buttons,
             background="black", textvariable=self.button_query_text,
             foreground="white",
             width=25, command=self.onExplainQuery)
         self.button_query_text.set("Explain Query")
-        self.button_query.pack(side=tkinter.BOTTOM, pady=(5, 5))
+        self.button_query.pack(side=tkinter.LEFT, padx=(0, 5))
+        # Stops the sweep and shows the plans found so far
+        self.button_cancel = tkinter.Button(
+            self.frame_query_buttons, text="Cancel",
+            width=10, state="disabled", command=self.onCancelQuery)
+        self.button_cancel.pack(side=tkinter.LEFT)
+        # Cost increase threshold (lambda) of the plan diagram reduction
+        tkinter.Label(self.frame_query_buttons, text="Reduction threshold (%):").pack(
+            side=tkinter.LEFT, padx=(10, 0))
+        self.entryReduction = tkinter.Entry(
+            self.frame_query_buttons, width=6, justify=tkinter.LEFT)
+        self.entryReduction.insert(0, "{:g}".format(qep_processor.REDUCTION_THRESHOLD))
+        self.entryReduction.pack(side=tkinter.LEFT, padx=(5, 0))
+        # Progress of the sweep, updated by _pollWorker()
+        self.label_progress_text = tkinter.StringVar()
+        tkinter.Label(self.frame_query_buttons, textvariable=self.label_progress_text,
+                      anchor="w", width=70).pack(side=tkinter.LEFT, padx=(10, 0))
         self.entry_query = tkinter.Text(
             self.frame_query, height=15, width=120, wrap=tkinter.WORD)
         self.entry_query.pack(side='left', fill='both',
@@ -348,3 +603,17 @@ class LandingPage(tkinter.Frame):
                                               font=("Arial", 12))
         self.label_explanation.grid(
             column=0, row=11, columnspan=2, sticky='w', padx=(10, 10), pady=(10, 10))
+
+
+def _formatProgress(dictProgress):
+    """
+    Format the progress of a sweep, as given by qep_processor.SweepMonitor.getProgress()
+
+    """
+    szProgress = "{} of {} points, {} plans found".format(
+        dictProgress["done"], dictProgress["total"], dictProgress["plans"])
+    if dictProgress["rate"] is not None:
+        szProgress += ", {:.0f} EXPLAIN/s".format(dictProgress["rate"])
+    if dictProgress["eta"] is not None:
+        szProgress += ", about {:.0f} s left".format(dictProgress["eta"])
+    return szProgress
@@ -7,8 +7,17 @@ This script is called by app.py to display multiple QEPs in tree format.
 
 import tkinter
 import tkinter.scrolledtext
+import tkinter.ttk
 
 import MainFrame
+import plan_diff
+import query_plan_visualizer as visualiser
+
+# Entry of the comparison menu that turns the highlighting of differences off
+NO_COMPARISON = "None"
+# Background of the operators of the selected plan that are not in the plan compared with
+INSERTED_COLOUR = "#c8f0c8"
+CHANGED_COLOUR = "#fff0a0"
 
 
 class PlansPage(tkinter.Frame):
@@ -16,10 +25,45 @@ class PlansPage(tkinter.Frame):
     This is the class that displays the plans page whereto view all possible QEPs. It is displayed as a 
     separate frame from the landing page. The QEPs may also be viewed on the CLI for convienience.
 
+    Only a one-line summary of every plan is kept in the plan list. A plan is rendered as a tree
+    when it is selected, so the page stays responsive with hundreds of plans or very large plans.
+    Once the sweep has finished, plans of the same plan family are grouped under one row of the
+    list, which shows the first plan of the family and can be expanded to show all of them.
+
+    Attributes
+    ----------
+    lstPlans : list
+        (label, QEP, summary) of every plan in the plan list, where the summary is given by
+        qep_processor.summarizeQEP(). The plan list item of a plan is its index in lstPlans.
+
+    dictFamilyItems : dict
+        Key: Plan list item of a plan family
+        Value: Index in lstPlans of the first plan of the family
+
+    varCompareWith : tkinter.StringVar
+        Label of the plan the selected plan is compared with, or NO_COMPARISON. The operators
+        inserted and changed in the selected plan are highlighted, and the differences are
+        listed below it.
+
     Methods
     -------
     displayPlans(planStrings)
-        Display all possible QEPs and actual QEP on GUI and CLI
+        Display the summary of the plans (number of QEPs, closest plan) on GUI
+
+    clearPlans()
+        Remove the plans and selectivity map of the previous query
+
+    addPlan(label, qep, dictSummary)
+        Add a QEP to the plan list, while the sweep is still running
+
+    displayFamilies(lstFamilies, lstFamilyExplanations)
+        Group the plans of the plan list by plan family
+
+    compareWith(label)
+        Highlight the differences of the selected plan from another plan
+
+    displaySelectivityMap(mapString)
+        Display the selectivity map, replacing the previous one
 
     """
 
@@ -35,13 +79,154 @@ class PlansPage(tkinter.Frame):
         self.canvas.configure(scrollregion=self.canvas.bbox("all"))
 
     def displayPlans(self, planStrings):
-        # Display QEPs on GUI
+        # Display the summary of the QEPs on GUI
         self.label_plans.configure(state='normal')
-        # Remove previous plans
+        # Remove previous summary
         self.label_plans.delete('1.0', tkinter.END)
         self.label_plans.insert('end', planStrings + '\n')
         self.label_plans.configure(state='disabled')
 
+    def clearPlans(self):
+        self.displayPlans("")
+        self.displaySelectivityMap("")
+        self.lstPlans = []
+        self.dictFamilyItems = {}
+        self.treeview_plans.delete(*self.treeview_plans.get_children())
+        self.optionmenu_compare["menu"].delete(1, tkinter.END)
+        self.varCompareWith.set(NO_COMPARISON)
+        self._displayPlanTree("")
+
+    def addPlan(self, label, qep, dictSummary):
+        """
+        Add a QEP to the plan list. The QEP is not rendered until it is selected.
+
+        Parameters
+        ----------
+        label : String
+            Name of the plan in the list, e.g. "Plan 3"
+
+        qep : plan_tree.PlanNode
+            The top operator of the QEP
+
+        dictSummary : dict
+            The summary of the QEP, as given by qep_processor.summarizeQEP()
+
+        """
+        self.lstPlans.append((label, qep, dictSummary))
+        self.treeview_plans.insert("", tkinter.END, iid=str(len(self.lstPlans) - 1),
+                                   text="{:<12} cost {:>14.2f}   {:>4} nodes   {}".format(
+                                       label, dictSummary["cost"], dictSummary["nodes"], dictSummary["fingerprint"][:12]))
+        self.optionmenu_compare["menu"].add_command(label=label, command=lambda: self.compareWith(label))
+        if len(self.lstPlans) == 1:
+            # Show the first plan straight away
+            self.treeview_plans.selection_set("0")
+            self.onSelectPlan(None)
+
+    def displayFamilies(self, lstFamilies, lstFamilyExplanations):
+        """
+        Group the plans of the plan list by plan family, largest family first. Families of a single
+        plan are shown as the plan itself.
+
+        Parameters
+        ----------
+        lstFamilies : list
+            The plan numbers of every family, as given by qep_processor.clusterPlans(). Plan
+            number N is the plan labelled "Plan N".
+
+        lstFamilyExplanations : list
+            The text of every family in the plan list
+
+        """
+        dictPlanIndexes = dict((label, index) for index, (label, _, _) in enumerate(self.lstPlans))
+        for position, (lstPlanNumbers, szExplanation) in enumerate(zip(lstFamilies, lstFamilyExplanations)):
+            lstItems = [str(dictPlanIndexes["Plan {}".format(plan)]) for plan in lstPlanNumbers]
+            if len(lstItems) == 1:
+                self.treeview_plans.move(lstItems[0], "", position)
+                continue
+            familyItem = "family{}".format(position + 1)
+            self.treeview_plans.insert("", position, iid=familyItem, text=szExplanation.strip())
+            self.dictFamilyItems[familyItem] = int(lstItems[0])
+            for item in lstItems:
+                self.treeview_plans.move(item, familyItem, tkinter.END)
+
+    def onSelectPlan(self, event):
+        """
+        Callback function when a plan is selected in the plan list. Renders the plan, which
+        reuses the render cache of query_plan_visualizer if it was viewed recently.
+
+        """
+        lstSelection = self.treeview_plans.selection()
+        if len(lstSelection) == 0:
+            return
+        # A plan family is shown as its first plan
+        index = self.dictFamilyItems.get(lstSelection[0])
+        if index is None:
+            index = int(lstSelection[0])
+        label, qep, _ = self.lstPlans[index]
+        szQEPTree = "{}:\n\n{}".format(label, visualiser.visualize_query_plan(qep))
+        szDiff, dictHighlights = self._comparePlan(index)
+        self._displayPlanTree(szQEPTree + szDiff, dictHighlights)
+
+    def compareWith(self, label):
+        """
+        Highlight the operators of the selected plan that differ from another plan
+
+        Parameters
+        ----------
+        label : String
+            Name of the plan in the list to compare with, or NO_COMPARISON
+
+        """
+        self.varCompareWith.set(label)
+        self.onSelectPlan(None)
+
+    def _comparePlan(self, index):
+        """
+        Compare a plan with the plan chosen in the comparison menu
+
+        Returns
+        -------
+        szDiff : String
+            The differences to show below the plan, empty if the plan is not compared
+
+        dictHighlights : dict
+            Key: "inserted" or "changed", the tag of the highlighted lines
+            Value: Line numbers of the rendered plan to highlight, starting from 1
+
+        """
+        label, qep, _ = self.lstPlans[index]
+        lstOtherPlans = [plan for plan in self.lstPlans if plan[0] == self.varCompareWith.get()]
+        if len(lstOtherPlans) == 0 or lstOtherPlans[0][0] == label:
+            return "", {}
+        otherLabel, otherQEP, _ = lstOtherPlans[0]
+        dictDiff = plan_diff.diffPlans(otherQEP, qep)
+        setInserted = set(id(plan_node) for plan_node in dictDiff["inserted"])
+        setChanged = set(id(plan_node) for _, plan_node in dictDiff["changed"])
+        dictHighlights = {"inserted": [], "changed": []}
+        # The rendered plan starts with its label and an empty line
+        for line, plan_node in enumerate(visualiser.get_line_plan_nodes(qep), start=3):
+            if id(plan_node) in setInserted:
+                dictHighlights["inserted"].append(line)
+            elif id(plan_node) in setChanged:
+                dictHighlights["changed"].append(line)
+        szDiff = "\nCompared with {}: {}".format(otherLabel, plan_diff.formatPlanDiff(dictDiff))
+        return szDiff, dictHighlights
+
+    def _displayPlanTree(self, szQEPTree, dictHighlights=None):
+        self.text_plan_tree.configure(state='normal')
+        self.text_plan_tree.delete('1.0', tkinter.END)
+        self.text_plan_tree.insert('end', szQEPTree)
+        for tag, lstLines in (dictHighlights or {}).items():
+            for line in lstLines:
+                self.text_plan_tree.tag_add(tag, "{}.0".format(line), "{}.end".format(line))
+        self.text_plan_tree.configure(state='disabled')
+
+    def displaySelectivityMap(self, mapString):
+        self.label_map.configure(state='normal')
+        self.label_map.delete('1.0', tkinter.END)
+        self.label_map.insert('end', mapString)
+        self.label_map.configure(state='disabled')
+
     def __init__(self, tk_parent_frame, tk_root_window, objLandingPage):
         """
         Constructor of the PlansPage class
@@ -67,6 +252,9 @@ class PlansPage(tkinter.Frame):
         # Get the LandingPage object to pass variables
         self.objLandingPage = objLandingPage
 
+        self.lstPlans = []
+        self.dictFamilyItems = {}
+
         # Vertical scrollbar
         self.yscroll = tkinter.Scrollbar(
             self, command=self.canvas.yview, orient=tkinter.VERTICAL)
@@ -88,11 +276,51 @@ class PlansPage(tkinter.Frame):
             self.frame, text="Back",
             command=lambda: self.controller.showFrame(MainFrame.LandingPage)).grid(row=0, column=0, padx=(10, 0), pady=9)
 
+        """Selectivity map"""
+        self.label_map_header = tkinter.Label(
+            self.canvas, text="Selectivity map:", anchor="w")
+        self.label_map_header.config(font=(None, 14))
+        self.label_map_header.pack(padx=(10, 0), pady=(15, 0))
+        self.label_map = tkinter.scrolledtext.ScrolledText(
+            self.canvas, wrap='none', state='disabled', width=130, height=12, font=("Courier", 10))
+        self.label_map.pack(padx=(10, 10), pady=(10, 0))
+
         """Plans"""
         self.label_plans_header = tkinter.Label(
             self.canvas, text="Plans:", anchor="w")
         self.label_plans_header.config(font=(None, 14))
         self.label_plans_header.pack(padx=(10, 0), pady=(15, 0))
         self.label_plans = tkinter.scrolledtext.ScrolledText(
-            self.canvas, wrap='word', state='disabled', width=130, height=100)
-        self.label_plans.pack(padx=(10, 10), pady=(10, 10))
+            self.canvas, wrap='word', state='disabled', width=130, height=5)
+        self.label_plans.pack(padx=(10, 10), pady=(10, 0))
+
+        # The list only holds one line per plan or plan family, and the selected plan is rendered
+        # below it
+        self.frame_plan_list = tkinter.Frame(self.canvas)
+        self.frame_plan_list.pack(padx=(10, 10), pady=(10, 0), fill=tkinter.X)
+        tkinter.ttk.Style(self).configure("Plans.Treeview", font=("Courier", 10))
+        self.treeview_plans = tkinter.ttk.Treeview(
+            self.frame_plan_list, height=8, show="tree", selectmode="browse", style="Plans.Treeview")
+        self.treeview_plans.column("#0", width=1000)
+        self.treeview_plans.pack(side=tkinter.LEFT, fill=tkinter.X, expand=True)
+        self.scrollbar_plan_list = tkinter.Scrollbar(
+            self.frame_plan_list, command=self.treeview_plans.yview)
+        self.scrollbar_plan_list.pack(side=tkinter.RIGHT, fill=tkinter.Y)
+        self.treeview_plans.config(yscrollcommand=self.scrollbar_plan_list.set)
+        self.treeview_plans.bind("<<TreeviewSelect>>", self.onSelectPlan)
+
+        # The plan compared with the selected plan
+        self.frame_compare = tkinter.Frame(self.canvas)
+        self.frame_compare.pack(padx=(10, 10), pady=(10, 0), fill=tkinter.X)
+        tkinter.Label(self.frame_compare, text="Highlight differences from:").pack(side=tkinter.LEFT)
+        self.varCompareWith = tkinter.StringVar(self.frame_compare, NO_COMPARISON)
+        self.optionmenu_compare = tkinter.OptionMenu(
+            self.frame_compare, self.varCompareWith, NO_COMPARISON,
+            command=lambda label: self.compareWith(label))
+        self.optionmenu_compare.pack(side=tkinter.LEFT)
+
+        self.text_plan_tree = tkinter.scrolledtext.ScrolledText(
+            self.canvas, wrap='none', state='disabled', width=130, height=60)
+        self.text_plan_tree.pack(padx=(10, 10), pady=(10, 10))
+        self.text_plan_tree.tag_configure("inserted", background=INSERTED_COLOUR)
+        self.text_plan_tree.tag_configure("changed", background=CHANGED_COLOUR)
@@ -11,8 +11,7 @@ Tested successfully on the following environments:
 - PostgreSQL 9.6.X with TPC-H dataset 
 
 Dependencies:
-- anytree (2.8.0) - For visualising the QEP
-- jsondiff (1.2.0) - For parsing QEPs given by PostgreSQL database server
+- numpy (1.16 or later) - For storing and analysing the selectivity map
 - psycopg2 (2.8.6) - For communicating with PostgreSQL database server
 - sqlparse (0.4.1) - For parsing the input SQL query
 
@@ -144,6 +143,7 @@ def main():
         """
 
         if tkinter.messagebox.askokcancel("Quit", "Do you want to quit?"):
+            app.getPage("LandingPage").closeConnections()
             root.quit()  # stops mainloop
 
     root = tkinter.Tk()
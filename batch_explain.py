@@ -0,0 +1,358 @@
+"""
+batch_explain.py
+
+This script analyses a whole workload of queries without the user interface, e.g. the 22 TPC-H
+queries on a machine without a display. Every .sql file of a directory is swept like
+"Explain Query" does, and one JSON file with the plans, selectivity map, cost surface and timings
+is written per query.
+
+The queries are spread over a pool of worker threads or processes. Every worker has its own
+connection to the server, with --sessions sessions each.
+
+Usage:
+    python batch_explain.py queries/ --output-dir results --workers 4 --executor process
+
+"""
+import argparse
+import concurrent.futures
+import glob
+import json
+import multiprocessing.util
+import os
+import threading
+import time
+import traceback
+
+import numpy as np
+
+import db_connection_manager as db_connect
+import instrumentation
+import plan_diff
+import qep_processor
+
+EXECUTOR_THREAD = "thread"
+EXECUTOR_PROCESS = "process"
+# Default number of queries analysed at the same time. Every worker opens --sessions connections
+# (one more with the asyncio driver), so this is kept well below the max_connections of a default
+# server rather than scaled with the number of CPUs.
+DEFAULT_WORKERS = 4
+
+# Communicator of the current worker thread. Worker processes have a single worker thread.
+_workerState = threading.local()
+# All communicators connected by this process, so that they can be disconnected at the end
+_lstCommunicators = []
+_lockCommunicators = threading.Lock()
+
+
+def analyseQueryFile(szQueryPath, dictSettings):
+    """
+    Sweep one query and write its results to a JSON file in the output directory. Runs in a
+    worker thread or process.
+
+    Parameters
+    ----------
+    szQueryPath : String
+        Path of the file containing the SQL query
+
+    dictSettings : dict
+        The command-line settings, as built by main()
+
+    Returns
+    -------
+    dictSummary : dict
+        The "query_file", "status", number of "plans", number of "points" and "total_s" of the
+        query, to report on the console. The full results are only written to the JSON file.
+        With --trace, also the spans and counters recorded by the worker as "trace".
+
+    """
+    start = time.perf_counter()
+    dictResult = {"query_file": os.path.basename(szQueryPath)}
+    try:
+        with open(szQueryPath) as f:
+            query = f.read()
+        dictResult["query"] = query
+        with instrumentation.span("analysis", query_file=dictResult["query_file"]):
+            dictResult.update(_explainQuery(query, _getCommunicator(dictSettings), dictSettings))
+    except Exception as error:
+        traceback.print_exc()
+        dictResult["status"] = "error"
+        dictResult["error"] = "{}: {}".format(type(error).__name__, error)
+    dictResult.setdefault("timings", {})["total_s"] = time.perf_counter() - start
+
+    szOutputPath = os.path.join(
+        dictSettings["output_dir"], os.path.splitext(os.path.basename(szQueryPath))[0] + ".json")
+    with open(szOutputPath, "w") as f:
+        json.dump(dictResult, f, indent=1)
+    return {
+        "query_file": dictResult["query_file"],
+        "status": dictResult["status"],
+        "plans": len(dictResult.get("plans", [])),
+        "points": dictResult.get("sweep", {}).get("done", 0),
+        "total_s": dictResult["timings"]["total_s"],
+        # Worker processes send their spans to the parent process, which writes the trace
+        "trace": instrumentation.drain() if dictSettings["trace"] is not None else None,
+    }
+
+
+def _explainQuery(query, Communicator, dictSettings):
+    """
+    Run the sweep, retrieve the actual QEP and compare it with the plans of the sweep, in the
+    same way as MainFrame.LandingPage.explainQuery()
+
+    Returns
+    -------
+    dictResult : dict
+        The values to write to the JSON file of the query
+
+    """
+    dictResult = {"status": "ok", "timings": {}}
+    start = time.perf_counter()
+    result = qep_processor.processQuery(query, Communicator)
+    dictResult["timings"]["sweep_s"] = time.perf_counter() - start
+    if result[0] == qep_processor.RET_CONVERT_QUERY_ERR:
+        # No predicate to vary, so only the actual QEP can be shown
+        dictResult["status"] = "no_predicates"
+        start = time.perf_counter()
+        dictResult["actual_plan"] = {
+            "qep": qep_processor.getActualQEP(query, Communicator)[1].toQEP(), "plan": None}
+        dictResult["timings"]["actual_qep_s"] = time.perf_counter() - start
+        return dictResult
+
+    _, lstAllQEPs, lstPredicateAttributes, selectivityMap, dictSweepInfo, costMap, rowsMap = result
+    reducedMap, dictSwallowedBy = qep_processor.reducePlanDiagram(
+        selectivityMap, costMap, dictSettings["reduction"])
+    familyMap, lstFamilies = qep_processor.clusterPlans(lstAllQEPs, selectivityMap)
+    # Fraction of the selectivity space covered by every plan, indexed by plan number
+    arrCoverage = np.bincount(selectivityMap.ravel(), minlength=len(lstAllQEPs) + 1) / selectivityMap.size
+    dictPlanFamilies = dict((plan, family + 1) for family, lstFamilyPlans in enumerate(lstFamilies)
+                            for plan in lstFamilyPlans)
+    lstPlans = []
+    for index, qep in enumerate(lstAllQEPs):
+        dictPlan = {"plan": index + 1, "coverage": float(arrCoverage[index + 1]),
+                    "swallowed_by": dictSwallowedBy.get(index + 1), "family": dictPlanFamilies[index + 1]}
+        dictPlan.update(qep_processor.summarizeQEP(qep))
+        dictPlan["qep"] = qep.toQEP()
+        lstPlans.append(dictPlan)
+    dictResult["predicate_attributes"] = lstPredicateAttributes
+    dictResult["sweep"] = dictSweepInfo
+    dictResult["plans"] = lstPlans
+    arrFamilyCoverage = np.bincount(familyMap.ravel(), minlength=len(lstFamilies) + 1) / familyMap.size
+    dictResult["families"] = [
+        {"family": family + 1, "plans": lstFamilyPlans, "coverage": float(arrFamilyCoverage[family + 1])}
+        for family, lstFamilyPlans in enumerate(lstFamilies)]
+    dictResult["map_shape"] = list(selectivityMap.shape)
+    if dictSettings["maps"]:
+        dictResult["selectivity_map"] = selectivityMap.tolist()
+        dictResult["reduced_map"] = reducedMap.tolist()
+        dictResult["family_map"] = familyMap.tolist()
+        dictResult["cost_map"] = _surfaceToList(costMap)
+        dictResult["rows_map"] = _surfaceToList(rowsMap)
+
+    start = time.perf_counter()
+    actualQEP = qep_processor.getActualQEP(query, Communicator)[1]
+    dictResult["timings"]["actual_qep_s"] = time.perf_counter() - start
+    start = time.perf_counter()
+    result = qep_processor.compareActualQEP(actualQEP, lstAllQEPs)
+    dictResult["timings"]["compare_s"] = time.perf_counter() - start
+    dictResult["actual_plan"] = {
+        "qep": actualQEP.toQEP(),
+        "plan": result[1] if result[0] == qep_processor.RET_QEP_FOUND else None,
+    }
+    if result[0] == qep_processor.RET_QEP_NOT_FOUND:
+        closestPlanIndex, dictDiff = qep_processor.findClosestQEP(actualQEP, lstAllQEPs)
+        if closestPlanIndex is not None:
+            # Operators of the closest plan that differ from the actual plan
+            dictResult["actual_plan"]["closest_plan"] = closestPlanIndex
+            dictResult["actual_plan"]["differences"] = {
+                "inserted": [plan_diff.describeOperator(node) for node in dictDiff["inserted"]],
+                "removed": [plan_diff.describeOperator(node) for node in dictDiff["removed"]],
+                "changed": [[plan_diff.describeOperator(node1), plan_diff.describeOperator(node2)]
+                            for node1, node2 in dictDiff["changed"]],
+            }
+    return dictResult
+
+
+def _surfaceToList(arrSurface):
+    # JSON has no NaN, unknown cells are written as null
+    arrValues = arrSurface.astype(object)
+    arrValues[np.isnan(arrSurface)] = None
+    return arrValues.tolist()
+
+
+def _getCommunicator(dictSettings):
+    """
+    Get the communicator of the current worker, connecting it on first use
+
+    """
+    Communicator = getattr(_workerState, "Communicator", None)
+    if Communicator is None:
+        Communicator = db_connect.createCommunicator(
+            dictSettings["host"], dictSettings["database"], dictSettings["port"],
+            dictSettings["username"], dictSettings["password"], dictSettings["driver"])
+        if Communicator.conn is None:
+            raise ConnectionError("Could not connect to {}:{}".format(
+                dictSettings["host"], dictSettings["port"]))
+        _workerState.Communicator = Communicator
+        with _lockCommunicators:
+            _lstCommunicators.append(Communicator)
+    return Communicator
+
+
+def _disconnectAll():
+    """
+    Disconnect all communicators connected by this process
+
+    """
+    with _lockCommunicators:
+        for Communicator in _lstCommunicators:
+            Communicator.disconnect()
+        del _lstCommunicators[:]
+
+
+def _countAvailableConnections(dictSettings):
+    """
+    Get the number of connections the server still accepts from users that are not superusers
+
+    Returns
+    -------
+    result : int
+        max_connections less the connections reserved for superusers and those of all other
+        clients, or None if it could not be retrieved
+
+    """
+    session = db_connect.Postgres_Connect()
+    session.connect(dictSettings["host"], dictSettings["database"], dictSettings["port"],
+                    dictSettings["username"], dictSettings["password"])
+    try:
+        # pg_stat_activity only lists client backends before PostgreSQL 10, which added the
+        # backend_type column
+        szClientBackends = "backend_type = 'client backend' AND "
+        if session.conn is not None and session.conn.server_version < 100000:
+            szClientBackends = ""
+        # This session is left out, since it is closed before the workers connect
+        result = session.processQuery(
+            "SELECT current_setting('max_connections')::int \
+                - current_setting('superuser_reserved_connections')::int \
+                - (SELECT count(*) FROM pg_stat_activity \
+                   WHERE {}pid != pg_backend_pid())".format(szClientBackends))
+    finally:
+        session.disconnect()
+    if result:
+        return result[0][0]
+    return None
+
+
+def _initWorker(dictSettings):
+    """
+    Apply the settings to the modules of a worker. Worker processes do not inherit module
+    settings changed by the parent process, so they are applied again in every worker.
+
+    """
+    if dictSettings["trace"] is not None:
+        instrumentation.enable()
+    qep_processor.SWEEP_MODE = dictSettings["sweep_mode"]
+    qep_processor.PROBE_MODE = dictSettings["probe_mode"]
+    qep_processor.RESOLUTION = dictSettings["resolution"]
+    qep_processor.SWEEP_TIMEOUT_S = dictSettings["sweep_timeout"]
+    qep_processor.USE_QEP_CACHE = dictSettings["cache"]
+    qep_processor.KEEP_RAW_QEPS = dictSettings["raw_qeps"]
+    db_connect.POOL_SIZE = dictSettings["sessions"]
+    db_connect.ASYNC_POOL_SIZE = dictSettings["sessions"]
+    if dictSettings["executor"] == EXECUTOR_PROCESS:
+        # Worker processes exit without running atexit handlers, but run the finalizers of
+        # multiprocessing when the executor shuts down
+        multiprocessing.util.Finalize(None, _disconnectAll, exitpriority=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sweep every query of a directory and write the results as JSON")
+    parser.add_argument("query_dir", help="Directory containing one SQL query per .sql file")
+    parser.add_argument("--output-dir", default="results")
+    parser.add_argument("--pattern", default="*.sql", help="File name pattern of the queries")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--database", default="TPC-H")
+    parser.add_argument("--port", default="5432")
+    parser.add_argument("--username", default="postgres")
+    parser.add_argument("--password", default="root")
+    parser.add_argument("--driver", choices=("pool", "asyncio"), default=db_connect.EXPLAIN_DRIVER)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Number of queries analysed at the same time. Reduced if the server "
+                             "does not accept enough connections.")
+    parser.add_argument("--executor", choices=(EXECUTOR_THREAD, EXECUTOR_PROCESS),
+                        default=EXECUTOR_PROCESS)
+    parser.add_argument("--sessions", type=int, default=db_connect.POOL_SIZE,
+                        help="Number of database sessions of every worker")
+    parser.add_argument("--sweep-mode", default=qep_processor.SWEEP_MODE,
+                        choices=(qep_processor.SWEEP_MODE_GRID, qep_processor.SWEEP_MODE_ADAPTIVE,
+                                 qep_processor.SWEEP_MODE_SPARSE))
+    parser.add_argument("--probe-mode", default=qep_processor.PROBE_MODE,
+                        choices=(qep_processor.PROBE_MODE_LITERAL, qep_processor.PROBE_MODE_PREPARED,
+                                 qep_processor.PROBE_MODE_SERVER))
+    parser.add_argument("--resolution", type=int, default=qep_processor.RESOLUTION)
+    parser.add_argument("--sweep-timeout", type=float, default=qep_processor.SWEEP_TIMEOUT_S,
+                        help="Time limit of the sweep of one query, in seconds")
+    parser.add_argument("--reduction", type=float, default=qep_processor.REDUCTION_THRESHOLD,
+                        help="Cost increase threshold of the plan diagram reduction, in percent")
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="Do not reuse QEPs cached by previous sweeps")
+    parser.add_argument("--raw-qeps", action="store_true",
+                        help="Write the full EXPLAIN output of every plan, not only the fields shown")
+    parser.add_argument("--no-maps", dest="maps", action="store_false",
+                        help="Do not write the selectivity map and cost surface")
+    parser.add_argument("--trace", metavar="TRACE_FILE",
+                        help="Time every stage and write a Chrome trace of all queries")
+    args = parser.parse_args()
+
+    lstQueryPaths = sorted(glob.glob(os.path.join(args.query_dir, args.pattern)))
+    if len(lstQueryPaths) == 0:
+        raise SystemExit("No queries matching {} found in {}".format(args.pattern, args.query_dir))
+    os.makedirs(args.output_dir, exist_ok=True)
+    dictSettings = vars(args)
+
+    nWorkers = min(args.workers, len(lstQueryPaths))
+    # The asyncio driver opens a synchronous catalog session next to its asynchronous connections
+    nConnectionsPerWorker = args.sessions + (1 if args.driver == "asyncio" else 0)
+    nAvailableConnections = _countAvailableConnections(dictSettings)
+    if nAvailableConnections is not None and nWorkers * nConnectionsPerWorker > nAvailableConnections:
+        nWorkers = max(1, nAvailableConnections // nConnectionsPerWorker)
+        print("The server accepts {} more connections, using {} workers of {} sessions".format(
+            nAvailableConnections, nWorkers, nConnectionsPerWorker))
+
+    if args.executor == EXECUTOR_PROCESS:
+        Executor = concurrent.futures.ProcessPoolExecutor
+    else:
+        Executor = concurrent.futures.ThreadPoolExecutor
+    start = time.perf_counter()
+    lstSummaries = []
+    # Connections of worker processes are closed by the finalizer registered in _initWorker()
+    with Executor(max_workers=nWorkers,
+                  initializer=_initWorker, initargs=(dictSettings,)) as executor:
+        lstFutures = [executor.submit(analyseQueryFile, szQueryPath, dictSettings)
+                      for szQueryPath in lstQueryPaths]
+        for future in concurrent.futures.as_completed(lstFutures):
+            dictSummary = future.result()
+            print("{}: {} ({} plans, {:.1f} s)".format(
+                dictSummary["query_file"], dictSummary["status"], dictSummary["plans"],
+                dictSummary["total_s"]))
+            lstSummaries.append(dictSummary)
+            if dictSummary["trace"] is not None:
+                instrumentation.merge(*dictSummary.pop("trace"))
+    _disconnectAll()
+
+    print("\n{:<24} {:<14} {:>6} {:>10} {:>10}".format("Query", "Status", "Plans", "Points", "Time (s)"))
+    for dictSummary in sorted(lstSummaries, key=lambda dictSummary: dictSummary["query_file"]):
+        print("{:<24} {:<14} {:>6} {:>10} {:>10.1f}".format(
+            dictSummary["query_file"], dictSummary["status"], dictSummary["plans"],
+            dictSummary["points"], dictSummary["total_s"]))
+    print("{} queries in {:.1f} s, results written to {}".format(
+        len(lstSummaries), time.perf_counter() - start, args.output_dir))
+    if args.trace is not None:
+        print("\n" + instrumentation.formatSummary())
+        instrumentation.exportChromeTrace(args.trace)
+    if any(dictSummary["status"] == "error" for dictSummary in lstSummaries):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
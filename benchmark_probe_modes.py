@@ -0,0 +1,102 @@
+"""
+benchmark_probe_modes.py
+
+This script compares the time taken by the selectivity sweep when each grid point is sent as a
+new query string ("literal" probe mode) against a prepared Picasso template ("prepared" probe
+mode). A PostgreSQL server with the database used by the query is required.
+
+Usage:
+    python benchmark_probe_modes.py query.sql --repeats 5 --sessions 1
+
+"""
+import argparse
+import time
+
+import db_connection_manager as db_connect
+import qep_processor
+
+
+def benchmarkProbeMode(query, Communicator, probeMode, nRepeats):
+    """
+    Run the selectivity sweep several times with one probe mode
+
+    Parameters
+    ----------
+    query : String
+        A normal SQL query
+
+    Communicator : Postgres_Connect or Postgres_ConnectPool object
+        For interfacing with database
+
+    probeMode : String
+        One of the qep_processor.PROBE_MODE_* constants
+
+    nRepeats : int
+        Number of sweeps to time
+
+    Returns
+    -------
+    lstTimings : list
+        Wall-clock time of each sweep in seconds
+
+    selectivityMap : numpy.ndarray
+        Selectivity map of the last sweep, to check that both modes find the same plans
+
+    """
+    # The on-disk QEP cache would otherwise serve every sweep after the first one, whatever the
+    # probe mode
+    previousSettings = (qep_processor.PROBE_MODE, qep_processor.USE_QEP_CACHE)
+    qep_processor.PROBE_MODE = probeMode
+    qep_processor.USE_QEP_CACHE = False
+    lstTimings = []
+    selectivityMap = None
+    try:
+        for _ in range(nRepeats):
+            start = time.perf_counter()
+            result = qep_processor.processQuery(query, Communicator)
+            lstTimings.append(time.perf_counter() - start)
+            if result[0] != qep_processor.RET_ALL_QEPS:
+                raise SystemExit("No predicates found in the query")
+            selectivityMap = result[3]
+    finally:
+        qep_processor.PROBE_MODE, qep_processor.USE_QEP_CACHE = previousSettings
+    return lstTimings, selectivityMap
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare literal and prepared probe modes of the selectivity sweep")
+    parser.add_argument("query_file", help="File containing the SQL query")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--database", default="TPC-H")
+    parser.add_argument("--port", default="5432")
+    parser.add_argument("--username", default="postgres")
+    parser.add_argument("--password", default="root")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--sessions", type=int, default=1,
+                        help="Number of pooled sessions, 1 to time the server-side work only")
+    args = parser.parse_args()
+
+    with open(args.query_file) as f:
+        query = f.read()
+
+    Communicator = db_connect.Postgres_ConnectPool()
+    Communicator.connect(args.host, args.database, args.port,
+                         args.username, args.password, args.sessions)
+
+    dictResults = {}
+    for probeMode in (qep_processor.PROBE_MODE_LITERAL, qep_processor.PROBE_MODE_PREPARED):
+        dictResults[probeMode] = benchmarkProbeMode(
+            query, Communicator, probeMode, args.repeats)
+    Communicator.disconnect()
+
+    print("\n{:<10} {:>10} {:>10} {:>10}".format("Mode", "Min (s)", "Mean (s)", "Max (s)"))
+    for probeMode, (lstTimings, _) in dictResults.items():
+        print("{:<10} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+            probeMode, min(lstTimings), sum(lstTimings) / len(lstTimings), max(lstTimings)))
+    if not (dictResults[qep_processor.PROBE_MODE_LITERAL][1] == dictResults[qep_processor.PROBE_MODE_PREPARED][1]).all():
+        print("WARNING: the probe modes produced different selectivity maps")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,697 @@
+"""
+benchmark_suite.py
+
+This script times the hot paths of the tool without a PostgreSQL server: the selectivity sweep
+of processQuery() end to end, the comparison of QEPs, the selectivity ranges of a map, the
+rendering of plans and the extraction of predicates. EXPLAIN results are replayed from
+fixtures by ReplayCommunicator, so the timings only include the work done by the tool itself.
+
+A fixture is recorded from a live server with --record. A synthetic TPC-H-like fixture,
+synthetic plans of up to 1000 nodes and a join chain deeper than the recursion limit are always
+benchmarked, so the suite also runs without any recorded fixture.
+
+The timings are saved as JSON. When a previous result file is given with --baseline, every
+benchmark that became slower by more than --tolerance is reported and the script exits with
+status 1, so regressions between commits are caught.
+
+Usage:
+    python benchmark_suite.py --output results.json --baseline previous_results.json
+    python benchmark_suite.py --record query.sql --fixture query_fixture.json --database TPC-H
+
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import time
+
+import numpy as np
+
+import db_connection_manager as db_connect
+import get_predicates_conditions
+import plan_tree
+import qep_processor
+import query_plan_visualizer as visualiser
+
+# Relations of the synthetic plans in join order, with their cardinality at scale factor 1
+SYNTHETIC_RELATIONS = [
+    ("lineitem", 6001215), ("orders", 1500000), ("partsupp", 800000), ("part", 200000),
+    ("customer", 150000), ("supplier", 10000), ("nation", 25), ("region", 5)]
+
+# Predicate attributes of the synthetic query: relation and the range of its values
+SYNTHETIC_ATTRIBUTES = {
+    "l_quantity": ("lineitem", 1.0, 50.0),
+    "o_totalprice": ("orders", 857.71, 555285.16),
+}
+
+SYNTHETIC_QUERY = """select n_name, sum(l_extendedprice * (1 - l_discount)) as revenue
+from lineitem, orders, partsupp, part, customer, supplier, nation, region
+where l_orderkey = o_orderkey and l_partkey = ps_partkey and l_suppkey = ps_suppkey
+    and ps_partkey = p_partkey and o_custkey = c_custkey and l_suppkey = s_suppkey
+    and s_nationkey = n_nationkey and n_regionkey = r_regionkey
+    and l_quantity <= 20 and o_totalprice <= 100000 and r_name = 'ASIA'
+group by n_name
+order by revenue desc"""
+
+# Number of nodes of the large synthetic plan
+SYNTHETIC_PLAN_NODES = 1000
+# Number of joins of the left-deep join chain, which is deeper than the recursion limit of Python
+DEEP_PLAN_JOINS = 2000
+# Number of distinct plans clustered into plan families, and number of nodes of every plan
+CLUSTER_PLANS = 200
+CLUSTER_PLAN_NODES = 50
+
+# Number of times every benchmark is run. The median is compared against the baseline.
+DEFAULT_REPEATS = 5
+# Relative slowdown of the median that is reported as a regression
+DEFAULT_TOLERANCE = 0.2
+
+
+class ReplayCommunicator():
+    """
+    This is the class that stands in for Postgres_Connect by replaying recorded EXPLAIN results.
+    QEPs are looked up by the text of the query with its predicate values, so a fixture is
+    specific to the Picasso template and the grid points it was recorded with. EXECUTE of a
+    prepared statement is expanded into the same text, so a fixture recorded in "literal" probe
+    mode can be replayed in "prepared" mode and vice versa. The batch EXPLAIN function of "server"
+    probe mode is replayed from the same QEPs.
+
+    Attributes
+    ----------
+    dictQEPs : dict
+        Key: Text of a query
+        Value: Its QEP as a JSON string, parsed again at every lookup like the database driver
+        does
+
+    dictStatistics : dict
+        The result of getAttributeStatistics() for every attribute of the fixture
+
+    """
+
+    def __init__(self, dictFixture):
+        self.dictQEPs = dict((query, json.dumps(qep)) for query, qep in dictFixture["qeps"].items())
+        self.dictStatistics = dictFixture["statistics"]
+        self.dictPreparedStatements = {}
+        # There is no connection, but callers check that one was established
+        self.conn = "replay"
+
+    def connect(self, *args):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def ping(self):
+        return True
+
+    def cancel(self):
+        pass
+
+    def resetCancel(self):
+        pass
+
+    def getQEP(self, query):
+        szQEP = self.dictQEPs.get(_expandExecute(query, self.dictPreparedStatements))
+        if szQEP is None:
+            raise KeyError("Query was not recorded in the fixture: {}".format(query))
+        return [(json.loads(szQEP),)]
+
+    def getQEPs(self, lstQueries):
+        return [self.getQEP(query) for query in lstQueries]
+
+    def executeStatement(self, statement):
+        _recordPrepare(statement, self.dictPreparedStatements)
+        return True
+
+    def explainBatch(self, template, lstPoints, lstKnownFingerprints):
+        # Same rows as the batch EXPLAIN function of db_connection_manager.BATCH_EXPLAIN_FUNCTIONS
+        setKnownFingerprints = set(lstKnownFingerprints)
+        lstResults = []
+        for lstParameters in lstPoints:
+            qep = self.getQEP(template % tuple(lstParameters))[0][0]
+            dictPlan = qep[0]["Plan"]
+            fingerprint = _fingerprintPlanShape(dictPlan)
+            if fingerprint in setKnownFingerprints:
+                qep = None
+            setKnownFingerprints.add(fingerprint)
+            lstResults.append((fingerprint, dictPlan.get("Total Cost"), dictPlan.get("Plan Rows"), qep))
+        return lstResults
+
+    def getAttributeStatistics(self, lstAttributes):
+        return dict((attribute, self.dictStatistics[attribute]) for attribute in lstAttributes)
+
+    def getHistogram(self, tableName, attrName):
+        return self.dictStatistics[attrName]["histogram"]
+
+    def getCardinality(self, tableName):
+        for dictStatistics in self.dictStatistics.values():
+            if dictStatistics["relation"] == tableName:
+                return dictStatistics["cardinality"]
+        return None
+
+    def findRelation(self, attrName):
+        return self.dictStatistics[attrName]["relation"]
+
+    def getStatisticsVersion(self, lstRelations):
+        return "replay"
+
+    def getServerIdentity(self):
+        return "replay"
+
+    def getPlannerSettings(self):
+        return "replay"
+
+
+class RecordingCommunicator():
+    """
+    This is the class that records the EXPLAIN results and statistics retrieved through another
+    communicator, to build a fixture for ReplayCommunicator. All other methods are passed on to
+    the wrapped communicator.
+
+    """
+
+    def __init__(self, objCommunicator):
+        self.objCommunicator = objCommunicator
+        self.dictFixture = {"qeps": {}, "statistics": {}}
+        self.dictPreparedStatements = {}
+
+    def __getattr__(self, name):
+        return getattr(self.objCommunicator, name)
+
+    def getQEP(self, query):
+        return self.getQEPs([query])[0]
+
+    def getQEPs(self, lstQueries):
+        lstResults = self.objCommunicator.getQEPs(lstQueries)
+        for query, result in zip(lstQueries, lstResults):
+            if result is not None:
+                self.dictFixture["qeps"][_expandExecute(query, self.dictPreparedStatements)] = result[0][0]
+        return lstResults
+
+    def executeStatement(self, statement):
+        _recordPrepare(statement, self.dictPreparedStatements)
+        return self.objCommunicator.executeStatement(statement)
+
+    def getAttributeStatistics(self, lstAttributes):
+        dictStatistics = self.objCommunicator.getAttributeStatistics(lstAttributes)
+        for attribute, dictAttribute in dictStatistics.items():
+            self.dictFixture["statistics"][attribute] = {
+                "relation": dictAttribute["relation"],
+                "histogram": [list(row) for row in dictAttribute["histogram"]],
+                "cardinality": dictAttribute["cardinality"],
+            }
+        return dictStatistics
+
+
+class SyntheticCommunicator():
+    """
+    This is the class that plans SYNTHETIC_QUERY without a server, with a simple model of a
+    TPC-H-like database: the scans of lineitem and orders and the join methods depend on the
+    predicate values, and the costs grow with the selectivities. Only used to record the
+    synthetic fixture.
+
+    """
+
+    def __init__(self):
+        self.conn = "synthetic"
+
+    def executeStatement(self, statement):
+        return True
+
+    def cancel(self):
+        pass
+
+    def resetCancel(self):
+        pass
+
+    def getAttributeStatistics(self, lstAttributes):
+        dictStatistics = {}
+        for attribute in lstAttributes:
+            relation, low, high = SYNTHETIC_ATTRIBUTES[attribute]
+            lstBounds = [low + (high - low) * (i / 100) ** 2 for i in range(101)]
+            dictStatistics[attribute] = {
+                "relation": relation,
+                "histogram": [("{" + ",".join("{:.2f}".format(bound) for bound in lstBounds) + "}", None, None)],
+                "cardinality": float(dict(SYNTHETIC_RELATIONS)[relation]),
+            }
+        return dictStatistics
+
+    def getQEPs(self, lstQueries):
+        return [self.getQEP(query) for query in lstQueries]
+
+    def getQEP(self, query):
+        dictSelectivities = {}
+        for attribute, value in re.findall(r"(\w+) <= ([-0-9.e]+)", query):
+            if attribute in SYNTHETIC_ATTRIBUTES:
+                _, low, high = SYNTHETIC_ATTRIBUTES[attribute]
+                dictSelectivities[SYNTHETIC_ATTRIBUTES[attribute][0]] = min(
+                    max((float(value) - low) / (high - low), 0.001), 1.0)
+        return [([{"Plan": _makeSyntheticJoinPlan(dictSelectivities)}],)]
+
+
+def buildSyntheticFixture():
+    """
+    Record the synthetic fixture of SYNTHETIC_QUERY, for every sweep mode
+
+    Returns
+    -------
+    dictFixture : dict
+        The "query", its "qeps" and the "statistics" of its attributes
+
+    """
+    objRecorder = RecordingCommunicator(SyntheticCommunicator())
+    for sweepMode in (qep_processor.SWEEP_MODE_GRID, qep_processor.SWEEP_MODE_ADAPTIVE,
+                      qep_processor.SWEEP_MODE_SPARSE):
+        with _sweepSettings(sweepMode), contextlib.redirect_stdout(io.StringIO()):
+            qep_processor.processQuery(SYNTHETIC_QUERY, objRecorder)
+    objRecorder.dictFixture["query"] = SYNTHETIC_QUERY
+    return objRecorder.dictFixture
+
+
+def recordFixture(query, objCommunicator):
+    """
+    Record the fixture of a query from a live server, for every sweep mode
+
+    Parameters
+    ----------
+    query : String
+        A normal SQL query
+
+    objCommunicator : Postgres_Connect or Postgres_ConnectPool object
+        For interfacing with database
+
+    Returns
+    -------
+    dictFixture : dict
+        The "query", its "qeps" and the "statistics" of its attributes
+
+    """
+    objRecorder = RecordingCommunicator(objCommunicator)
+    for sweepMode in (qep_processor.SWEEP_MODE_GRID, qep_processor.SWEEP_MODE_ADAPTIVE,
+                      qep_processor.SWEEP_MODE_SPARSE):
+        with _sweepSettings(sweepMode):
+            result = qep_processor.processQuery(query, objRecorder)
+        if result[0] != qep_processor.RET_ALL_QEPS:
+            raise SystemExit("No predicates found in the query")
+    objRecorder.getQEP(query)
+    objRecorder.dictFixture["query"] = query
+    return objRecorder.dictFixture
+
+
+def makeSyntheticPlan(nNodes, seed=0):
+    """
+    Build a random QEP with the given number of nodes, to benchmark very large plans
+
+    Parameters
+    ----------
+    nNodes : int
+        Number of nodes of the plan
+
+    seed : int
+        Seed of the random number generator
+
+    Returns
+    -------
+    qep : list
+        A QEP in the JSON format of PostgreSQL
+
+    """
+    objRandom = random.Random(seed)
+    lstNodes = [{"Plans": []}]
+    lstOpen = [lstNodes[0]]
+    for _ in range(nNodes - 1):
+        parent = objRandom.choice(lstOpen)
+        node = {"Plans": []}
+        parent["Plans"].append(node)
+        if len(parent["Plans"]) == 2:
+            lstOpen.remove(parent)
+        lstNodes.append(node)
+        lstOpen.append(node)
+    # Children are always created after their parent, so reversed order visits children first
+    for node in reversed(lstNodes):
+        lstChildren = node["Plans"]
+        if len(lstChildren) == 0:
+            relation, cardinality = objRandom.choice(SYNTHETIC_RELATIONS)
+            node.update(_makeScanNode(relation, cardinality, objRandom.random()))
+            continue
+        if len(lstChildren) == 2:
+            node["Node Type"] = objRandom.choice(["Hash Join", "Merge Join", "Nested Loop"])
+            rows = max(child["Plan Rows"] for child in lstChildren)
+        else:
+            node["Node Type"] = objRandom.choice(["Sort", "Materialize", "Aggregate", "Gather"])
+            rows = lstChildren[0]["Plan Rows"]
+        node.update({
+            "Parallel Aware": False,
+            "Startup Cost": sum(child["Startup Cost"] for child in lstChildren),
+            "Total Cost": round(sum(child["Total Cost"] for child in lstChildren) + rows * 0.01, 2),
+            "Plan Rows": rows,
+            "Plan Width": 32,
+            "Output": ["col_{}".format(i) for i in range(4)],
+        })
+    return [{"Plan": lstNodes[0]}]
+
+
+def makeJoinChainPlan(nJoins, seed=0):
+    """
+    Build a left-deep chain of hash joins, to benchmark very deep plans
+
+    Parameters
+    ----------
+    nJoins : int
+        Number of joins of the plan. The plan has 3 * nJoins + 1 nodes.
+
+    seed : int
+        Seed of the random number generator, which chooses the relations and their selectivity
+
+    Returns
+    -------
+    qep : list
+        A QEP in the JSON format of PostgreSQL
+
+    """
+    objRandom = random.Random(seed)
+    relation, cardinality = objRandom.choice(SYNTHETIC_RELATIONS)
+    plan = _makeScanNode(relation, cardinality, objRandom.random())
+    for _ in range(nJoins):
+        relation, cardinality = objRandom.choice(SYNTHETIC_RELATIONS)
+        scan = _makeScanNode(relation, cardinality, objRandom.random())
+        hashNode = {"Node Type": "Hash", "Parallel Aware": False, "Startup Cost": scan["Total Cost"],
+                    "Total Cost": scan["Total Cost"], "Plan Rows": scan["Plan Rows"], "Plan Width": 64,
+                    "Plans": [scan]}
+        plan = {"Node Type": "Hash Join", "Parallel Aware": False, "Join Type": "Inner",
+                "Startup Cost": scan["Total Cost"],
+                "Total Cost": round(plan["Total Cost"] + scan["Total Cost"] + plan["Plan Rows"] * 0.01, 2),
+                "Plan Rows": plan["Plan Rows"], "Plan Width": 96, "Plans": [plan, hashNode]}
+    return [{"Plan": plan}]
+
+
+def runBenchmarks(lstFixtures, nRepeats):
+    """
+    Time every benchmark
+
+    Parameters
+    ----------
+    lstFixtures : list
+        (name, fixture) of every fixture whose query is swept end to end
+
+    nRepeats : int
+        Number of times every benchmark is run
+
+    Returns
+    -------
+    dictResults : dict
+        Key: Name of the benchmark
+        Value: Its "min_s", "median_s" and number of "repeats"
+
+    """
+    dictBenchmarks = {}
+    for name, dictFixture in lstFixtures:
+        for sweepMode in (qep_processor.SWEEP_MODE_GRID, qep_processor.SWEEP_MODE_ADAPTIVE,
+                          qep_processor.SWEEP_MODE_SPARSE):
+            dictBenchmarks["process_query/{}/{}".format(sweepMode, name)] = (
+                lambda query=dictFixture["query"], objReplay=ReplayCommunicator(dictFixture), sweepMode=sweepMode:
+                _processQuery(query, objReplay, sweepMode))
+        # The grid sweep again, with the points explained in batches by the server
+        dictBenchmarks["process_query/{}_{}/{}".format(
+            qep_processor.SWEEP_MODE_GRID, qep_processor.PROBE_MODE_SERVER, name)] = (
+            lambda query=dictFixture["query"], objReplay=ReplayCommunicator(dictFixture):
+            _processQuery(query, objReplay, qep_processor.SWEEP_MODE_GRID, qep_processor.PROBE_MODE_SERVER))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        objReplay = ReplayCommunicator(lstFixtures[0][1])
+        with _sweepSettings(qep_processor.SWEEP_MODE_ADAPTIVE):
+            result = qep_processor.processQuery(lstFixtures[0][1]["query"], objReplay)
+    adaptiveMap = result[3]
+    dictPlans = {
+        "small": plan_tree.fromQEP([{"Plan": _makeScanNode("orders", 1500000, 0.5)}]),
+        "tpch": result[1][-1],
+        "synthetic_{}".format(SYNTHETIC_PLAN_NODES): plan_tree.fromQEP(makeSyntheticPlan(SYNTHETIC_PLAN_NODES)),
+    }
+    for name, qep in dictPlans.items():
+        # Two plans of the same size that differ in a few nodes
+        otherQEP = plan_tree.fromQEP(json.loads(json.dumps(qep.toQEP()).replace("Hash Join", "Merge Join")))
+        dictBenchmarks["compare_qeps/" + name] = (
+            lambda qep=qep, otherQEP=otherQEP: qep_processor._compareQEPs(qep, otherQEP))
+        # Rendering without the render cache, then showing the same plan again
+        dictBenchmarks["visualize/" + name] = lambda qep=qep: visualiser._visualize_query_plan(qep)
+        dictBenchmarks["visualize/cached/" + name] = lambda qep=qep: visualiser.visualize_query_plan(qep)
+    # Join chains of the same depth with different scans, too deep to be serialised as JSON
+    deepQEP = plan_tree.fromQEP(makeJoinChainPlan(DEEP_PLAN_JOINS))
+    otherDeepQEP = plan_tree.fromQEP(makeJoinChainPlan(DEEP_PLAN_JOINS, seed=1))
+    dictBenchmarks["compare_qeps/join_chain_{}".format(DEEP_PLAN_JOINS)] = (
+        lambda: qep_processor._compareQEPs(deepQEP, otherDeepQEP))
+    dictBenchmarks["visualize/join_chain_{}".format(DEEP_PLAN_JOINS)] = (
+        lambda: visualiser._visualize_query_plan(deepQEP))
+
+    dictBenchmarks["cluster_plans/adaptive"] = lambda: qep_processor.clusterPlans(result[1], adaptiveMap)
+    lstClusterQEPs = [plan_tree.fromQEP(makeSyntheticPlan(CLUSTER_PLAN_NODES, seed=seed)) for seed in range(CLUSTER_PLANS)]
+    clusterMap = np.random.RandomState(0).randint(1, CLUSTER_PLANS + 1, size=(qep_processor.RESOLUTION,) * 2)
+    dictBenchmarks["cluster_plans/synthetic_{}".format(CLUSTER_PLANS)] = (
+        lambda: qep_processor.clusterPlans(lstClusterQEPs, clusterMap))
+
+    gridMap = np.random.RandomState(0).randint(1, 5, size=(qep_processor.RESOLUTION,) * 2).astype(np.uint8)
+    dictBenchmarks["selectivity_ranges/grid"] = lambda: qep_processor._retrieveSelectivityRanges(gridMap)
+    dictBenchmarks["selectivity_ranges/adaptive"] = lambda: qep_processor._retrieveSelectivityRanges(adaptiveMap)
+
+    for name, dictFixture in lstFixtures:
+        dictBenchmarks["predicate_extraction/cold/" + name] = (
+            lambda query=dictFixture["query"]: _compileQueryTemplate(query, bCold=True))
+        dictBenchmarks["predicate_extraction/warm/" + name] = (
+            lambda query=dictFixture["query"]: _compileQueryTemplate(query, bCold=False))
+
+    dictResults = {}
+    for name, function in dictBenchmarks.items():
+        lstTimings = []
+        for _ in range(nRepeats):
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                function()
+                lstTimings.append(time.perf_counter() - start)
+        dictResults[name] = {
+            "min_s": min(lstTimings),
+            "median_s": statistics.median(lstTimings),
+            "repeats": nRepeats,
+        }
+        print("{:<48} {:>12.6f} {:>12.6f}".format(name, dictResults[name]["min_s"], dictResults[name]["median_s"]))
+    return dictResults
+
+
+def compareResults(dictBaseline, dictResults, tolerance):
+    """
+    Find the benchmarks that became slower than in a previous run
+
+    Parameters
+    ----------
+    dictBaseline : dict
+    dictResults : dict
+        Results of the previous and the current run, as returned by runBenchmarks()
+
+    tolerance : float
+        Relative slowdown of the median that is reported as a regression, e.g. 0.2 for 20 %
+
+    Returns
+    -------
+    lstRegressions : list
+        (name, baseline median, current median) of every regression
+
+    """
+    lstRegressions = []
+    for name, dictResult in dictResults.items():
+        dictPrevious = dictBaseline.get(name)
+        if dictPrevious is not None and dictResult["median_s"] > dictPrevious["median_s"] * (1 + tolerance):
+            lstRegressions.append((name, dictPrevious["median_s"], dictResult["median_s"]))
+    return lstRegressions
+
+
+def _processQuery(query, objCommunicator, sweepMode, probeMode=None):
+    with _sweepSettings(sweepMode, probeMode):
+        return qep_processor.processQuery(query, objCommunicator)
+
+
+def _fingerprintPlanShape(dictPlan):
+    """
+    Compute the fingerprint of a plan like pg_temp.qpv_plan_shape() of the batch EXPLAIN function
+
+    """
+    lstTokens = []
+    # None marks the end of a node's children
+    lstStack = [dictPlan]
+    while lstStack:
+        dictNode = lstStack.pop()
+        if dictNode is None:
+            lstTokens.append(")")
+            continue
+        lstTokens.append("({}|{}".format(dictNode["Node Type"], dictNode.get("Relation Name", "")))
+        lstStack.append(None)
+        lstStack.extend(reversed(dictNode.get("Plans", [])))
+    return hashlib.md5("".join(lstTokens).encode("utf-8")).hexdigest()
+
+
+def _compileQueryTemplate(query, bCold):
+    if bCold:
+        get_predicates_conditions._compile_normalized_query.cache_clear()
+    return qep_processor._convertToQueryTemplate(query)
+
+
+@contextlib.contextmanager
+def _sweepSettings(sweepMode, probeMode=None):
+    """
+    Run a sweep with the given sweep mode and without the on-disk QEP cache, which would
+    otherwise serve every sweep after the first one. The probe mode is only changed if given.
+
+    """
+    previousSettings = (qep_processor.SWEEP_MODE, qep_processor.PROBE_MODE, qep_processor.USE_QEP_CACHE)
+    qep_processor.SWEEP_MODE = sweepMode
+    if probeMode is not None:
+        qep_processor.PROBE_MODE = probeMode
+    qep_processor.USE_QEP_CACHE = False
+    try:
+        yield
+    finally:
+        qep_processor.SWEEP_MODE, qep_processor.PROBE_MODE, qep_processor.USE_QEP_CACHE = previousSettings
+
+
+def _recordPrepare(statement, dictPreparedStatements):
+    match = re.match(r"PREPARE (\w+)\(.*?\) AS (.*)", statement, re.S)
+    if match:
+        dictPreparedStatements[match.group(1)] = match.group(2)
+
+
+def _expandExecute(query, dictPreparedStatements):
+    """
+    Substitute the arguments of "EXECUTE name(...)" into the prepared query, which gives the same
+    text as the query bound in "literal" probe mode
+
+    """
+    match = re.match(r"EXECUTE (\w+)\((.*)\)$", query, re.S)
+    if match is None or match.group(1) not in dictPreparedStatements:
+        return query
+    # Arguments are numbers and quoted literals, which do not contain ", " outside of strings
+    lstArguments = re.findall(r"(?:'(?:[^']|'')*'|DATE '[^']*'|[^,])+", match.group(2))
+    return re.sub(r"\$(\d+)", lambda parameter: lstArguments[int(parameter.group(1)) - 1].strip(),
+                  dictPreparedStatements[match.group(1)])
+
+
+def _makeScanNode(relation, cardinality, selectivity):
+    rows = max(int(cardinality * selectivity), 1)
+    if selectivity < 0.05:
+        nodeType, cost = "Index Scan", rows * 0.5 + 0.43
+    elif selectivity < 0.25:
+        nodeType, cost = "Bitmap Heap Scan", rows * 0.1 + cardinality * 0.002
+    else:
+        nodeType, cost = "Seq Scan", cardinality * 0.01 + rows * 0.0025
+    return {
+        "Node Type": nodeType,
+        "Parallel Aware": False,
+        "Relation Name": relation,
+        "Alias": relation,
+        "Startup Cost": 0.0,
+        "Total Cost": round(cost, 2),
+        "Plan Rows": rows,
+        "Plan Width": 64,
+        "Output": ["{}.col_{}".format(relation, i) for i in range(4)],
+        "Filter": "(selectivity <= {:.3f})".format(selectivity) if selectivity < 1 else None,
+        "Plans": [],
+    }
+
+
+def _makeSyntheticJoinPlan(dictSelectivities):
+    """
+    Build the plan of SYNTHETIC_QUERY: a left-deep join of SYNTHETIC_RELATIONS under a sort and
+    an aggregate, about 25 nodes like the larger TPC-H queries
+
+    """
+    plan = None
+    for relation, cardinality in SYNTHETIC_RELATIONS:
+        scan = _makeScanNode(relation, cardinality, dictSelectivities.get(relation, 1.0))
+        if plan is None:
+            plan = scan
+            continue
+        rows = max(min(plan["Plan Rows"], scan["Plan Rows"]), 1)
+        if plan["Plan Rows"] < 1000:
+            nodeType, lstChildren, cost = "Nested Loop", [plan, scan], plan["Plan Rows"] * scan["Total Cost"] * 0.01
+        elif scan["Plan Rows"] > 1000000 and plan["Plan Rows"] > 1000000:
+            nodeType, lstChildren, cost = "Merge Join", [plan, scan], (plan["Plan Rows"] + scan["Plan Rows"]) * 0.02
+        else:
+            hashNode = {"Node Type": "Hash", "Parallel Aware": False, "Startup Cost": scan["Total Cost"],
+                        "Total Cost": scan["Total Cost"], "Plan Rows": scan["Plan Rows"], "Plan Width": 64,
+                        "Output": scan["Output"], "Plans": [scan]}
+            nodeType, lstChildren, cost = "Hash Join", [plan, hashNode], plan["Plan Rows"] * 0.01
+        plan = {
+            "Node Type": nodeType, "Parallel Aware": False, "Startup Cost": 0.0,
+            "Total Cost": round(sum(child["Total Cost"] for child in lstChildren) + cost, 2),
+            "Plan Rows": rows, "Plan Width": 96, "Output": ["revenue"], "Plans": lstChildren,
+        }
+    for nodeType in ("Aggregate", "Sort"):
+        plan = {
+            "Node Type": nodeType, "Parallel Aware": False, "Startup Cost": plan["Total Cost"],
+            "Total Cost": round(plan["Total Cost"] + plan["Plan Rows"] * 0.001, 2),
+            "Plan Rows": 25, "Plan Width": 32, "Output": ["n_name", "revenue"], "Plans": [plan],
+        }
+    return plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the hot paths of the tool on recorded EXPLAIN results")
+    parser.add_argument("--fixture", action="append", default=[],
+                        help="Recorded fixture to benchmark, or the file to write with --record")
+    parser.add_argument("--record", metavar="QUERY_FILE",
+                        help="Record the fixture of a query from a live server instead of benchmarking")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--database", default="TPC-H")
+    parser.add_argument("--port", default="5432")
+    parser.add_argument("--username", default="postgres")
+    parser.add_argument("--password", default="root")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="Results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    if args.record is not None:
+        if len(args.fixture) != 1:
+            raise SystemExit("--record needs exactly one --fixture file to write")
+        with open(args.record) as f:
+            query = f.read()
+        Communicator = db_connect.createCommunicator(
+            args.host, args.database, args.port, args.username, args.password)
+        dictFixture = recordFixture(query, Communicator)
+        Communicator.disconnect()
+        with open(args.fixture[0], "w") as f:
+            json.dump(dictFixture, f)
+        print("Recorded {} QEPs to {}".format(len(dictFixture["qeps"]), args.fixture[0]))
+        return
+
+    lstFixtures = [("synthetic_tpch", buildSyntheticFixture())]
+    for szPath in args.fixture:
+        with open(szPath) as f:
+            lstFixtures.append((os.path.splitext(os.path.basename(szPath))[0], json.load(f)))
+
+    print("{:<48} {:>12} {:>12}".format("Benchmark", "Min (s)", "Median (s)"))
+    dictResults = runBenchmarks(lstFixtures, args.repeats)
+    with open(args.output, "w") as f:
+        json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                   "created": time.strftime("%Y-%m-%d %H:%M:%S"), "benchmarks": dictResults}, f, indent=1)
+    print("Results written to {}".format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            dictBaseline = json.load(f)["benchmarks"]
+        lstRegressions = compareResults(dictBaseline, dictResults, args.tolerance)
+        for name, baseline, current in lstRegressions:
+            print("REGRESSION {}: {:.6f} s -> {:.6f} s ({:+.0f} %)".format(
+                name, baseline, current, (current / baseline - 1) * 100))
+        if len(lstRegressions) > 0:
+            raise SystemExit(1)
+        print("No regressions against {}".format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,96 @@ Database settings can be configured from the GUI
 
 """
 
+import asyncio
+import contextlib
+import hashlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import psycopg2
+import psycopg2.extensions
+
+import instrumentation
+
+# Number of database sessions used to send EXPLAIN requests concurrently
+POOL_SIZE = 4
+# Number of asynchronous connections used by Postgres_AsyncConnect. These are cheap to keep
+# busy since no thread is needed per connection.
+ASYNC_POOL_SIZE = 16
+# Driver used by createCommunicator(), either "pool" (threads) or "asyncio"
+EXPLAIN_DRIVER = "pool"
+
+"""
+https://www.postgresql.org/docs/9.3/sql-explain.html
+Optional parameters:
+- ANALYZE [BOOLEAN] ==> False (Default)
+- VERBOSE [BOOLEAN] ==> True
+- COSTS [BOOLEAN] ==> True
+- BUFFERS [BOOLEAN] ==> False (Default)
+- TIMING [BOOLEAN] ==> False
+- FORMAT {TEXT | XML | JSON | YAML}
+"""
+EXPLAIN_STATEMENT = "EXPLAIN (FORMAT JSON, COSTS TRUE, TIMING FALSE, VERBOSE TRUE)"
+
+"""
+Functions used by explainBatch() to explain a whole batch of grid points in one round trip. They
+are created in pg_temp, so they are private to the session and dropped when it ends, and do not
+need any privilege besides TEMPORARY.
+
+- qpv_plan_shape(plan) lists the node types and relations of a plan and the shape of its tree,
+  with the same tokens as plan_tree.PlanNode.fingerprint()
+- qpv_explain_batch(template, points, known) substitutes each row of points into the slots of
+  template with format(), explains the query and returns the index of the point (from 1), the
+  md5 of the shape of its plan, and the total cost and row estimate of the plan. The QEP itself
+  is only returned for a fingerprint that is neither in known nor returned earlier by the same
+  call. Points that fail are skipped, a cancelled point cancels the whole call.
+"""
+BATCH_EXPLAIN_FUNCTIONS = """
+CREATE OR REPLACE FUNCTION pg_temp.qpv_plan_shape(plan json) RETURNS text AS $qpv$
+DECLARE
+	shape text := '(' || (plan->>'Node Type') || '|' || coalesce(plan->>'Relation Name', '');
+	child json;
+BEGIN
+	IF plan->'Plans' IS NOT NULL THEN
+		FOR child IN SELECT json_array_elements(plan->'Plans') LOOP
+			shape := shape || pg_temp.qpv_plan_shape(child);
+		END LOOP;
+	END IF;
+	RETURN shape || ')';
+END
+$qpv$ LANGUAGE plpgsql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION pg_temp.qpv_explain_batch(template text, points text[], known text[])
+RETURNS TABLE(point_index integer, fingerprint text, total_cost float8, plan_rows float8, qep json) AS $qpv$
+DECLARE
+	point text[];
+	plan json;
+BEGIN
+	point_index := 0;
+	FOREACH point SLICE 1 IN ARRAY points LOOP
+		point_index := point_index + 1;
+		BEGIN
+			EXECUTE '""" + EXPLAIN_STATEMENT + """ ' || format(template, VARIADIC point) INTO qep;
+		EXCEPTION WHEN OTHERS THEN
+			RAISE WARNING 'qpv_explain_batch: point %: %', point_index, SQLERRM;
+			CONTINUE;
+		END;
+		plan := qep->0->'Plan';
+		fingerprint := md5(pg_temp.qpv_plan_shape(plan));
+		total_cost := (plan->>'Total Cost')::float8;
+		plan_rows := (plan->>'Plan Rows')::float8;
+		IF fingerprint = ANY(known) THEN
+			qep := NULL;
+		ELSE
+			known := known || fingerprint;
+		END IF;
+		RETURN NEXT;
+	END LOOP;
+END
+$qpv$ LANGUAGE plpgsql;
+"""
+BATCH_EXPLAIN_QUERY = "SELECT * FROM pg_temp.qpv_explain_batch(%s, %s::text[], %s::text[])"
 
 class Postgres_Connect():
 	"""
@@ -20,6 +109,10 @@ class Postgres_Connect():
 		cur : psycopg2.Cursor object
 		Allows Python code to execute PostgreSQL command in a database session.
 
+	dictAttributeStatistics : dict
+		Statistics of attributes retrieved by getAttributeStatistics(), reused for as long as the
+		statistics of their relations do not change
+
 	Methods
 	-------
 	connect(host, database, port, username, password)
@@ -31,6 +124,25 @@ class Postgres_Connect():
 `	getQEP(query)
 			Get the QEP in JSON from the database, based on the query provided
 
+	getQEPs(lstQueries)
+			Get the QEPs for several queries, in the same order as the queries
+
+	explainBatch(template, lstPoints, lstKnownFingerprints)
+			Explain a query template at several points in one round trip, with the functions of
+			BATCH_EXPLAIN_FUNCTIONS
+
+	executeStatement(statement)
+			Run a statement which does not return rows, such as SET or PREPARE
+
+	ping()
+			Check that the connection to the server is still usable with a cheap round trip
+
+	cancel()
+			Ask the server to cancel the statement currently running on this session
+
+	resetCancel()
+			Accept EXPLAIN requests again after cancel(), at the start of a sweep
+
 	getHistogram(tableName, attrName)
 			Get histogram for specific column in table to determine min and max values
 
@@ -40,6 +152,18 @@ class Postgres_Connect():
 	findRelation(attrName)
 			Determine which relation a column attribute is from
 
+	getStatisticsVersion(lstRelations)
+			Get a version string that changes whenever the statistics of the relations change
+
+	getServerIdentity()
+			Get a string identifying the server and database this session is connected to
+
+	getPlannerSettings()
+			Get a version string of the planner settings of this session
+
+	getAttributeStatistics(lstAttributes)
+			Get the relation, histogram and cardinality of several attributes in one round trip
+
 	processQuery(query)
 			Handle generic queries to database`
 
@@ -48,6 +172,7 @@ class Postgres_Connect():
 	def __init__(self):
 		self.conn = None
 		self.cur = None
+		self.dictAttributeStatistics = {}
 
 	def connect(self, host, database, port, username, password):
 		"""
@@ -67,6 +192,9 @@ class Postgres_Connect():
 		try:
 			self.conn = psycopg2.connect(
 				host=host, database=database, user=username, password=password, port=port)
+			# Without autocommit the session would stay inside one transaction, which keeps
+			# seeing the same snapshot of the statistics views
+			self.conn.autocommit = True
 			self.cur = self.conn.cursor()
 			print("Connection is successful.")
 
@@ -99,22 +227,136 @@ class Postgres_Connect():
 		"""
 		if (self.conn is not None):
 			try:
-				"""
-				https://www.postgresql.org/docs/9.3/sql-explain.html
-				Optional parameters:
-				- ANALYZE [BOOLEAN] ==> False (Default)
-				- VERBOSE [BOOLEAN] ==> True
-				- COSTS [BOOLEAN] ==> True
-				- BUFFERS [BOOLEAN] ==> False (Default)
-				- TIMING [BOOLEAN] ==> False
-				- FORMAT {TEXT | XML | JSON | YAML}
-				"""
-				statement = "EXPLAIN (FORMAT JSON, COSTS TRUE, TIMING FALSE, VERBOSE TRUE)"
-				self.cur.execute(statement + query)
-				result = self.cur.fetchall()
+				with instrumentation.span("getQEP"):
+					self.cur.execute(EXPLAIN_STATEMENT + query)
+					result = self.cur.fetchall()
 				return result
+			except psycopg2.extensions.QueryCanceledError:
+				print("EXPLAIN was cancelled or exceeded statement_timeout")
+			except (Exception, psycopg2.DatabaseError) as error:
+				print(error)
+
+	def cancel(self):
+		"""
+		Ask the server to cancel the statement currently running on this session, if any. Can be
+		called from another thread.
+
+		"""
+		if (self.conn is not None):
+			try:
+				self.conn.cancel()
+			except (Exception, psycopg2.DatabaseError) as error:
+				print(error)
+
+	def resetCancel(self):
+		"""
+		Accept EXPLAIN requests again after cancel(), at the start of a sweep. A single session does
+		not hold back queued requests, so there is nothing to reset.
+
+		"""
+		pass
+
+	def getQEPs(self, lstQueries):
+		"""
+		Get the QEPs for several queries, one after another on this session
+
+		Parameters
+		----------
+		lstQueries : list
+				Valid SQL queries
+
+		Returns
+		-------
+		result : list
+				The result of getQEP() for each query, in the same order as lstQueries
+
+		"""
+		return [self.getQEP(query) for query in lstQueries]
+
+	def explainBatch(self, template, lstPoints, lstKnownFingerprints):
+		"""
+		Explain a query template at several points in one round trip. BATCH_EXPLAIN_FUNCTIONS must
+		have been run on this session first.
+
+		Parameters
+		----------
+		template : String
+				The query with %s in place of every predicate value
+
+		lstPoints : list
+				The SQL literals of the predicate values of every point, one list per point
+
+		lstKnownFingerprints : list
+				Fingerprints of plans that were already received. The QEP of a point with one of
+				these plans is not sent again.
+
+		Returns
+		-------
+		result : list
+				(fingerprint, total cost, row estimate, QEP in JSON format) of every point, in the
+				same order as lstPoints. The QEP is None if its fingerprint was known or was sent
+				for an earlier point of lstPoints. None for a point that failed.
+
+		"""
+		lstResults = [None for _ in lstPoints]
+		if (self.conn is not None):
+			try:
+				with instrumentation.span("explainBatch", points=len(lstPoints)):
+					self.cur.execute(BATCH_EXPLAIN_QUERY, (template, lstPoints, lstKnownFingerprints))
+					lstRows = self.cur.fetchall()
+				for pointIndex, fingerprint, totalCost, rows, qep in lstRows:
+					lstResults[pointIndex - 1] = (fingerprint, totalCost, rows, qep)
+			except psycopg2.extensions.QueryCanceledError:
+				print("EXPLAIN batch was cancelled or exceeded statement_timeout")
+			except (Exception, psycopg2.DatabaseError) as error:
+				print(error)
+		return lstResults
+
+	def executeStatement(self, statement):
+		"""
+		Run a statement which does not return rows, such as SET or PREPARE, and commit it so that
+		it stays in effect for the rest of the session
+
+		Parameters
+		----------
+		statement : String
+				A valid SQL statement
+
+		Returns
+		-------
+		result : bool
+				True if the statement was successful
+
+		"""
+		if (self.conn is not None):
+			try:
+				self.cur.execute(statement)
+				self.conn.commit()
+				return True
 			except (Exception, psycopg2.DatabaseError) as error:
 				print(error)
+				self.conn.rollback()
+		return False
+
+	def ping(self):
+		"""
+		Check that the connection to the server is still usable with a cheap round trip
+
+		Returns
+		-------
+		result : bool
+				True if the server answered
+
+		"""
+		if (self.conn is None or self.conn.closed):
+			return False
+		try:
+			self.cur.execute("SELECT 1")
+			self.cur.fetchone()
+			return True
+		except (Exception, psycopg2.DatabaseError) as error:
+			print(error)
+			return False
 
 	def getHistogram(self, tableName, attrName):
 		"""
@@ -138,9 +380,8 @@ class Postgres_Connect():
 		if (self.conn is not None):
 			try:
 				query = ("SELECT histogram_bounds, most_common_vals, most_common_freqs \
-						FROM pg_stats WHERE tablename = '{}' AND attname = '{}'"
-						 .format(tableName, attrName))
-				self.cur.execute(query)
+						FROM pg_stats WHERE tablename = %s AND attname = %s")
+				self.cur.execute(query, (tableName, attrName))
 				result = self.cur.fetchall()
 				print("Histogram retrieved.")
 				return result
@@ -163,9 +404,8 @@ class Postgres_Connect():
 
 		"""
 		cardinality = 0
-		query = (
-			"SELECT reltuples FROM pg_class WHERE relname = '{}';".format(tableName))
-		self.cur.execute(query)
+		query = "SELECT reltuples FROM pg_class WHERE relname = %s;"
+		self.cur.execute(query, (tableName,))
 		result = self.cur.fetchall()
 		cardinality = result[0][0]
 		# print("Cardinality of {} retrieved = {}".format(tableName, cardinality))
@@ -187,13 +427,147 @@ class Postgres_Connect():
 
 		"""
 		query = ("SELECT c.relname FROM pg_class AS c INNER JOIN pg_attribute AS a ON a.attrelid = c.oid \
-				WHERE a.attname = '{}' AND c.relkind = 'r'".format(attrName))
-		self.cur.execute(query)
+				WHERE a.attname = %s AND c.relkind = 'r'")
+		self.cur.execute(query, (attrName,))
 		result = self.cur.fetchall()
 		tableName = result[0][0]
 		# print("Attr name {} found in table {}".format(attrName, tableName))
 		return tableName
 
+	def getStatisticsVersion(self, lstRelations):
+		"""
+		Get a version string that changes whenever the planner statistics of the relations change,
+		i.e. when a relation is analysed (manually or by autovacuum) or its size changes
+
+		Parameters
+		----------
+		lstRelations : list
+				Names of relations in the database
+
+		Returns
+		-------
+		result : String
+				Hex digest of the statistics of all relations, or None if it could not be retrieved
+
+		"""
+		dictVersions = self._getRelationVersions(lstRelations)
+		if dictVersions is not None:
+			return hashlib.sha1(repr(sorted(dictVersions.items())).encode("utf-8")).hexdigest()
+
+	def getServerIdentity(self):
+		"""
+		Get a string identifying the server and database this session is connected to, so that
+		QEPs retrieved from different servers are not mixed up
+
+		Returns
+		-------
+		result : String
+				Host, port, database name and server version, or None if not connected
+
+		"""
+		if (self.conn is not None):
+			info = self.conn.info
+			return "{}:{}/{} {}".format(info.host, info.port, info.dbname, info.server_version)
+
+	def getPlannerSettings(self):
+		"""
+		Get a version string of the settings that change the plans chosen by the planner, such as
+		random_page_cost, work_mem, the enable_* switches and default_statistics_target, so that
+		QEPs retrieved with other settings are not mixed up
+
+		Returns
+		-------
+		result : String
+				Hex digest of the "Query Tuning" settings, or None if they could not be retrieved
+
+		"""
+		if (self.conn is not None):
+			try:
+				query = ("SELECT name, setting FROM pg_settings WHERE category LIKE 'Query Tuning%' \
+						ORDER BY name")
+				self.cur.execute(query)
+				return hashlib.sha1(repr(self.cur.fetchall()).encode("utf-8")).hexdigest()
+			except (Exception, psycopg2.DatabaseError) as error:
+				print(error)
+
+	def _getRelationVersions(self, lstRelations):
+		"""
+		Get the statistics version of every relation, as a string built from the columns of
+		pg_class and pg_stat_user_tables that change when the relation is analysed
+
+		"""
+		if (self.conn is not None):
+			try:
+				query = ("SELECT c.relname, c.relpages, c.reltuples, s.last_analyze, s.last_autoanalyze \
+						FROM pg_class AS c LEFT JOIN pg_stat_user_tables AS s ON s.relid = c.oid \
+						WHERE c.relname = ANY(%s) AND c.relkind = 'r' ORDER BY c.relname")
+				self.cur.execute(query, (list(lstRelations),))
+				return dict((row[0], repr(row[1:])) for row in self.cur.fetchall())
+			except (Exception, psycopg2.DatabaseError) as error:
+				print(error)
+
+	def getAttributeStatistics(self, lstAttributes, dictCache=None):
+		"""
+		Get the relation, histogram and cardinality of several attributes in a single round trip.
+		The result is cached, and reused for as long as the statistics of the relations do not
+		change. Checking whether they have changed also takes a single round trip.
+
+		Parameters
+		----------
+		lstAttributes : list
+				Valid attributes that are contained within some relation table
+
+		dictCache : dict
+				Cache to use instead of the cache of this session
+
+		Returns
+		-------
+		result : dict
+				Key: An attribute from lstAttributes
+				Value: A dict with the keys "relation" (as returned by findRelation()), "histogram"
+				(as returned by getHistogram()) and "cardinality" (as returned by getCardinality())
+
+		"""
+		if dictCache is None:
+			dictCache = self.dictAttributeStatistics
+		if all(attribute in dictCache for attribute in lstAttributes):
+			dictVersions = self._getRelationVersions(
+				set(dictCache[attribute]["relation"] for attribute in lstAttributes))
+			if dictVersions is not None and all(
+					dictVersions.get(dictCache[attribute]["relation"]) == dictCache[attribute]["version"]
+					for attribute in lstAttributes):
+				print("Statistics of {} reused.".format(", ".join(lstAttributes)))
+				return dict((attribute, dictCache[attribute]) for attribute in lstAttributes)
+
+		print("Retrieving statistics for {}...".format(", ".join(lstAttributes)))
+		if (self.conn is not None):
+			try:
+				# For each attribute, the first relation that has it is used, as in findRelation()
+				query = ("SELECT DISTINCT ON (a.attname) a.attname, c.relname, \
+						s.histogram_bounds::text, s.most_common_vals::text, s.most_common_freqs, \
+						c.reltuples, c.relpages, st.last_analyze, st.last_autoanalyze \
+						FROM pg_attribute AS a \
+						INNER JOIN pg_class AS c ON a.attrelid = c.oid \
+						INNER JOIN pg_namespace AS n ON n.oid = c.relnamespace \
+						LEFT JOIN pg_stats AS s ON s.schemaname = n.nspname \
+							AND s.tablename = c.relname AND s.attname = a.attname \
+						LEFT JOIN pg_stat_user_tables AS st ON st.relid = c.oid \
+						WHERE a.attname = ANY(%s) AND c.relkind = 'r' \
+						ORDER BY a.attname, c.oid")
+				self.cur.execute(query, (list(lstAttributes),))
+				for row in self.cur.fetchall():
+					dictCache[row[0]] = {
+						"relation": row[1],
+						"histogram": [(row[2], row[3], row[4])],
+						"cardinality": row[5],
+						# Same format as _getRelationVersions()
+						"version": repr((row[6], row[5], row[7], row[8])),
+					}
+				print("Statistics retrieved.")
+				return dict((attribute, dictCache.get(attribute)) for attribute in lstAttributes)
+			except (Exception, psycopg2.DatabaseError) as error:
+				print(error)
+
 	def processQuery(self, query):
 		"""
 		Handle generic queries to database
@@ -218,6 +592,747 @@ class Postgres_Connect():
 				print(error)
 
 
+class Postgres_ConnectPool():
+	"""
+	This is a thread-safe pool of Postgres_Connect sessions. It offers the same methods as
+	Postgres_Connect so that it can be used in its place, and sends EXPLAIN requests to all
+	sessions concurrently in getQEPs().
+
+	Attributes
+	----------
+	lstSessions : list
+		All Postgres_Connect sessions that were connected successfully. Each session owns its own
+		connection and cursor, and is only used by one worker at a time.
+
+	queueIdleSessions : queue.Queue
+		Sessions which are not currently used by a worker
+
+	executor : concurrent.futures.ThreadPoolExecutor
+		Worker threads, one per session
+
+	Methods
+	-------
+	connect(host, database, port, username, password, nSessions)
+		Open nSessions connections to the PostgreSQL server
+
+	disconnect()
+		Disconnect all sessions from the server
+
+	getQEPs(lstQueries)
+		Get the QEPs for several queries concurrently, in the same order as the queries
+
+	explainBatch(template, lstPoints, lstKnownFingerprints)
+		Explain a query template at several points, with one batch per session
+
+	executeStatement(statement)
+		Run a statement such as SET or PREPARE on every session
+
+	ping()
+		Check that every session of the pool is still usable
+
+	cancel()
+		Cancel the EXPLAIN requests of the current sweep
+
+	resetCancel()
+		Accept EXPLAIN requests again after cancel(), at the start of a sweep
+
+	"""
+
+	def __init__(self):
+		self.conn = None
+		self.dictAttributeStatistics = {}
+		self.lstSessions = []
+		self.queueIdleSessions = queue.Queue()
+		self.executor = None
+		# Set by cancel(), so that queued EXPLAIN requests are not sent
+		self.eventCancelled = threading.Event()
+
+	def connect(self, host, database, port, username, password, nSessions=POOL_SIZE):
+		"""
+		Open nSessions connections to the PostgreSQL server
+
+		Parameters
+		----------
+		host : string
+		database : string
+		port : string
+		username : string
+		password : string
+				Required information by PostgreSQL to connect to database
+
+		nSessions : int
+				Number of sessions in the pool
+
+		"""
+		for _ in range(nSessions):
+			session = Postgres_Connect()
+			session.connect(host, database, port, username, password)
+			if session.conn is None:
+				# Do not retry with the same settings if the server refuses the connection
+				break
+			self.lstSessions.append(session)
+			self.queueIdleSessions.put(session)
+		if len(self.lstSessions) > 0:
+			self.conn = self.lstSessions[0].conn
+			self.executor = ThreadPoolExecutor(max_workers=len(self.lstSessions))
+
+	def disconnect(self):
+		"""
+		Disconnect all sessions from the server
+
+		"""
+		if self.executor is not None:
+			self.executor.shutdown(wait=True)
+			self.executor = None
+		for session in self.lstSessions:
+			session.disconnect()
+		self.lstSessions = []
+		self.queueIdleSessions = queue.Queue()
+		self.conn = None
+
+	@contextlib.contextmanager
+	def _borrowSession(self):
+		"""
+		Take an idle session for the duration of the with-block, waiting for one if all
+		sessions are busy
+
+		"""
+		if len(self.lstSessions) == 0:
+			# Behave like a single session that failed to connect
+			yield Postgres_Connect()
+			return
+		session = self.queueIdleSessions.get()
+		try:
+			yield session
+		finally:
+			self.queueIdleSessions.put(session)
+
+	def getQEP(self, query):
+		with self._borrowSession() as session:
+			return session.getQEP(query)
+
+	def getQEPs(self, lstQueries):
+		"""
+		Get the QEPs for several queries concurrently, using all sessions of the pool
+
+		Parameters
+		----------
+		lstQueries : list
+				Valid SQL queries
+
+		Returns
+		-------
+		result : list
+				The result of getQEP() for each query, in the same order as lstQueries
+
+		"""
+		if self.executor is None:
+			return [None for _ in lstQueries]
+		# Executor.map() yields the results in the order of the inputs
+		return list(self.executor.map(self._getQEPUnlessCancelled, lstQueries))
+
+	def _getQEPUnlessCancelled(self, query):
+		if self.eventCancelled.is_set():
+			return None
+		return self.getQEP(query)
+
+	def explainBatch(self, template, lstPoints, lstKnownFingerprints):
+		"""
+		Explain a query template at several points. The points are split into one batch per
+		session, so that every session plans its batch concurrently in one round trip. See
+		Postgres_Connect.explainBatch().
+
+		"""
+		if self.executor is None:
+			return [None for _ in lstPoints]
+		lstBatches = _splitBatches(lstPoints, len(self.lstSessions))
+		lstResults = []
+		for lstBatchResults in self.executor.map(
+				lambda lstBatch: self._explainBatchUnlessCancelled(template, lstBatch, lstKnownFingerprints),
+				lstBatches):
+			lstResults.extend(lstBatchResults)
+		return lstResults
+
+	def _explainBatchUnlessCancelled(self, template, lstPoints, lstKnownFingerprints):
+		if self.eventCancelled.is_set():
+			return [None for _ in lstPoints]
+		with self._borrowSession() as session:
+			return session.explainBatch(template, lstPoints, lstKnownFingerprints)
+
+	def cancel(self):
+		"""
+		Cancel the EXPLAIN requests of the current sweep. Requests in flight are cancelled by the
+		server, and neither the queued ones nor those of later batches are sent until
+		resetCancel() is called, so their result is None. Can be called from another thread.
+
+		"""
+		self.eventCancelled.set()
+		for session in self.lstSessions:
+			session.cancel()
+
+	def resetCancel(self):
+		"""
+		Accept EXPLAIN requests again after cancel(). Called once when a sweep starts rather than
+		by every batch, so that a cancel between two batches is not lost.
+
+		"""
+		self.eventCancelled.clear()
+
+	def executeStatement(self, statement):
+		"""
+		Run a statement on every session of the pool, since settings and prepared statements only
+		apply to the session they were run on
+
+		Parameters
+		----------
+		statement : String
+				A valid SQL statement which does not return rows
+
+		Returns
+		-------
+		result : bool
+				True if the statement was successful on all sessions
+
+		"""
+		if len(self.lstSessions) == 0:
+			return False
+		# Take every session out of the pool so that no probe runs while the statement is applied
+		lstBorrowed = [self.queueIdleSessions.get() for _ in self.lstSessions]
+		try:
+			return all([session.executeStatement(statement) for session in lstBorrowed])
+		finally:
+			for session in lstBorrowed:
+				self.queueIdleSessions.put(session)
+
+	def ping(self):
+		"""
+		Check that every session of the pool is still usable
+
+		"""
+		if len(self.lstSessions) == 0:
+			return False
+		lstBorrowed = [self.queueIdleSessions.get() for _ in self.lstSessions]
+		try:
+			return all([session.ping() for session in lstBorrowed])
+		finally:
+			for session in lstBorrowed:
+				self.queueIdleSessions.put(session)
+
+	def getHistogram(self, tableName, attrName):
+		with self._borrowSession() as session:
+			return session.getHistogram(tableName, attrName)
+
+	def getCardinality(self, tableName):
+		with self._borrowSession() as session:
+			return session.getCardinality(tableName)
+
+	def findRelation(self, attrName):
+		with self._borrowSession() as session:
+			return session.findRelation(attrName)
+
+	def getStatisticsVersion(self, lstRelations):
+		with self._borrowSession() as session:
+			return session.getStatisticsVersion(lstRelations)
+
+	def getServerIdentity(self):
+		with self._borrowSession() as session:
+			return session.getServerIdentity()
+
+	def getPlannerSettings(self):
+		with self._borrowSession() as session:
+			return session.getPlannerSettings()
+
+	def getAttributeStatistics(self, lstAttributes):
+		# Share one cache between all sessions, since they are connected to the same database
+		with self._borrowSession() as session:
+			return session.getAttributeStatistics(lstAttributes, self.dictAttributeStatistics)
+
+	def processQuery(self, query):
+		with self._borrowSession() as session:
+			return session.processQuery(query)
+
+
+class Postgres_AsyncConnect():
+	"""
+	This is a communicator that keeps many EXPLAIN requests in flight using asyncio and the
+	asynchronous connections of psycopg2. No thread is needed per connection, so many more
+	connections than with Postgres_ConnectPool can be kept busy to hide the network round trip
+	when the server is on another host.
+
+	The awaitable methods getQEPAsync() and getQEPsAsync() can be used from asyncio code. The
+	synchronous getQEP() and getQEPs() run them on the private event loop of this object, so it
+	can also be passed to qep_processor.processQuery() in place of Postgres_Connect.
+
+	Attributes
+	----------
+	lstConnections : list
+		Asynchronous psycopg2 connections. psycopg2 cannot pipeline several statements on one
+		connection, so each connection has at most one EXPLAIN in flight.
+
+	queueIdleConnections : asyncio.Queue
+		Connections which are not currently waiting for a result
+
+	catalogSession : Postgres_Connect object
+		Synchronous session used for catalog lookups, which are only done a few times per sweep
+
+	loop : asyncio.SelectorEventLoop object
+		Private event loop used by the synchronous methods. The awaitable methods also need a
+		selector event loop, since they wait on the sockets of the connections.
+
+	Methods
+	-------
+	connect(host, database, port, username, password, nConnections)
+		Open nConnections asynchronous connections to the PostgreSQL server
+
+	disconnect()
+		Disconnect all connections from the server
+
+	getQEPAsync(query)
+		Awaitable version of Postgres_Connect.getQEP()
+
+	getQEPsAsync(lstQueries)
+		Get the QEPs for several queries concurrently, in the same order as the queries
+
+	explainBatchAsync(template, lstPoints, lstKnownFingerprints)
+		Explain a query template at several points, with one batch per connection
+
+	executeStatementAsync(statement)
+		Run a statement such as SET or PREPARE on every asynchronous connection
+
+	ping()
+		Check that the catalog session and every asynchronous connection are still usable
+
+	cancel()
+		Cancel the EXPLAIN requests of the current sweep
+
+	resetCancel()
+		Accept EXPLAIN requests again after cancel(), at the start of a sweep
+
+	"""
+
+	def __init__(self):
+		self.conn = None
+		self.lstConnections = []
+		self.queueIdleConnections = None
+		self.catalogSession = Postgres_Connect()
+		self.loop = None
+		# Set by cancel(), so that queued EXPLAIN requests are not sent
+		self.eventCancelled = threading.Event()
+
+	def connect(self, host, database, port, username, password, nConnections=ASYNC_POOL_SIZE):
+		"""
+		Open nConnections asynchronous connections to the PostgreSQL server
+
+		Parameters
+		----------
+		host : string
+		database : string
+		port : string
+		username : string
+		password : string
+				Required information by PostgreSQL to connect to database
+
+		nConnections : int
+				Number of asynchronous connections
+
+		"""
+		self.catalogSession.connect(host, database, port, username, password)
+		if self.catalogSession.conn is None:
+			return
+		self.conn = self.catalogSession.conn
+		# _waitAsync() needs add_reader() and add_writer(), which the default proactor event loop
+		# of Windows does not implement
+		self.loop = asyncio.SelectorEventLoop()
+		self.loop.run_until_complete(self._connectAsync(
+			host, database, port, username, password, nConnections))
+
+	async def _connectAsync(self, host, database, port, username, password, nConnections):
+		self.queueIdleConnections = asyncio.Queue()
+		for _ in range(nConnections):
+			try:
+				conn = psycopg2.connect(
+					host=host, database=database, user=username, password=password, port=port,
+					async_=1)
+				await _waitAsync(conn)
+			except (Exception, psycopg2.DatabaseError) as error:
+				print(error)
+				break
+			self.lstConnections.append(conn)
+			self.queueIdleConnections.put_nowait(conn)
+		print("{} asynchronous connections opened.".format(len(self.lstConnections)))
+
+	def disconnect(self):
+		"""
+		Disconnect all connections from the server
+
+		"""
+		for conn in self.lstConnections:
+			conn.close()
+		self.lstConnections = []
+		if self.loop is not None:
+			self.loop.close()
+			self.loop = None
+		self.catalogSession.disconnect()
+		self.conn = None
+
+	async def getQEPAsync(self, query):
+		"""
+		Get the QEP in JSON from the database, based on the query provided. Waits for an idle
+		connection if all of them have a request in flight.
+
+		Parameters
+		----------
+		query : String
+				A valid SQL query
+
+		Returns
+		-------
+		result : list
+				A QEP in JSON format, including costs
+
+		"""
+		if len(self.lstConnections) == 0:
+			return None
+		conn = await self.queueIdleConnections.get()
+		try:
+			if self.eventCancelled.is_set():
+				return None
+			# Requests of the event loop overlap each other on the same thread
+			with instrumentation.span("getQEP", bAsync=True):
+				cur = conn.cursor()
+				cur.execute(EXPLAIN_STATEMENT + query)
+				await _waitAsync(conn)
+				return cur.fetchall()
+		except psycopg2.extensions.QueryCanceledError:
+			print("EXPLAIN was cancelled or exceeded statement_timeout")
+		except (Exception, psycopg2.DatabaseError) as error:
+			print(error)
+		finally:
+			self.queueIdleConnections.put_nowait(conn)
+
+	async def getQEPsAsync(self, lstQueries):
+		"""
+		Get the QEPs for several queries, keeping one request in flight on every connection
+
+		Parameters
+		----------
+		lstQueries : list
+				Valid SQL queries
+
+		Returns
+		-------
+		result : list
+				The result of getQEP() for each query, in the same order as lstQueries
+
+		"""
+		# gather() returns the results in the order of the awaitables
+		return list(await asyncio.gather(*[self.getQEPAsync(query) for query in lstQueries]))
+
+	async def explainBatchAsync(self, template, lstPoints, lstKnownFingerprints):
+		"""
+		Explain a query template at several points. The points are split into one batch per
+		connection, each sent in one round trip. See Postgres_Connect.explainBatch().
+
+		"""
+		if len(self.lstConnections) == 0:
+			return [None for _ in lstPoints]
+		lstResults = []
+		for lstBatchResults in await asyncio.gather(
+				*[self._explainBatchAsync(template, lstBatch, lstKnownFingerprints)
+				  for lstBatch in _splitBatches(lstPoints, len(self.lstConnections))]):
+			lstResults.extend(lstBatchResults)
+		return lstResults
+
+	async def _explainBatchAsync(self, template, lstPoints, lstKnownFingerprints):
+		lstResults = [None for _ in lstPoints]
+		conn = await self.queueIdleConnections.get()
+		try:
+			if self.eventCancelled.is_set():
+				return lstResults
+			with instrumentation.span("explainBatch", bAsync=True, points=len(lstPoints)):
+				cur = conn.cursor()
+				cur.execute(BATCH_EXPLAIN_QUERY, (template, lstPoints, lstKnownFingerprints))
+				await _waitAsync(conn)
+				lstRows = cur.fetchall()
+			for pointIndex, fingerprint, totalCost, rows, qep in lstRows:
+				lstResults[pointIndex - 1] = (fingerprint, totalCost, rows, qep)
+		except psycopg2.extensions.QueryCanceledError:
+			print("EXPLAIN batch was cancelled or exceeded statement_timeout")
+		except (Exception, psycopg2.DatabaseError) as error:
+			print(error)
+		finally:
+			self.queueIdleConnections.put_nowait(conn)
+		return lstResults
+
+	def getQEP(self, query):
+		if self.loop is None:
+			return None
+		return self.loop.run_until_complete(self.getQEPAsync(query))
+
+	def getQEPs(self, lstQueries):
+		if self.loop is None:
+			return [None for _ in lstQueries]
+		return self.loop.run_until_complete(self.getQEPsAsync(lstQueries))
+
+	async def executeStatementAsync(self, statement):
+		"""
+		Run a statement which does not return rows on every asynchronous connection
+
+		Parameters
+		----------
+		statement : String
+				A valid SQL statement
+
+		Returns
+		-------
+		result : bool
+				True if the statement was successful on all connections
+
+		"""
+		if len(self.lstConnections) == 0:
+			return False
+		# Take every connection out of the queue so that no probe runs while the statement is applied
+		lstBorrowed = [await self.queueIdleConnections.get() for _ in self.lstConnections]
+		try:
+			bResult = True
+			for conn in lstBorrowed:
+				try:
+					conn.cursor().execute(statement)
+					await _waitAsync(conn)
+				except (Exception, psycopg2.DatabaseError) as error:
+					print(error)
+					bResult = False
+			return bResult
+		finally:
+			for conn in lstBorrowed:
+				self.queueIdleConnections.put_nowait(conn)
+
+	def explainBatch(self, template, lstPoints, lstKnownFingerprints):
+		if self.loop is None:
+			return [None for _ in lstPoints]
+		return self.loop.run_until_complete(self.explainBatchAsync(template, lstPoints, lstKnownFingerprints))
+
+	def executeStatement(self, statement):
+		if self.loop is None:
+			return False
+		return self.loop.run_until_complete(self.executeStatementAsync(statement))
+
+	def cancel(self):
+		"""
+		Cancel the EXPLAIN requests of the current sweep. Requests in flight are cancelled by the
+		server, and neither the queued ones nor those of later batches are sent until
+		resetCancel() is called, so their result is None. Can be called from another thread.
+
+		"""
+		self.eventCancelled.set()
+		for conn in self.lstConnections:
+			try:
+				conn.cancel()
+			except (Exception, psycopg2.DatabaseError) as error:
+				print(error)
+
+	def resetCancel(self):
+		"""
+		Accept EXPLAIN requests again after cancel(). Called once when a sweep starts rather than
+		by every batch, so that a cancel between two batches is not lost.
+
+		"""
+		self.eventCancelled.clear()
+
+	def ping(self):
+		"""
+		Check that the catalog session and every asynchronous connection are still usable
+
+		"""
+		if not self.catalogSession.ping():
+			return False
+		return self.executeStatement("SELECT 1")
+
+	def getHistogram(self, tableName, attrName):
+		return self.catalogSession.getHistogram(tableName, attrName)
+
+	def getCardinality(self, tableName):
+		return self.catalogSession.getCardinality(tableName)
+
+	def findRelation(self, attrName):
+		return self.catalogSession.findRelation(attrName)
+
+	def getStatisticsVersion(self, lstRelations):
+		return self.catalogSession.getStatisticsVersion(lstRelations)
+
+	def getServerIdentity(self):
+		return self.catalogSession.getServerIdentity()
+
+	def getPlannerSettings(self):
+		return self.catalogSession.getPlannerSettings()
+
+	def getAttributeStatistics(self, lstAttributes):
+		return self.catalogSession.getAttributeStatistics(lstAttributes)
+
+	def processQuery(self, query):
+		return self.catalogSession.processQuery(query)
+
+
+async def _waitAsync(conn):
+	"""
+	Wait until an asynchronous psycopg2 connection has finished its current operation, without
+	blocking the event loop
+
+	Parameters
+	----------
+	conn : psycopg2.Connection object
+			A connection created with async_=1
+
+	"""
+	loop = asyncio.get_event_loop()
+	while True:
+		state = conn.poll()
+		if state == psycopg2.extensions.POLL_OK:
+			return
+		future = loop.create_future()
+
+		def _onReady():
+			if not future.done():
+				future.set_result(None)
+
+		if state == psycopg2.extensions.POLL_READ:
+			loop.add_reader(conn.fileno(), _onReady)
+			try:
+				await future
+			finally:
+				loop.remove_reader(conn.fileno())
+		elif state == psycopg2.extensions.POLL_WRITE:
+			loop.add_writer(conn.fileno(), _onReady)
+			try:
+				await future
+			finally:
+				loop.remove_writer(conn.fileno())
+		else:
+			raise psycopg2.OperationalError(
+				"poll() returned unexpected state {}".format(state))
+
+
+def _splitBatches(lstPoints, nBatches):
+	"""
+	Split the points into at most nBatches consecutive batches of nearly the same size
+
+	"""
+	nBatches = min(nBatches, len(lstPoints))
+	if nBatches == 0:
+		return []
+	lstBounds = [len(lstPoints) * index // nBatches for index in range(nBatches + 1)]
+	return [lstPoints[lstBounds[index]:lstBounds[index + 1]] for index in range(nBatches)]
+
+
+def createCommunicator(host, database, port, username, password, driver=None):
+	"""
+	Connect to the PostgreSQL server with the communicator selected by EXPLAIN_DRIVER
+
+	Parameters
+	----------
+	host : string
+	database : string
+	port : string
+	username : string
+	password : string
+			Required information by PostgreSQL to connect to database
+
+	driver : string
+			Either "pool" or "asyncio". EXPLAIN_DRIVER is used if not provided
+
+	Returns
+	-------
+	Communicator : Postgres_ConnectPool or Postgres_AsyncConnect object
+			A connected communicator
+
+	"""
+	if driver is None:
+		driver = EXPLAIN_DRIVER
+	if driver == "asyncio":
+		Communicator = Postgres_AsyncConnect()
+		Communicator.connect(host, database, port, username, password, ASYNC_POOL_SIZE)
+	else:
+		Communicator = Postgres_ConnectPool()
+		Communicator.connect(host, database, port, username, password, POOL_SIZE)
+	return Communicator
+
+
+class SessionManager():
+	"""
+	This is the class that keeps communicators connected between analyses, so that a new
+	connection (and authentication handshake) is only needed the first time a server is used or
+	after the connection was lost
+
+	Attributes
+	----------
+	dictCommunicators : dict
+		Key: Tuple of the connection settings and driver
+		Value: The connected communicator for these settings
+
+	Methods
+	-------
+	getCommunicator(host, database, port, username, password, driver)
+		Get a connected communicator, reusing the previous one if it is still usable
+
+	closeAll()
+		Disconnect all communicators
+
+	"""
+
+	def __init__(self):
+		self.dictCommunicators = {}
+
+	def getCommunicator(self, host, database, port, username, password, driver=None):
+		"""
+		Get a connected communicator for the connection settings. The previous communicator for
+		the same settings is checked with a ping and reused, otherwise a new one is connected.
+
+		Parameters
+		----------
+		host : string
+		database : string
+		port : string
+		username : string
+		password : string
+				Required information by PostgreSQL to connect to database
+
+		driver : string
+				Either "pool" or "asyncio". EXPLAIN_DRIVER is used if not provided
+
+		Returns
+		-------
+		Communicator : Postgres_ConnectPool or Postgres_AsyncConnect object
+				A connected communicator, or a disconnected one if the server could not be reached
+
+		"""
+		if driver is None:
+			driver = EXPLAIN_DRIVER
+		# The password is part of the key so that a session is never reused with other credentials
+		key = (host, database, str(port), username,
+			   hashlib.sha1(password.encode("utf-8")).hexdigest(), driver)
+		Communicator = self.dictCommunicators.get(key)
+		if Communicator is not None:
+			if Communicator.ping():
+				return Communicator
+			print("Connection was lost, reconnecting...")
+			Communicator.disconnect()
+			del self.dictCommunicators[key]
+
+		Communicator = createCommunicator(host, database, port, username, password, driver)
+		if Communicator.conn is not None:
+			self.dictCommunicators[key] = Communicator
+		return Communicator
+
+	def closeAll(self):
+		"""
+		Disconnect all communicators
+
+		"""
+		for Communicator in self.dictCommunicators.values():
+			Communicator.disconnect()
+		self.dictCommunicators = {}
+
+
 def main():
 	# Initialise server details
 	host = "localhost"
@@ -1,39 +1,355 @@
-import sqlparse
-
-
-def get_token_type(token):
-    return type(token).__name__.lower()
-
-
-def get_tokens(node, columns_to_get=[], clauses_to_change=[]):
-    clauses_to_search = ['where', 'on', 'group by', 'order by']
-    comparisons_to_find = ['<', '<=', '>',  '>=', '!=']
-    current_token_type = get_token_type(node)
-    if current_token_type in clauses_to_search:
-        comparisons = list(filter(lambda token: get_token_type(
-            token) == 'comparison', node.tokens))
-        for comparison in comparisons:
-            tokens_in_comparison = comparison.tokens
-            values_of_tokens = list(
-                map(lambda token: token.value, tokens_in_comparison))
-            if set(values_of_tokens).intersection(set(comparisons_to_find)):
-                string_to_keep = ''
-                for token_in_comparison in tokens_in_comparison:
-                    string_to_keep += token_in_comparison.value
-                    if get_token_type(token_in_comparison) == 'identifier':
-                        columns_to_get.append(token_in_comparison.value)
-                clauses_to_change.append(string_to_keep)
-
-    for sub_token in node.tokens:
-        if get_token_type(sub_token).lower() in clauses_to_search:
-            get_tokens(sub_token, columns_to_get, clauses_to_change)
-
-
-def get_var_column(query):
-    parsed_query = sqlparse.parse(query)[0]  # this is the 'root' token
-    columns_to_get = []
-    clauses_to_change = []
-    get_tokens(parsed_query, columns_to_get, clauses_to_change)
-    print(columns_to_get)
-    print(clauses_to_change)
-    return columns_to_get, clauses_to_change
+import datetime
+import functools
+import re
+
+from sqlparse import lexer
+from sqlparse import tokens as T
+
+# Number of compiled templates kept by compile_query_template()
+TEMPLATE_CACHE_SIZE = 128
+
+# Clauses whose comparisons are predicates, and clauses that end them
+PREDICATE_CLAUSES = {'where', 'on', 'having'}
+OTHER_CLAUSES = {'select', 'from', 'group by', 'order by', 'limit', 'offset', 'union',
+                 'union all', 'intersect', 'except', 'returning', 'window'}
+# Comparisons that can be varied, and the comparison to use when the literal is on the left
+FLIPPED_OPERATORS = {'<': '>', '<=': '>=', '>': '<', '>=': '<=', '!=': '!=', '<>': '<>', '=': '='}
+DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+class PredicateSlot(object):
+    """
+    A predicate of the query that compares a column with literal values, i.e.
+    "column <op> literal", "literal <op> column" or "column BETWEEN literal AND literal"
+
+    Attributes
+    ----------
+    column : String
+        The column as written in the query, e.g. l1.l_quantity
+
+    attribute : String
+        The column without the relation name, e.g. l_quantity
+
+    operator : String
+        The comparison with the column on the left, or "between"
+
+    kind : String
+        "numeric", "date" or "string"
+
+    values : tuple
+        The literal values. Floats for numeric predicates, ISO strings for dates, and unquoted
+        strings otherwise.
+
+    start, end : int
+        Position of the predicate in the normalized query text
+
+    text : String
+        The predicate as written in the query
+
+    """
+
+    def __init__(self, column, operator, kind, values, start, end, text):
+        self.column = column
+        self.attribute = column.split(".")[-1]
+        self.operator = operator
+        self.kind = kind
+        self.values = tuple(values)
+        self.start = start
+        self.end = end
+        self.text = text
+
+    def __repr__(self):
+        return "PredicateSlot({!r})".format(self.text)
+
+
+class QueryTemplate(object):
+    """
+    A query with the position of each of its predicates, built once by compile_query_template()
+    and shared by every caller that compiles the same query
+
+    Attributes
+    ----------
+    query : String
+        The normalized query text
+
+    slots : tuple
+        PredicateSlot of every predicate, in the order they appear in the query
+
+    Methods
+    -------
+    build_probe_template(slots, token)
+        Compile a template in which some predicates are replaced by parameter slots
+
+    """
+
+    def __init__(self, query, slots):
+        self.query = query
+        self.slots = tuple(slots)
+
+    def build_probe_template(self, slots, token):
+        # The query is split once here, so that binding a point does not search the query text
+        segments = []
+        kinds = []
+        comparisons = []
+        lower_bounds = []
+        position = 0
+        for slot in sorted(slots, key=lambda slot: slot.start):
+            segment = self.query[position:slot.start] + slot.column
+            if slot.operator == 'between':
+                # Only the upper bound is varied, the lower bound of the query is kept
+                segment += " BETWEEN {} AND".format(ProbeTemplate.format_value(slot.kind, slot.values[0]))
+                comparisons.append(" ")
+                lower_bounds.append(slot.values[0])
+            else:
+                comparisons.append(" <= ")
+                lower_bounds.append(None)
+            segments.append(segment)
+            kinds.append(slot.kind)
+            position = slot.end
+        segments.append(self.query[position:])
+        return ProbeTemplate(segments, kinds, token, comparisons, lower_bounds)
+
+
+class ProbeTemplate(object):
+    """
+    A Picasso query template, pre-split into literal segments around its parameter slots. Every
+    slot is the predicate "<column> <= <value>", or "<column> BETWEEN <low> AND <value>" for a
+    BETWEEN predicate of the query, where the value is varied by the sweep.
+
+    Attributes
+    ----------
+    segments : tuple
+        The query text between the slots. Every segment except the last ends with the column of
+        the next slot, followed by "BETWEEN <low> AND" for a BETWEEN slot.
+
+    comparisons : tuple
+        The text between the segment and the value of every slot, " <= " or " " after BETWEEN
+
+    lower_bounds : tuple
+        The lower bound of every BETWEEN slot, as written in the query, and None for the other
+        slots. Values below it would make the range empty, so the sweep does not go below it.
+
+    kinds : tuple
+        "numeric", "date" or "string" for every slot. Date values are given as day numbers
+        (date.toordinal()) so that they can be interpolated like numbers.
+
+    text : String
+        The template with every slot written as "<column><token>", used to identify the template
+
+    Methods
+    -------
+    bind(point)
+        Build the query for one grid point
+
+    parameterize()
+        Build the query with $1, $2, ... in place of the values, and the type of every parameter
+
+    format_template()
+        Build the query with %s in place of the values, for the format() function of PostgreSQL
+
+    format_value(kind, value)
+        Format one value as an SQL literal of the given kind
+
+    """
+
+    SQL_TYPES = {'numeric': 'numeric', 'date': 'date', 'string': 'text'}
+
+    def __init__(self, segments, kinds, token, comparisons=None, lower_bounds=None):
+        self.segments = tuple(segments)
+        self.kinds = tuple(kinds)
+        if comparisons is None:
+            comparisons = [" <= "] * len(self.kinds)
+        self.comparisons = tuple(comparisons)
+        if lower_bounds is None:
+            lower_bounds = [None] * len(self.kinds)
+        self.lower_bounds = tuple(lower_bounds)
+        self.text = token.join(self.segments)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def bind(self, point):
+        parts = [self.segments[0]]
+        for kind, comparison, value, segment in zip(self.kinds, self.comparisons, point, self.segments[1:]):
+            parts.append(comparison)
+            parts.append(self.format_value(kind, value))
+            parts.append(segment)
+        return "".join(parts)
+
+    def parameterize(self):
+        parts = [self.segments[0]]
+        for index, (comparison, segment) in enumerate(zip(self.comparisons, self.segments[1:])):
+            parts.append("{}${}".format(comparison, index + 1))
+            parts.append(segment)
+        return "".join(parts), [self.SQL_TYPES[kind] for kind in self.kinds]
+
+    def format_template(self):
+        # A literal % of the query would be read as a format specifier
+        parts = [self.segments[0].replace("%", "%%")]
+        for comparison, segment in zip(self.comparisons, self.segments[1:]):
+            parts.append(comparison + "%s")
+            parts.append(segment.replace("%", "%%"))
+        return "".join(parts)
+
+    @staticmethod
+    def format_value(kind, value):
+        if kind == 'numeric':
+            return str(value)
+        if kind == 'date':
+            if not isinstance(value, str):
+                value = datetime.date.fromordinal(int(round(value))).isoformat()
+            return "DATE '{}'".format(value)
+        return "'{}'".format(str(value).replace("'", "''"))
+
+
+def normalize_query(query):
+    # Collapse whitespace and comments outside of quoted strings and identifiers, and drop the
+    # trailing semicolon
+    query = re.sub(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")|(?:\s|--[^\n]*|/\*.*?\*/)+""",
+                   lambda match: match.group(1) or " ", query, flags=re.S)
+    return query.strip().rstrip(";").strip()
+
+
+def compile_query_template(query):
+    """
+    Find all predicates of a query in a single pass over its tokens. The result is memoized by the
+    normalized query text, so compiling the same query again costs a dictionary lookup.
+
+    """
+    return _compile_normalized_query(normalize_query(query))
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile_normalized_query(query):
+    tokens = []
+    position = 0
+    # Only lex the query, the grouping done by sqlparse.parse() is not needed
+    for ttype, value in lexer.tokenize(query):
+        if ttype not in T.Whitespace and ttype not in T.Newline and ttype not in T.Comment:
+            tokens.append((ttype, value, position, position + len(value)))
+        position += len(value)
+
+    slots = []
+    in_predicates = False
+    # The clause state of the enclosing parenthesis depths, so that a subquery does not end the
+    # WHERE clause around it
+    outer_states = []
+    index = 0
+    while index < len(tokens):
+        ttype, value, _, _ = tokens[index]
+        lowered = value.lower()
+        if ttype in T.Punctuation and value == '(':
+            outer_states.append(in_predicates)
+        elif ttype in T.Punctuation and value == ')' and outer_states:
+            in_predicates = outer_states.pop()
+        elif ttype in T.Keyword:
+            if lowered in PREDICATE_CLAUSES:
+                in_predicates = True
+            elif lowered in OTHER_CLAUSES or 'join' in lowered or ttype in T.Keyword.DML:
+                in_predicates = False
+        if in_predicates and not _continues_expression(tokens, index - 1):
+            slot, next_index = _match_predicate(query, tokens, index)
+            if slot is not None:
+                slots.append(slot)
+                index = next_index
+                continue
+        index += 1
+    return QueryTemplate(query, slots)
+
+
+def _match_predicate(query, tokens, index):
+    column, after_column = _match_column(tokens, index)
+    if column is not None:
+        if after_column < len(tokens):
+            ttype, value, _, _ = tokens[after_column]
+            if ttype in T.Operator.Comparison and value in FLIPPED_OPERATORS:
+                kind, literal, after_literal = _match_literal(tokens, after_column + 1)
+                if kind is not None and not _continues_expression(tokens, after_literal):
+                    return _make_slot(query, tokens, index, after_literal, column, value,
+                                      kind, [literal]), after_literal
+            elif ttype in T.Keyword and value.lower() == 'between':
+                kind, low, after_low = _match_literal(tokens, after_column + 1)
+                if (kind is not None and after_low < len(tokens)
+                        and tokens[after_low][1].lower() == 'and'):
+                    kind_high, high, after_high = _match_literal(tokens, after_low + 1)
+                    if kind_high == kind and not _continues_expression(tokens, after_high):
+                        return _make_slot(query, tokens, index, after_high, column, 'between',
+                                          kind, [low, high]), after_high
+        return None, index
+
+    kind, literal, after_literal = _match_literal(tokens, index)
+    if kind is not None and after_literal < len(tokens):
+        ttype, value, _, _ = tokens[after_literal]
+        if ttype in T.Operator.Comparison and value in FLIPPED_OPERATORS:
+            column, after_column = _match_column(tokens, after_literal + 1)
+            if column is not None and not _continues_expression(tokens, after_column):
+                return _make_slot(query, tokens, index, after_column, column,
+                                  FLIPPED_OPERATORS[value], kind, [literal]), after_column
+    return None, index
+
+
+def _match_column(tokens, index):
+    # A name, optionally qualified by relation names
+    parts = []
+    while index < len(tokens) and tokens[index][0] in (T.Name, T.Literal.String.Symbol):
+        parts.append(tokens[index][1])
+        index += 1
+        if index < len(tokens) and tokens[index][1] == '.':
+            index += 1
+            continue
+        # A name followed by "(" is a function call
+        if index < len(tokens) and tokens[index][1] == '(':
+            return None, index
+        return ".".join(parts), index
+    return None, index
+
+
+def _match_literal(tokens, index):
+    if index >= len(tokens):
+        return None, None, index
+    ttype, value, _, _ = tokens[index]
+    if ttype in T.Literal.Number:
+        try:
+            return 'numeric', float(value), index + 1
+        except ValueError:
+            return None, None, index
+    if ttype in T.Name.Builtin or ttype in T.Keyword:
+        # DATE '1995-01-01'
+        if (value.lower() == 'date' and index + 1 < len(tokens)
+                and tokens[index + 1][0] in T.Literal.String.Single):
+            string = _unquote(tokens[index + 1][1])
+            if DATE_PATTERN.match(string):
+                return 'date', string, index + 2
+        return None, None, index
+    if ttype in T.Literal.String.Single:
+        string = _unquote(value)
+        # '1995-01-01'::date
+        if (index + 2 < len(tokens) and tokens[index + 1][1] == '::'
+                and tokens[index + 2][1].lower() == 'date' and DATE_PATTERN.match(string)):
+            return 'date', string, index + 3
+        if index + 1 < len(tokens) and tokens[index + 1][1] == '::':
+            return None, None, index
+        if DATE_PATTERN.match(string):
+            return 'date', string, index + 1
+        return 'string', string, index + 1
+    return None, None, index
+
+
+def _continues_expression(tokens, index):
+    # True if the token at index joins its neighbour into a larger expression, e.g. "5 + 3"
+    if index < 0 or index >= len(tokens):
+        return False
+    ttype, value, _, _ = tokens[index]
+    # sqlparse lexes "*" as a wildcard, also when it is a multiplication
+    return ((ttype in T.Operator and ttype not in T.Operator.Comparison) or ttype is T.Wildcard
+            or value in ('.', '::') or (ttype in T.Keyword and value.lower() == 'not'))
+
+
+def _make_slot(query, tokens, first, after_last, column, operator, kind, values):
+    start = tokens[first][2]
+    end = tokens[after_last - 1][3]
+    return PredicateSlot(column, operator, kind, values, start, end, query[start:end])
+
+
+def _unquote(string):
+    return string[1:-1].replace("''", "'")
@@ -0,0 +1,232 @@
+"""
+instrumentation.py
+
+This script measures where the time of an analysis goes. Stages are timed with spans, e.g.
+
+	with instrumentation.span("catalog", attributes=3):
+		...
+
+and events such as QEPs served from the cache are counted with count(). The spans of all threads
+are kept in memory until they are exported as a Chrome trace (chrome://tracing or
+https://ui.perfetto.dev) with exportChromeTrace(), or summarised per stage with formatSummary().
+
+Instrumentation is disabled by default, in which case span() and count() return immediately. It
+is switched on at runtime with enable(), or for the whole process by setting the environment
+variable named by TRACE_ENV_VARIABLE to the path of the trace file to write.
+
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+# If this environment variable is set, instrumentation is enabled when the module is imported
+# and its value is the path that exportChromeTrace() writes to by default
+TRACE_ENV_VARIABLE = "QPV_TRACE"
+# Written by exportChromeTrace() if neither a path nor the environment variable is given
+DEFAULT_TRACE_FILE = "qpv_trace.json"
+
+# Spans recorded after this many are dropped, so that a long session cannot run out of memory
+MAX_EVENTS = 1000000
+
+_bEnabled = bool(os.environ.get(TRACE_ENV_VARIABLE))
+# Returned by span() when disabled. nullcontext objects can be entered any number of times.
+_NULL_SPAN = contextlib.nullcontext()
+# Timestamps of the trace are relative to this time
+_startNs = time.perf_counter_ns()
+# (name, start ns, duration ns, process id, thread id, bAsync, args) of every finished span.
+# list.append() is atomic, so spans can be recorded from any thread without a lock.
+_lstEvents = []
+# Key: Counter name, Value: [total, list of (time ns, process id, thread id, total)]
+_dictCounters = {}
+_lockCounters = threading.Lock()
+_nDroppedEvents = 0
+
+
+class _Span():
+	"""
+	Context manager that records one span when it exits
+
+	"""
+	__slots__ = ("name", "bAsync", "args", "startNs")
+
+	def __init__(self, name, bAsync, args):
+		self.name = name
+		self.bAsync = bAsync
+		self.args = args
+
+	def __enter__(self):
+		self.startNs = time.perf_counter_ns()
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		global _nDroppedEvents
+		endNs = time.perf_counter_ns()
+		if len(_lstEvents) >= MAX_EVENTS:
+			_nDroppedEvents += 1
+			return False
+		if excType is not None:
+			self.args["error"] = excType.__name__
+		_lstEvents.append((self.name, self.startNs - _startNs, endNs - self.startNs,
+						   os.getpid(), threading.get_ident(), self.bAsync, self.args))
+		return False
+
+
+def enable():
+	global _bEnabled
+	_bEnabled = True
+
+
+def disable():
+	global _bEnabled
+	_bEnabled = False
+
+
+def isEnabled():
+	return _bEnabled
+
+
+def span(name, bAsync=False, **args):
+	"""
+	Time a stage of the analysis
+
+	Parameters
+	----------
+	name : String
+			Name of the stage. All spans with the same name are added up by formatSummary().
+
+	bAsync : bool
+			True for spans that overlap other spans of the same thread without being nested in
+			them, such as requests of an asyncio event loop
+
+	args : dict
+			Values shown with the span in the trace, e.g. the number of queries of a batch
+
+	Returns
+	-------
+	span : context manager
+			Records the span when the with block exits
+
+	"""
+	if not _bEnabled:
+		return _NULL_SPAN
+	return _Span(name, bAsync, args)
+
+
+def count(name, value=1):
+	"""
+	Add value to a counter, e.g. the number of QEPs found in the cache
+
+	"""
+	if not _bEnabled:
+		return
+	with _lockCounters:
+		counter = _dictCounters.setdefault(name, [0, []])
+		counter[0] += value
+		counter[1].append((time.perf_counter_ns() - _startNs, os.getpid(), threading.get_ident(), counter[0]))
+
+
+def reset():
+	"""
+	Remove all spans and counters recorded so far
+
+	"""
+	drain()
+
+
+def drain():
+	"""
+	Remove all spans and counters recorded so far and return them, e.g. to send them from a
+	worker process to the parent process
+
+	Returns
+	-------
+	lstEvents : list
+			The recorded spans
+
+	dictCounters : dict
+			The recorded counters
+
+	"""
+	global _lstEvents, _dictCounters, _nDroppedEvents
+	with _lockCounters:
+		lstEvents, _lstEvents = _lstEvents, []
+		dictCounters, _dictCounters = _dictCounters, {}
+		_nDroppedEvents = 0
+	return lstEvents, dictCounters
+
+
+def merge(lstEvents, dictCounters):
+	"""
+	Add spans and counters returned by drain() in another process or thread
+
+	"""
+	_lstEvents.extend(lstEvents)
+	with _lockCounters:
+		for name, (total, lstSamples) in dictCounters.items():
+			counter = _dictCounters.setdefault(name, [0, []])
+			counter[0] += total
+			counter[1].extend(lstSamples)
+
+
+def exportChromeTrace(szPath=None):
+	"""
+	Write the recorded spans and counters in the Chrome trace event format
+
+	Parameters
+	----------
+	szPath : String
+			Path of the JSON file to write. The value of the TRACE_ENV_VARIABLE environment
+			variable, or else DEFAULT_TRACE_FILE, is used if not provided.
+
+	"""
+	if szPath is None:
+		szPath = os.environ.get(TRACE_ENV_VARIABLE) or DEFAULT_TRACE_FILE
+	lstTraceEvents = []
+	for asyncId, (name, startNs, durationNs, pid, tid, bAsync, args) in enumerate(list(_lstEvents)):
+		if bAsync:
+			lstTraceEvents.append({"name": name, "cat": "async", "ph": "b", "id": asyncId,
+								   "ts": startNs / 1000, "pid": pid, "tid": tid, "args": args})
+			lstTraceEvents.append({"name": name, "cat": "async", "ph": "e", "id": asyncId,
+								   "ts": (startNs + durationNs) / 1000, "pid": pid, "tid": tid})
+		else:
+			lstTraceEvents.append({"name": name, "ph": "X", "ts": startNs / 1000, "dur": durationNs / 1000,
+								   "pid": pid, "tid": tid, "args": args})
+	with _lockCounters:
+		for name, (_, lstSamples) in _dictCounters.items():
+			for timeNs, pid, tid, total in lstSamples:
+				lstTraceEvents.append({"name": name, "ph": "C", "ts": timeNs / 1000, "pid": pid,
+									   "tid": tid, "args": {name: total}})
+	with open(szPath, "w") as f:
+		json.dump({"traceEvents": lstTraceEvents, "displayTimeUnit": "ms"}, f)
+	print("Trace written to {}".format(szPath))
+
+
+def formatSummary():
+	"""
+	Summarise the recorded spans per stage and the totals of the counters
+
+	Returns
+	-------
+	szSummary : String
+			A table with the number of calls, total, mean and maximum time of every stage,
+			slowest stage first, followed by the counters
+
+	"""
+	dictStages = {}
+	for name, _, durationNs, _, _, _, _ in list(_lstEvents):
+		stage = dictStages.setdefault(name, [0, 0, 0])
+		stage[0] += 1
+		stage[1] += durationNs
+		stage[2] = max(stage[2], durationNs)
+	szSummary = "{:<28} {:>8} {:>12} {:>12} {:>12}\n".format("Stage", "Calls", "Total (ms)", "Mean (ms)", "Max (ms)")
+	for name, (nCalls, totalNs, maxNs) in sorted(dictStages.items(), key=lambda item: -item[1][1]):
+		szSummary += "{:<28} {:>8} {:>12.2f} {:>12.3f} {:>12.3f}\n".format(
+			name, nCalls, totalNs / 1e6, totalNs / nCalls / 1e6, maxNs / 1e6)
+	with _lockCounters:
+		for name, (total, _) in sorted(_dictCounters.items()):
+			szSummary += "{:<28} {:>8}\n".format(name, total)
+	if _nDroppedEvents > 0:
+		szSummary += "{} spans were dropped after the first {}\n".format(_nDroppedEvents, MAX_EVENTS)
+	return szSummary
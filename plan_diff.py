@@ -0,0 +1,241 @@
+"""
+plan_diff.py
+
+This script finds the operators that differ between two QEPs, e.g. between the actual plan and a
+plan of the selectivity map, so that the Plans page can highlight them.
+
+The trees are compared in order from the top operator down. Operators are compared by node type
+and relation only, like the plan fingerprint, so two plans without differences have the same
+fingerprint. Every subtree of both plans is numbered first, such that two subtrees get the same
+number if and only if they are identical. Identical subtrees are then skipped with a single
+comparison, and only the paths that lead to a difference are visited.
+
+"""
+
+# Number of operators listed per kind of difference by formatPlanDiff()
+DIFF_LIST_LIMIT = 10
+
+
+def diffPlans(qep1, qep2):
+	"""
+	Find the operators that were inserted, removed or changed from one QEP to another
+
+	An operator that is in both plans with a different node type or relation is changed. An
+	operator added on top of an operator of the other plan, e.g. a Sort or a Materialize, is
+	inserted or removed on its own. Other subtrees without a counterpart are inserted or removed
+	as a whole.
+
+	Parameters
+	----------
+	qep1 : plan_tree.PlanNode
+			The QEP compared against, e.g. the actual plan
+
+	qep2 : plan_tree.PlanNode
+			The QEP whose differences are reported
+
+	Returns
+	-------
+	dictDiff : dict
+			"inserted": list of the operators of qep2 that are not in qep1
+			"removed": list of the operators of qep1 that are not in qep2
+			"changed": list of (operator of qep1, operator of qep2) that differ
+			"distance": total number of operators inserted, removed or changed
+
+	"""
+	# Key: id() of a PlanNode, Value: number of its subtree
+	dictNodeIds = {}
+	dictSubtrees = {}
+	_numberSubtrees(qep1, dictSubtrees, dictNodeIds)
+	_numberSubtrees(qep2, dictSubtrees, dictNodeIds)
+
+	lstInserted = []
+	lstRemoved = []
+	lstChanged = []
+	# Pairs of operators that are in the same place of both plans, visited without recursion
+	lstStack = [(qep1, qep2)]
+	while lstStack:
+		node1, node2 = lstStack.pop()
+		if dictNodeIds[id(node1)] == dictNodeIds[id(node2)]:
+			continue
+		label1 = (node1.nodeType, node1.relation)
+		label2 = (node2.nodeType, node2.relation)
+		if label1 != label2:
+			if _isAddedOnTop(node2, node1):
+				lstInserted.append(node2)
+				lstStack.append((node1, node2.children[0]))
+				continue
+			if _isAddedOnTop(node1, node2):
+				lstRemoved.append(node1)
+				lstStack.append((node1.children[0], node2))
+				continue
+			lstChanged.append((node1, node2))
+		for index1, index2 in _alignChildren(node1.children, node2.children, dictNodeIds):
+			if index1 is None:
+				lstInserted.extend(node2.children[index2].iterNodes())
+			elif index2 is None:
+				lstRemoved.extend(node1.children[index1].iterNodes())
+			else:
+				lstStack.append((node1.children[index1], node2.children[index2]))
+	return {
+		"inserted": lstInserted,
+		"removed": lstRemoved,
+		"changed": lstChanged,
+		"distance": len(lstInserted) + len(lstRemoved) + len(lstChanged),
+	}
+
+
+def formatPlanDiff(dictDiff):
+	"""
+	Describe the differences found by diffPlans()
+
+	Parameters
+	----------
+	dictDiff : dict
+			The differences, as given by diffPlans()
+
+	Returns
+	-------
+	szDiff : String
+			The number of operators inserted, removed and changed, followed by one line per
+			operator. At most DIFF_LIST_LIMIT operators are listed per kind of difference.
+
+	"""
+	if dictDiff["distance"] == 0:
+		return "The plans have the same operators\n"
+	szDiff = "{} operators inserted, {} removed, {} changed\n".format(
+		len(dictDiff["inserted"]), len(dictDiff["removed"]), len(dictDiff["changed"]))
+	for symbol, lstDescriptions in (
+			("+", [describeOperator(node) for node in dictDiff["inserted"][:DIFF_LIST_LIMIT]]),
+			("-", [describeOperator(node) for node in dictDiff["removed"][:DIFF_LIST_LIMIT]]),
+			("~", ["{} -> {}".format(describeOperator(node1), describeOperator(node2))
+				   for node1, node2 in dictDiff["changed"][:DIFF_LIST_LIMIT]])):
+		for szDescription in lstDescriptions:
+			szDiff += "{} {}\n".format(symbol, szDescription)
+	nUnlisted = sum(max(len(dictDiff[kind]) - DIFF_LIST_LIMIT, 0) for kind in ("inserted", "removed", "changed"))
+	if nUnlisted > 0:
+		szDiff += "... and {} more\n".format(nUnlisted)
+	return szDiff
+
+
+def describeOperator(node):
+	"""
+	Name an operator in a few words, e.g. "Seq Scan on orders"
+
+	"""
+	if node.relation is not None:
+		return "{} on {}".format(node.nodeType, node.relation)
+	return node.nodeType
+
+
+def _isAddedOnTop(node, otherNode):
+	"""
+	Check whether an operator with a single input, e.g. a Sort, is added on top of the operator of
+	the other plan in the same place. This is assumed if its input is of the same type as the other
+	operator, or has the same number of inputs while the operator itself has a different number.
+
+	"""
+	if len(node.children) != 1:
+		return False
+	child = node.children[0]
+	return ((child.nodeType, child.relation) == (otherNode.nodeType, otherNode.relation)
+			or len(child.children) == len(otherNode.children) != 1)
+
+
+def _numberSubtrees(root, dictSubtrees, dictNodeIds):
+	"""
+	Number every subtree of a QEP, bottom-up. Subtrees with the same operators in the same shape
+	get the same number, also across plans numbered with the same dictSubtrees.
+
+	Parameters
+	----------
+	root : plan_tree.PlanNode
+			The top operator of the QEP
+
+	dictSubtrees : dict
+			Key: (node type, relation, numbers of the children) of a subtree
+			Value: The number of the subtree
+
+	dictNodeIds : dict
+			Key: id() of a PlanNode
+			Value: The number of its subtree. Filled in by this function.
+
+	"""
+	# In reversed pre-order, the children of an operator come before the operator itself
+	for node in reversed(list(root.iterNodes())):
+		key = (node.nodeType, node.relation, tuple(dictNodeIds[id(child)] for child in node.children))
+		dictNodeIds[id(node)] = dictSubtrees.setdefault(key, len(dictSubtrees))
+
+
+def _alignChildren(lstChildren1, lstChildren2, dictNodeIds):
+	"""
+	Pair the inputs of two operators. Identical subtrees are paired first. The other inputs are
+	paired in order, as the order of the inputs of most operators has a meaning (e.g. the outer and
+	inner side of a join). Only where one operator has more of them, e.g. an Append, operators of
+	the same type are paired first.
+
+	Returns
+	-------
+	lstPairs : list
+			(index in lstChildren1, index in lstChildren2) of every pair. One of the indexes is
+			None for an input without a counterpart.
+
+	"""
+	if len(lstChildren1) == len(lstChildren2) == 1:
+		# The most common case, e.g. Sort, Hash or Aggregate
+		return [(0, 0)]
+	lstPairs = []
+	lstGaps = _pairMatching(list(range(len(lstChildren1))), list(range(len(lstChildren2))),
+							[dictNodeIds[id(child)] for child in lstChildren1],
+							[dictNodeIds[id(child)] for child in lstChildren2], lstPairs)
+	for lstIndexes1, lstIndexes2 in lstGaps:
+		lstGaps2 = [(lstIndexes1, lstIndexes2)]
+		if len(lstIndexes1) != len(lstIndexes2):
+			lstGaps2 = _pairMatching(lstIndexes1, lstIndexes2,
+									 [(lstChildren1[i].nodeType, lstChildren1[i].relation) for i in lstIndexes1],
+									 [(lstChildren2[i].nodeType, lstChildren2[i].relation) for i in lstIndexes2],
+									 lstPairs)
+		for lstRest1, lstRest2 in lstGaps2:
+			for position in range(max(len(lstRest1), len(lstRest2))):
+				lstPairs.append((lstRest1[position] if position < len(lstRest1) else None,
+								 lstRest2[position] if position < len(lstRest2) else None))
+	return lstPairs
+
+
+def _pairMatching(lstIndexes1, lstIndexes2, lstKeys1, lstKeys2, lstPairs):
+	"""
+	Pair the indexes whose keys are equal, keeping the order of both lists (longest common
+	subsequence). The lists are the inputs of one operator, so they are short.
+
+	Returns
+	-------
+	lstGaps : list
+			(indexes of lstIndexes1, indexes of lstIndexes2) that were not paired, between two
+			consecutive pairs
+
+	"""
+	n1 = len(lstKeys1)
+	n2 = len(lstKeys2)
+	# arrLengths[i][j]: length of the longest common subsequence of lstKeys1[i:] and lstKeys2[j:]
+	arrLengths = [[0] * (n2 + 1) for _ in range(n1 + 1)]
+	for i in range(n1 - 1, -1, -1):
+		for j in range(n2 - 1, -1, -1):
+			if lstKeys1[i] == lstKeys2[j]:
+				arrLengths[i][j] = arrLengths[i + 1][j + 1] + 1
+			else:
+				arrLengths[i][j] = max(arrLengths[i + 1][j], arrLengths[i][j + 1])
+	lstGaps = []
+	i = j = 0
+	start1 = start2 = 0
+	while i < n1 and j < n2:
+		if lstKeys1[i] == lstKeys2[j]:
+			lstGaps.append((lstIndexes1[start1:i], lstIndexes2[start2:j]))
+			lstPairs.append((lstIndexes1[i], lstIndexes2[j]))
+			i += 1
+			j += 1
+			start1, start2 = i, j
+		elif arrLengths[i + 1][j] >= arrLengths[i][j + 1]:
+			i += 1
+		else:
+			j += 1
+	lstGaps.append((lstIndexes1[start1:], lstIndexes2[start2:]))
+	return [(lstGap1, lstGap2) for lstGap1, lstGap2 in lstGaps if lstGap1 or lstGap2]
@@ -0,0 +1,191 @@
+"""
+plan_tree.py
+
+This script turns the JSON returned by EXPLAIN (FORMAT JSON) into a compact tree of PlanNode
+objects, which is what the processor keeps for every plan found and what the visualiser renders.
+
+Only the fields shown or compared by the application are kept. The raw JSON of a VERBOSE plan,
+with the output columns of every node, takes several times more memory than the tree and is only
+kept when asked for with bKeepRaw.
+
+"""
+import hashlib
+import sys
+
+
+class PlanNode():
+	"""
+	One operator of a QEP
+
+	Attributes
+	----------
+	nodeType : String
+		The "Node Type" of the operator, e.g. "Hash Join"
+
+	relation : String
+		The "Relation Name" scanned by the operator, None if it does not scan a relation
+
+	startupCost : float
+	totalCost : float
+		The "Startup Cost" and "Total Cost" of the operator, including its children
+
+	rows : float
+		The "Plan Rows" the planner expects the operator to return
+
+	filter : String
+		The "Filter" of the operator, None if it has none
+
+	children : tuple
+		The PlanNode of every input of the operator, in the order given by PostgreSQL
+
+	raw : list
+		The QEP in JSON format the tree was built from. Only set on the root, and only if
+		fromQEP() was asked to keep it.
+
+	Methods
+	-------
+	toQEP()
+		Get the QEP in JSON format
+
+	iterNodes()
+		Iterate over all operators of the tree in pre-order
+
+	fingerprint()
+		Compute a canonical structural fingerprint of the tree
+
+	"""
+	# _renderKey is memoized on the root by query_plan_visualizer
+	__slots__ = ("nodeType", "relation", "startupCost", "totalCost", "rows", "filter", "children",
+				 "raw", "_fingerprint", "_renderKey")
+
+	def __init__(self, nodeType, relation=None, startupCost=None, totalCost=None, rows=None,
+				 filter=None, children=()):
+		self.nodeType = nodeType
+		self.relation = relation
+		self.startupCost = startupCost
+		self.totalCost = totalCost
+		self.rows = rows
+		self.filter = filter
+		self.children = children
+		self.raw = None
+		self._fingerprint = None
+		self._renderKey = None
+
+	def __repr__(self):
+		return "PlanNode({!r}, relation={!r}, totalCost={!r}, children={})".format(
+			self.nodeType, self.relation, self.totalCost, len(self.children))
+
+	def toQEP(self):
+		"""
+		Get the QEP in JSON format, e.g. to write it to a file
+
+		Returns
+		-------
+		qep : list
+			The raw QEP if it was kept, or else a QEP with the fields of the tree only
+
+		"""
+		if self.raw is not None:
+			return self.raw
+		dictRootPlan = {}
+		lstStack = [(self, dictRootPlan)]
+		while lstStack:
+			node, dictPlan = lstStack.pop()
+			dictPlan["Node Type"] = node.nodeType
+			if node.relation is not None:
+				dictPlan["Relation Name"] = node.relation
+			if node.startupCost is not None:
+				dictPlan["Startup Cost"] = node.startupCost
+			if node.totalCost is not None:
+				dictPlan["Total Cost"] = node.totalCost
+			if node.rows is not None:
+				dictPlan["Plan Rows"] = node.rows
+			if node.filter is not None:
+				dictPlan["Filter"] = node.filter
+			if node.children:
+				dictPlan["Plans"] = [{} for _ in node.children]
+				lstStack.extend(zip(node.children, dictPlan["Plans"]))
+		return [{"Plan": dictRootPlan}]
+
+	def iterNodes(self):
+		"""
+		Iterate over all operators of the tree in pre-order, without recursion
+
+		"""
+		lstStack = [self]
+		while lstStack:
+			node = lstStack.pop()
+			yield node
+			lstStack.extend(reversed(node.children))
+
+	def fingerprint(self):
+		"""
+		Compute a canonical structural fingerprint of the tree. Only the node types, the relations
+		scanned and the shape of the tree are taken into account, so costs, row estimates and
+		filters do not make two plans different. Computed once per tree.
+
+		Returns
+		-------
+		fingerprint : string
+			Hex digest that is equal for two structurally identical trees
+
+		"""
+		if self._fingerprint is None:
+			lstTokens = []
+			# None marks the end of a node's children
+			lstStack = [self]
+			while lstStack:
+				node = lstStack.pop()
+				if node is None:
+					lstTokens.append(")")
+					continue
+				lstTokens.append("({}|{}".format(node.nodeType, node.relation or ''))
+				lstStack.append(None)
+				lstStack.extend(reversed(node.children))
+			self._fingerprint = hashlib.sha1("".join(lstTokens).encode("utf-8")).hexdigest()
+		return self._fingerprint
+
+
+def fromQEP(qep, bKeepRaw=False):
+	"""
+	Build the PlanNode tree of a QEP, without recursion so that deep plans are supported
+
+	Parameters
+	----------
+	qep : list
+		A QEP in JSON format retrieved from PostgreSQL
+
+	bKeepRaw : bool
+		Keep the QEP on the root of the tree, to be returned by toQEP()
+
+	Returns
+	-------
+	root : PlanNode
+		The top operator of the plan
+
+	"""
+	dictRootPlan = qep[0].get('Plan')
+	root = _makeNode(dictRootPlan)
+	# The children of a node are built when the node is visited
+	lstStack = [(root, dictRootPlan)]
+	while lstStack:
+		node, plan = lstStack.pop()
+		lstPlans = plan.get('Plans')
+		if lstPlans:
+			node.children = tuple(map(_makeNode, lstPlans))
+			lstStack.extend(zip(node.children, lstPlans))
+	if bKeepRaw:
+		root.raw = qep
+	return root
+
+
+def _makeNode(plan):
+	"""
+	Build the PlanNode of one operator, without its children
+
+	"""
+	relation = plan.get('Relation Name')
+	# Most plans share a handful of node types and relations, interning stores them once
+	return PlanNode(sys.intern(plan['Node Type']), sys.intern(relation) if relation is not None else None,
+					plan.get('Startup Cost'), plan.get('Total Cost'), plan.get('Plan Rows'),
+					plan.get('Filter'))
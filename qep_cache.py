@@ -0,0 +1,248 @@
+"""
+qep_cache.py
+
+This script keeps the QEPs retrieved during selectivity sweeps in an SQLite database in the
+user's cache directory, so that explaining the same query again does not need to query the
+database server for every grid point.
+
+Every entry is tagged with the statistics version of the relations used by the query. The
+statistics version changes whenever one of the relations is analysed, so entries expire as
+soon as the planner could choose a different plan. The planner settings of the server are part of
+the key of a query, so QEPs retrieved with other settings are not served either.
+
+"""
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+
+CACHE_FILE_NAME = "qep_cache.sqlite"
+CACHE_DIR_NAME = "query-plans-visualiser"
+# Points looked up per SELECT, below the limit of SQLite on the number of parameters
+LOOKUP_CHUNK_SIZE = 500
+
+
+class QEPCache():
+	"""
+	This is the class that stores and retrieves cached QEPs
+
+	Attributes
+	----------
+	szPath : String
+		Path to the SQLite database file. A new connection is opened and closed for every
+		operation, so the cache can be used from several threads and processes at the same time.
+
+	Methods
+	-------
+	getRelations(templateKey)
+		Get the relations used by a cached Picasso query template
+
+	expire(templateKey, statsVersion)
+		Remove the QEPs of a Picasso query template retrieved with other statistics
+
+	lookup(templateKey, statsVersion, lstPoints)
+		Get the cached QEPs of a Picasso query template for the given grid points
+
+	store(templateKey, statsVersion, lstRelations, dictQEPs)
+		Add QEPs of a Picasso query template to the cache
+
+	clear()
+		Remove all entries from the cache
+
+	"""
+
+	def __init__(self, szPath=None):
+		if szPath is None:
+			szPath = os.path.join(_defaultCacheDir(), CACHE_FILE_NAME)
+		self.szPath = szPath
+		szDir = os.path.dirname(szPath)
+		if szDir:
+			os.makedirs(szDir, exist_ok=True)
+		with self._connect() as conn:
+			conn.execute("""CREATE TABLE IF NOT EXISTS templates (
+				template_key TEXT PRIMARY KEY,
+				relations TEXT NOT NULL)""")
+			conn.execute("""CREATE TABLE IF NOT EXISTS qeps (
+				template_key TEXT NOT NULL,
+				point TEXT NOT NULL,
+				stats_version TEXT NOT NULL,
+				qep TEXT NOT NULL,
+				PRIMARY KEY (template_key, point))""")
+
+	@contextlib.contextmanager
+	def _connect(self):
+		# The context manager of sqlite3.Connection only commits or rolls back, the connection is
+		# closed here so that no handle is left open until it is garbage collected
+		conn = sqlite3.connect(self.szPath, timeout=30)
+		try:
+			with conn:
+				yield conn
+		finally:
+			conn.close()
+
+	def getRelations(self, templateKey):
+		"""
+		Get the relations used by a cached Picasso query template
+
+		Parameters
+		----------
+		templateKey : String
+				Key of the template, as given by makeTemplateKey()
+
+		Returns
+		-------
+		lstRelations : list
+				Names of the relations, or None if the template has not been cached
+
+		"""
+		with self._connect() as conn:
+			row = conn.execute(
+				"SELECT relations FROM templates WHERE template_key = ?", (templateKey,)).fetchone()
+		if row is None:
+			return None
+		return json.loads(row[0])
+
+	def expire(self, templateKey, statsVersion):
+		"""
+		Remove the QEPs of a Picasso query template retrieved with other statistics than the
+		current ones. Only needs to be called once per sweep.
+
+		Parameters
+		----------
+		templateKey : String
+				Key of the template, as given by makeTemplateKey()
+
+		statsVersion : String
+				Current statistics version of the relations used by the template
+
+		"""
+		with self._connect() as conn:
+			conn.execute("DELETE FROM qeps WHERE template_key = ? AND stats_version != ?",
+						 (templateKey, statsVersion))
+
+	def lookup(self, templateKey, statsVersion, lstPoints):
+		"""
+		Get the cached QEPs of a Picasso query template for the given grid points. Only entries
+		with the given statistics version are returned.
+
+		Parameters
+		----------
+		templateKey : String
+				Key of the template, as given by makeTemplateKey()
+
+		statsVersion : String
+				Current statistics version of the relations used by the template
+
+		lstPoints : list
+				Tuples of predicate values
+
+		Returns
+		-------
+		dictQEPs : dict
+				Key: A point from lstPoints that was found in the cache
+				Value: The cached QEP of that point
+
+		"""
+		dictPoints = dict((_makePointKey(point), point) for point in lstPoints)
+		lstPointKeys = list(dictPoints)
+		dictQEPs = {}
+		with self._connect() as conn:
+			for i in range(0, len(lstPointKeys), LOOKUP_CHUNK_SIZE):
+				lstChunk = lstPointKeys[i:i + LOOKUP_CHUNK_SIZE]
+				# Only the requested rows are read, through the primary key
+				query = ("SELECT point, qep FROM qeps WHERE template_key = ? AND stats_version = ? "
+						 "AND point IN ({})".format(", ".join("?" * len(lstChunk))))
+				for szPoint, szQEP in conn.execute(query, [templateKey, statsVersion] + lstChunk):
+					dictQEPs[dictPoints[szPoint]] = json.loads(szQEP)
+		return dictQEPs
+
+	def store(self, templateKey, statsVersion, lstRelations, dictQEPs):
+		"""
+		Add QEPs of a Picasso query template to the cache
+
+		Parameters
+		----------
+		templateKey : String
+				Key of the template, as given by makeTemplateKey()
+
+		statsVersion : String
+				Statistics version of the relations at the time the QEPs were retrieved
+
+		lstRelations : list
+				Names of the relations used by the template
+
+		dictQEPs : dict
+				Key: Tuple of predicate values
+				Value: The QEP retrieved for that point
+
+		"""
+		with self._connect() as conn:
+			conn.execute("INSERT OR REPLACE INTO templates (template_key, relations) VALUES (?, ?)",
+						 (templateKey, json.dumps(sorted(lstRelations))))
+			conn.executemany(
+				"INSERT OR REPLACE INTO qeps (template_key, point, stats_version, qep) VALUES (?, ?, ?, ?)",
+				[(templateKey, _makePointKey(point), statsVersion, json.dumps(qep))
+				 for point, qep in dictQEPs.items()])
+
+	def clear(self):
+		"""
+		Remove all entries from the cache
+
+		"""
+		with self._connect() as conn:
+			conn.execute("DELETE FROM qeps")
+			conn.execute("DELETE FROM templates")
+
+
+def makeTemplateKey(templateQuery, explainOptions, serverIdentity, plannerSettings):
+	"""
+	Build the cache key of a Picasso query template. Whitespace and a trailing semicolon are
+	ignored so that reformatting the query does not miss the cache.
+
+	Parameters
+	----------
+	templateQuery : String
+			A valid Picasso template query
+
+	explainOptions : String
+			The EXPLAIN statement used to retrieve the QEPs
+
+	serverIdentity : String
+			The server and database the QEPs are retrieved from, as given by
+			getServerIdentity() of the communicator. Relations of the same name in another
+			database have other statistics and plans.
+
+	plannerSettings : String
+			Version of the planner settings of the server, as given by getPlannerSettings() of
+			the communicator. After a change of e.g. random_page_cost or work_mem, the planner may
+			choose other plans although the statistics have not changed.
+
+	Returns
+	-------
+	templateKey : String
+			Hex digest identifying the template, EXPLAIN options, server and planner settings
+
+	"""
+	szNormalized = " ".join(templateQuery.split()).rstrip(";").strip()
+	return hashlib.sha1("\n".join([serverIdentity, plannerSettings, explainOptions, szNormalized]).encode("utf-8")).hexdigest()
+
+
+def _makePointKey(point):
+	return json.dumps(list(point), default=str)
+
+
+def _defaultCacheDir():
+	"""
+	Get the directory for cached files of this application, following the conventions of the
+	operating system
+
+	"""
+	if sys.platform.startswith("win"):
+		szBase = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+	elif sys.platform == "darwin":
+		szBase = os.path.expanduser("~/Library/Caches")
+	else:
+		szBase = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+	return os.path.join(szBase, CACHE_DIR_NAME)
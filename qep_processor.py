@@ -4,11 +4,20 @@ qep_processor.py
 This script retrieves all possible QEPs from the database.
 
 """
-import re
+import datetime
+import itertools
+import random
+import threading
+import time
 
-from jsondiff import diff
+import numpy as np
 
+import db_connection_manager as db_connect
 import get_predicates_conditions
+import instrumentation
+import plan_diff
+import plan_tree
+import qep_cache
 
 # Return status for public APIs
 RET_DEFAULT_ERR = 0
@@ -22,9 +31,382 @@ RET_QEP_NOT_FOUND = 6
 # Constants
 RESOLUTION = 10
 PREDICATE_TOKEN = " :varies"
+# Comparisons that are not varied by the sweep, because they do not select a range of values
+FIXED_OPERATORS = ("=", "!=", "<>")
+
+# How grid points are sent to the database
+# - "literal": the predicate values are substituted into the query text of every probe
+# - "prepared": the template is prepared once per session and each probe runs EXECUTE
+# - "server": a temporary function explains a whole batch of points inside the server, and only
+#   sends the QEP of every distinct plan once (see db_connection_manager.BATCH_EXPLAIN_FUNCTIONS).
+#   PROBE_TIMEOUT_MS then applies to the batch of a whole session, so the points of a batch that
+#   failed are probed again one at a time with their query text, each within PROBE_TIMEOUT_MS.
+PROBE_MODE = "literal"
+PROBE_MODE_LITERAL = "literal"
+PROBE_MODE_PREPARED = "prepared"
+PROBE_MODE_SERVER = "server"
+
+# Used to give each prepared Picasso template a unique statement name
+_preparedStatementCounter = itertools.count(1)
+
+# How the selectivity space is explored. Any number of predicates (dimensions) is supported.
+# - "grid": probe every cell of a grid with RESOLUTION cells along each dimension, or fewer if
+#   that would be more than DENSE_MAX_POINTS probes. Queries with too many predicates for even
+#   two cells per dimension are swept in "sparse" mode instead.
+# - "adaptive": probe a coarse RESOLUTION grid, then recursively bisect only the cells whose
+#   corners have different plans, down to ADAPTIVE_MIN_CELL_SIZE
+# - "sparse": probe SPARSE_SAMPLE_COUNT points of a Latin hypercube sample, and label every cell
+#   of the grid with the plan of the nearest sample
+SWEEP_MODE = "grid"
+SWEEP_MODE_GRID = "grid"
+SWEEP_MODE_ADAPTIVE = "adaptive"
+SWEEP_MODE_SPARSE = "sparse"
+# Upper bound on the number of probes of the grid sweep. The number of cells along each dimension
+# is reduced from RESOLUTION as the number of dimensions grows, e.g. to 4 for 6 predicates.
+DENSE_MAX_POINTS = 10000
+# Smallest cell of the adaptive sweep, as a fraction of the selectivity range of a dimension
+ADAPTIVE_MIN_CELL_SIZE = 0.001
+# Upper bound on the number of cells of the adaptive selectivity map. With many dimensions, the
+# smallest cell is made larger than ADAPTIVE_MIN_CELL_SIZE to stay within this bound.
+ADAPTIVE_MAX_CELLS = 4000000
+# Number of probes of the sparse sweep, regardless of the number of dimensions
+SPARSE_SAMPLE_COUNT = 200
+# Upper bound on the number of cells labelled by the sparse sweep. The number of cells along
+# each dimension is reduced from RESOLUTION as the number of dimensions grows.
+SPARSE_MAX_CELLS = 1000000
+# Number of cells labelled at once by the sparse sweep, to bound the size of the distance matrix
+SPARSE_LABEL_CHUNK = 8192
+# Seed of the sparse sample, so that repeated sweeps probe the same points
+SPARSE_SEED = 0
+
+# Reuse QEPs from previous sweeps of the same template while the statistics are unchanged
+USE_QEP_CACHE = True
+_objQEPCache = None
+
+# Keep the raw JSON of every QEP retrieved, not only its plan_tree.PlanNode tree. Only needed to
+# export the full EXPLAIN output, e.g. the "Output" columns of VERBOSE plans.
+KEEP_RAW_QEPS = False
+
+# Number of QEPs requested from the database at a time. Progress is reported and cancellation is
+# checked after every batch.
+SWEEP_BATCH_SIZE = 100
+
+# Time limit for planning a single grid point, enforced by the server with statement_timeout.
+# Points that exceed it are left as unknown (0) in the selectivity map. None to disable.
+PROBE_TIMEOUT_MS = 5000
+# Time limit for the whole sweep. When it is reached, the probes in flight are cancelled and the
+# remaining points are left as unknown. None to disable.
+SWEEP_TIMEOUT_S = 600
+# Minimum time between two updates of the partial selectivity map sent to SweepMonitor.mapCallback
+MAP_UPDATE_INTERVAL_S = 0.5
+# Largest number of cells along each dimension shown by formatSelectivityMap()
+MAP_PREVIEW_CELLS = 40
+# Symbols of the plans in formatSelectivityMap(). Unknown cells are shown as "." and plans beyond
+# the last symbol as "#".
+MAP_PREVIEW_SYMBOLS = "123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+# Default cost increase threshold (lambda, in percent) of plan diagram reduction. A plan is
+# replaced by a neighbouring plan if that costs at most this much more at all of its cells.
+REDUCTION_THRESHOLD = 10.0
+
+# Largest distance between two plans of the same plan family. The distance is the number of
+# operators (node type and relation) that one plan has more or less than the other, so a plan
+# with an extra Sort is at distance 1 and a Seq Scan replaced by an Index Scan at distance 2.
+FAMILY_DISTANCE_THRESHOLD = 2
+# Largest number of array elements computed at once for the plan distance matrix
+FAMILY_DISTANCE_BLOCK_ELEMENTS = 1 << 22
+
+
+class SweepMonitor():
+	"""
+	This is the class that reports the progress of a sweep, and lets another thread cancel it.
+	The sweep runs in the thread that called processQuery(), and calls the callback from that
+	thread after every batch of QEPs.
+
+	Attributes
+	----------
+	callback : function
+		Called with the dict returned by getProgress() whenever the progress changes
+
+	planCallback : function
+		Called with the plan number and QEP of every new plan, as soon as it is found
+
+	mapCallback : function
+		Called with the partial selectivity map while the sweep runs, at most once every
+		MAP_UPDATE_INTERVAL_S, and with the final map at the end. The map must not be modified.
+
+	nPointsTotal : int
+		Number of grid points the sweep has asked for so far. In adaptive mode, this grows with
+		every refinement level.
+
+	nPointsDone : int
+		Number of grid points whose QEP has been retrieved, from the cache or the database
 
+	nPointsExplained : int
+		Number of grid points whose QEP was retrieved from the database, used for the EXPLAIN rate
+
+	nPlansFound : int
+		Number of distinct plans found so far
+
+	nPointsUnknown : int
+		Number of grid points whose EXPLAIN timed out or failed
+
+	nPointsCached : int
+		Number of grid points whose QEP was found in the on-disk cache
+
+	cancelHandler : function
+		Called by cancel() to interrupt the EXPLAIN requests in flight, usually the cancel()
+		method of the communicator
+
+	bTimedOut : bool
+		True if the sweep was cancelled because it reached its time limit
+
+	Methods
+	-------
+	cancel()
+		Ask the sweep to stop, interrupting the EXPLAIN requests in flight
+
+	startDeadline(seconds)
+		Cancel the sweep automatically after some time
+
+	stopDeadline()
+		Stop the timer started by startDeadline()
+
+	plansFound(lstAllQEPs)
+		Report the plans found so far, calling planCallback for the new ones
+
+	wantsMapUpdate()
+		Check whether mapUpdated() would call mapCallback, to avoid building partial maps for nothing
+
+	mapUpdated(selectivityMap, bFinal)
+		Report the partial or final selectivity map
+
+	isCancelled()
+		Check whether cancel() has been called
+
+	getProgress()
+		Get the progress of the sweep
 
-def processQuery(query, Communicator):
+	"""
+
+	def __init__(self, callback=None, planCallback=None, mapCallback=None):
+		self.callback = callback
+		self.planCallback = planCallback
+		self.mapCallback = mapCallback
+		self.lastMapUpdate = None
+		self.nPointsTotal = 0
+		self.nPointsDone = 0
+		self.nPointsExplained = 0
+		self.nPlansFound = 0
+		self.nPointsUnknown = 0
+		self.nPointsCached = 0
+		self.startTime = time.perf_counter()
+		self.explainTime = 0.0
+		self.eventCancelled = threading.Event()
+		self.cancelHandler = None
+		self.bTimedOut = False
+		self.timerDeadline = None
+
+	def cancel(self):
+		self.eventCancelled.set()
+		if self.cancelHandler is not None:
+			self.cancelHandler()
+
+	def isCancelled(self):
+		return self.eventCancelled.is_set()
+
+	def startDeadline(self, seconds):
+		if seconds is None:
+			return
+		self.timerDeadline = threading.Timer(seconds, self._onDeadline)
+		self.timerDeadline.daemon = True
+		self.timerDeadline.start()
+
+	def stopDeadline(self):
+		if self.timerDeadline is not None:
+			self.timerDeadline.cancel()
+			self.timerDeadline = None
+
+	def _onDeadline(self):
+		print("Sweep reached its time limit")
+		self.bTimedOut = True
+		self.cancel()
+
+	def addPoints(self, nPoints):
+		self.nPointsTotal += nPoints
+		self._report()
+
+	def plansFound(self, lstAllQEPs):
+		if self.planCallback is not None:
+			for planNumber in range(self.nPlansFound + 1, len(lstAllQEPs) + 1):
+				self.planCallback(planNumber, lstAllQEPs[planNumber - 1])
+		self.pointsDone(0, len(lstAllQEPs))
+
+	def wantsMapUpdate(self):
+		return self.mapCallback is not None and (
+			self.lastMapUpdate is None
+			or time.perf_counter() - self.lastMapUpdate >= MAP_UPDATE_INTERVAL_S)
+
+	def mapUpdated(self, selectivityMap, bFinal=False):
+		if bFinal or self.wantsMapUpdate():
+			self.lastMapUpdate = time.perf_counter()
+			if self.mapCallback is not None:
+				self.mapCallback(selectivityMap)
+
+	def pointsDone(self, nPoints, nPlansFound, nExplained=0, explainTime=0.0, nUnknown=0, nCached=0):
+		self.nPointsDone += nPoints
+		self.nPointsCached += nCached
+		self.nPointsExplained += nExplained
+		self.explainTime += explainTime
+		self.nPlansFound = nPlansFound
+		self.nPointsUnknown += nUnknown
+		self._report()
+
+	def getProgress(self):
+		"""
+		Get the progress of the sweep
+
+		Returns
+		-------
+		dictProgress : dict
+				"done" and "total" grid points, "plans" found, "unknown" points whose EXPLAIN
+				timed out or failed, "cached" points found in the QEP cache, EXPLAIN "rate" per second (None before the first batch),
+				estimated seconds remaining "eta" (None if unknown), seconds "elapsed", whether the
+				sweep was "cancelled" and whether it "timed_out"
+
+		"""
+		rate = None
+		eta = None
+		if self.explainTime > 0:
+			rate = self.nPointsExplained / self.explainTime
+			if rate > 0:
+				eta = (self.nPointsTotal - self.nPointsDone) / rate
+		return {
+			"done": self.nPointsDone,
+			"total": self.nPointsTotal,
+			"plans": self.nPlansFound,
+			"unknown": self.nPointsUnknown,
+			"cached": self.nPointsCached,
+			"rate": rate,
+			"eta": eta,
+			"elapsed": time.perf_counter() - self.startTime,
+			"cancelled": self.isCancelled(),
+			"timed_out": self.bTimedOut,
+		}
+
+	def _report(self):
+		if self.callback is not None:
+			self.callback(self.getProgress())
+
+
+class _SweepProbes():
+	"""
+	This is the class that keeps what a sweep has set up on the database sessions to send its
+	probes and in the QEP cache, so that it is set up once per sweep rather than once per batch of
+	QEPs. Nothing is set up on the sessions until the first QEP that is not in the cache is
+	retrieved.
+
+	Attributes
+	----------
+	query : get_predicates_conditions.ProbeTemplate
+		The Picasso query template of the sweep
+
+	objCommunicator : Postgres_Connect or Postgres_ConnectPool object
+		For interfacing with database
+
+	bStarted : bool
+		True once start() has been called
+
+	statementName : String
+		Name of the prepared statement of the template in "prepared" probe mode, or None to
+		substitute the predicate values into the query text
+
+	dictServerPlans : dict
+		Key: Fingerprint of a plan computed by the server
+		Value: The first QEP in JSON format received with that plan
+		Only set in "server" probe mode if the batch EXPLAIN function could be created
+
+	templateKey : String
+		Key of the template in the QEP cache, or None if it has not been built yet
+
+	bCacheExpired : bool
+		True once the cached QEPs of the template retrieved with other statistics were removed
+
+	lstRelations : list
+		Names of the relations used by the template, once known
+
+	statsVersion : String
+		Statistics version of lstRelations, retrieved once per sweep and used for every lookup
+		and store of the QEP cache. None if it has not been retrieved or could not be.
+
+	bStatsVersionRetrieved : bool
+		True once getStatisticsVersion() has asked the database for statsVersion
+
+	Methods
+	-------
+	getTemplateKey()
+		Get the key of the template in the QEP cache, which includes the server identity and
+		planner settings
+
+	getStatisticsVersion(lstRelations)
+		Get the statistics version of the relations of the template, retrieved on the first call
+
+	start()
+		Prepare the template or create the batch EXPLAIN function, depending on PROBE_MODE
+
+	finish()
+		Remove the prepared statement and reset the settings changed by start()
+
+	"""
+
+	def __init__(self, query, objCommunicator):
+		self.query = query
+		self.objCommunicator = objCommunicator
+		self.bStarted = False
+		self.statementName = None
+		self.dictServerPlans = None
+		self.templateKey = None
+		self.bCacheExpired = False
+		self.lstRelations = None
+		self.statsVersion = None
+		self.bStatsVersionRetrieved = False
+
+	def getTemplateKey(self):
+		if self.templateKey is None:
+			serverIdentity = self.objCommunicator.getServerIdentity()
+			# Read once per sweep, like the statistics version. The key is needed before the
+			# relations of the template, and so their statistics version, are known.
+			plannerSettings = self.objCommunicator.getPlannerSettings() if serverIdentity is not None else None
+			if plannerSettings is not None:
+				self.templateKey = qep_cache.makeTemplateKey(
+					self.query.text, db_connect.EXPLAIN_STATEMENT, serverIdentity, plannerSettings)
+		return self.templateKey
+
+	def getStatisticsVersion(self, lstRelations):
+		if not self.bStatsVersionRetrieved:
+			self.bStatsVersionRetrieved = True
+			self.lstRelations = lstRelations
+			self.statsVersion = self.objCommunicator.getStatisticsVersion(lstRelations)
+		return self.statsVersion
+
+	def start(self):
+		if self.bStarted:
+			return
+		self.bStarted = True
+		if PROBE_MODE == PROBE_MODE_PREPARED:
+			self.statementName = _prepareQueryTemplate(self.query, self.objCommunicator)
+		elif PROBE_MODE == PROBE_MODE_SERVER:
+			self.dictServerPlans = _installBatchExplain(self.objCommunicator)
+
+	def finish(self):
+		if self.statementName is not None:
+			self.objCommunicator.executeStatement("DEALLOCATE " + self.statementName)
+			self.objCommunicator.executeStatement("RESET plan_cache_mode")
+			self.statementName = None
+
+
+
+def processQuery(query, Communicator, objMonitor=None):
 	"""
 	The main function to retrieve multiple QEPs based on the actual query. The normal query is 
 	first converted to a Picasso query template before calculating the selectivity values and 
@@ -36,45 +418,95 @@ def processQuery(query, Communicator):
 	query : String
 			A normal SQL query from user input
 
-	objCommunicator : Postgres_Connect object
+	objCommunicator : Postgres_Connect or Postgres_ConnectPool object
 			For interfacing with database
+
+	objMonitor : SweepMonitor object
+			Receives the progress of the sweep. If the sweep is cancelled through it, the grid
+			points that were not retrieved are left as 0 in the selectivity map. Grid points that
+			exceed PROBE_TIMEOUT_MS are also left as 0.
 		
 	Returns
 	-------
 	lstAllQEPs : list
-			All possibe QEPs for that Picasso query template
+			All possibe QEPs for that Picasso query template, as plan_tree.PlanNode trees
 
 	lstPredicateAttributes : list
-			List of all predicate attributes, maximum of 2 because only 2 dimensions are supported
+			List of all predicate attributes, one dimension of the selectivity map each
+
+	selectivityMap : numpy.ndarray
+			An N-dimensional integer array with one dimension per predicate attribute, that depicts
+			all possible selectivites and the plan taken for each selectivity. In adaptive mode, the
+			array has the resolution of the smallest cell along every dimension.
 
-	selectivityMap : list
-			A list (either 1D or 2D array) that depicts all possible selectivites and all the plans
-			taken for each selectivity
+	dictSweepInfo : dict
+			The final progress of the sweep, as given by SweepMonitor.getProgress(), including the
+			number of "unknown" points that timed out and of "cached" points found in the QEP cache
+
+	costMap : numpy.ndarray
+			The cost surface: total cost estimated by the planner for the plan of every cell of
+			selectivityMap. NaN where the plan is unknown.
+
+	rowsMap : numpy.ndarray
+			Row estimate of the planner for the plan of every cell of selectivityMap. NaN where
+			the plan is unknown.
 
 	"""
 	lstPredicateAttributes = None
-	templateQuery = None
+	objTemplate = None
 	# Parse the normal query to retrieve predicate attributes
-	result = _convertToQueryTemplate(query)
+	with instrumentation.span("parse"):
+		result = _convertToQueryTemplate(query)
 	if (result[0] == RET_CONVERT_QUERY_OK):
 		lstPredicateAttributes = result[1]
-		templateQuery = result[2]
+		objTemplate = result[2]
 	elif (result[0] == RET_CONVERT_QUERY_ERR):
 		return RET_CONVERT_QUERY_ERR, None
 
-	# Generate the selectivity values from histogram based on predicate attributes
-	# NOTE: Maximum of 2 dimensions, 1 dimension is denoted by return value of lstSelValsDimension02 to be None
-	lstSelValsDimension01, lstSelValsDimension02 = _generatePredicateValues(
-		Communicator, lstPredicateAttributes)
-
-	if lstSelValsDimension02 is None:
-		selectivityMap, lstAllQEPs = _retrieveQEPs_OneDimension(
-			templateQuery, lstSelValsDimension01, Communicator)
-	else:
-		selectivityMap, lstAllQEPs = _retrieveQEPs_TwoDimensions(
-			templateQuery, lstSelValsDimension01, lstSelValsDimension02, Communicator)
-
-	return RET_ALL_QEPS, lstAllQEPs, lstPredicateAttributes, selectivityMap
+	# Generate the selectivity values from histogram based on predicate attributes, one list of
+	# values per dimension
+	with instrumentation.span("catalog", attributes=len(lstPredicateAttributes)):
+		lstSelValsPerDimension, lstHistogramBounds = _generatePredicateValues(
+			Communicator, lstPredicateAttributes, objTemplate.lower_bounds)
+
+	if objMonitor is None:
+		objMonitor = SweepMonitor()
+	# Only cleared here, so that a cancel between two batches of the sweep is not lost
+	Communicator.resetCancel()
+	objMonitor.cancelHandler = Communicator.cancel
+	if PROBE_TIMEOUT_MS is not None:
+		Communicator.executeStatement("SET statement_timeout = {}".format(int(PROBE_TIMEOUT_MS)))
+	sweepMode = SWEEP_MODE
+	if sweepMode == SWEEP_MODE_GRID and 2 ** len(lstPredicateAttributes) > DENSE_MAX_POINTS:
+		# Even two cells per dimension would be more than DENSE_MAX_POINTS probes
+		print("Too many predicates for a grid sweep, using a sparse sweep instead")
+		sweepMode = SWEEP_MODE_SPARSE
+	objMonitor.startDeadline(SWEEP_TIMEOUT_S)
+	try:
+		with instrumentation.span("sweep", mode=sweepMode):
+			if sweepMode == SWEEP_MODE_ADAPTIVE:
+				selectivityMap, lstAllQEPs, costMap, rowsMap = _retrieveQEPs_Adaptive(
+					objTemplate, lstHistogramBounds, Communicator, objMonitor)
+			elif sweepMode == SWEEP_MODE_SPARSE:
+				selectivityMap, lstAllQEPs, costMap, rowsMap = _retrieveQEPs_Sparse(
+					objTemplate, lstHistogramBounds, Communicator, objMonitor)
+			else:
+				selectivityMap, lstAllQEPs, costMap, rowsMap = _retrieveQEPs_Dense(
+					objTemplate, lstSelValsPerDimension, Communicator, objMonitor)
+	finally:
+		objMonitor.stopDeadline()
+		objMonitor.cancelHandler = None
+		if PROBE_TIMEOUT_MS is not None:
+			Communicator.executeStatement("RESET statement_timeout")
+	objMonitor.mapUpdated(selectivityMap, bFinal=True)
+
+	dictSweepInfo = objMonitor.getProgress()
+	if dictSweepInfo["cached"] > 0:
+		print("{} of {} QEPs found in cache".format(dictSweepInfo["cached"], dictSweepInfo["total"]))
+	if dictSweepInfo["unknown"] > 0:
+		print("{} of {} QEPs timed out or failed".format(
+			dictSweepInfo["unknown"], dictSweepInfo["total"]))
+	return RET_ALL_QEPS, lstAllQEPs, lstPredicateAttributes, selectivityMap, dictSweepInfo, costMap, rowsMap
 
 
 def getActualQEP(query, objCommunicator):
@@ -91,18 +523,19 @@ def getActualQEP(query, objCommunicator):
 
 	Returns
 	-------
-	actualQEP : list
+	actualQEP : plan_tree.PlanNode
 		The actual QEP from the actual query. 
 
 	"""
 
 	# Show the actual QEP from the actual query
-	actualQEP = objCommunicator.getQEP(query)[0][0]
+	with instrumentation.span("actual_qep"):
+		actualQEP = plan_tree.fromQEP(objCommunicator.getQEP(query)[0][0], KEEP_RAW_QEPS)
 	# szQEPTree = visualiser.visualize_query_plan(actualQEP)
 	return RET_ONLY_ACTUAL_QEP, actualQEP
 
 
-def compareActualQEP(actualQEP, lstAllQEPs):
+def compareActualQEP(actualQEP, lstAllQEPs, dictPlanIndex=None):
 	"""
 	Comparing all possible QEPs from Picasso query template vs the actual QEP taken by the original SQL query.
 
@@ -111,39 +544,77 @@ def compareActualQEP(actualQEP, lstAllQEPs):
 	lstAllQEPs : list
 			All possibe QEPs for that Picasso query template
 
-	actualQEP: list
+	actualQEP: plan_tree.PlanNode
 			Actual QEP taken by the original SQL query
-	
+
+	dictPlanIndex : dict
+			Optional fingerprint index of lstAllQEPs built during the sweep. It is rebuilt from
+			lstAllQEPs if not provided
+
 	Returns
 	-------
 	actualPlanIndex : int
 		The plan number from predicted QEPs that the actual QEP is similar to 
 
 	"""
-	actualPlanIndex = int()
-	for i, existingQEP in enumerate(lstAllQEPs):
-		dict_qep_difference = _compareQEPs(existingQEP, actualQEP)
-		bIsDifferentPlan = _findValueInNestedDict(
-			dict_qep_difference, "Node Type")
-		# None means a similar plan has been found
-		if bIsDifferentPlan is None:
-			actualPlanIndex = i + 1
-			return RET_QEP_FOUND, actualPlanIndex
+	with instrumentation.span("compare", plans=len(lstAllQEPs)):
+		if dictPlanIndex is None:
+			dictPlanIndex = _buildPlanIndex(lstAllQEPs)
+		actualPlanIndex = dictPlanIndex.get(actualQEP.fingerprint())
+	if actualPlanIndex is not None:
+		return RET_QEP_FOUND, actualPlanIndex
 	return RET_QEP_NOT_FOUND, None
 
 
-def generateFoundExplanation(lstPredicateAttributes, selectivityMap):
+def findClosestQEP(actualQEP, lstAllQEPs):
+	"""
+	Find the QEP that differs from the actual QEP in the fewest operators, e.g. to explain an
+	actual QEP that was not found by compareActualQEP()
+
+	Parameters
+	----------
+	actualQEP : plan_tree.PlanNode
+			Actual QEP taken by the original SQL query
+
+	lstAllQEPs : list
+			All possibe QEPs for that Picasso query template
+
+	Returns
+	-------
+	closestPlanIndex : int
+			The plan number of the closest QEP, None if lstAllQEPs is empty
+
+	dictDiff : dict
+			The operators of the closest QEP that differ from the actual QEP, as given by
+			plan_diff.diffPlans()
+
+	"""
+	closestPlanIndex = None
+	dictClosestDiff = None
+	with instrumentation.span("closest_plan", plans=len(lstAllQEPs)):
+		for index, qep in enumerate(lstAllQEPs):
+			dictDiff = _compareQEPs(actualQEP, qep)
+			if dictClosestDiff is None or dictDiff["distance"] < dictClosestDiff["distance"]:
+				closestPlanIndex, dictClosestDiff = index + 1, dictDiff
+	return closestPlanIndex, dictClosestDiff
+
+
+def generateFoundExplanation(lstPredicateAttributes, selectivityMap, dictSwallowedBy=None):
 	"""
 	Attempt to generate an explanation if actual query QEP is found within the selectivity map
 
 	Parameters
 	----------
-	selectivityMap : list
-			A list (either 1D or 2D array) that depicts all possible selectivites and all the plans
-			taken for each selectivity
+	selectivityMap : numpy.ndarray
+			An N-dimensional array that depicts all possible selectivites and the plan taken for
+			each selectivity. This may be a reduced map, as given by reducePlanDiagram()
 
 	lstPredicateAttributes : list
-			List of all predicate attributes, maximum of 2 because only 2 dimensions are supported
+			List of all predicate attributes, one dimension of the selectivity map each
+
+	dictSwallowedBy : dict
+			The plans removed by reducePlanDiagram(), which are listed with the plan that
+			replaces them. None if the map was not reduced.
 
 	Returns
 	-------
@@ -154,23 +625,240 @@ def generateFoundExplanation(lstPredicateAttributes, selectivityMap):
 	"""
 	# Get the min and max of the selectivity ranges for all plans
 	dictSelectvityRanges = _retrieveSelectivityRanges(selectivityMap)
+	dictPlanCoverage = _retrievePlanCoverage(selectivityMap)
 
 	lstSelectivityExplanations = []
 	for key, value in dictSelectvityRanges.items():
-		if len(lstPredicateAttributes) == 1:
-			# One dimension explanation, use the second set of tuples since first tuples are empty
-			string = ("For Plan {}, the selectivity range for {} ranges from {} % to {} %\n".
-					  format(key, lstPredicateAttributes[0], int(value[1][0])*10, (int(value[1][1])+1)*10))
-			lstSelectivityExplanations.append(string)
-		elif len(lstPredicateAttributes) == 2:
-			# Two dimension explanation, use both sets of tuples
-			string = ("For Plan {}, the selectivity range for {} ranges from {} % to {} %, and {} ranges from {} % to {} %\n".
-					  format(key, lstPredicateAttributes[0], int(value[0][0])*10, (int(value[0][1])+1)*10,
-							 lstPredicateAttributes[1], int(value[1][0])*10, (int(value[1][1])+1)*10))
-			lstSelectivityExplanations.append(string)
+		lstRanges = []
+		for dim, (attribute, (minIndex, maxIndex)) in enumerate(zip(lstPredicateAttributes, value)):
+			nCells = selectivityMap.shape[dim]
+			lstRanges.append("{} ranges from {} % to {} %".format(
+				attribute, _formatSelectivity(minIndex, nCells), _formatSelectivity(maxIndex + 1, nCells)))
+		string = "For Plan {} ({} % of the selectivity space), the selectivity range for {}\n".format(
+			key, "{:g}".format(round(dictPlanCoverage[key] * 100, 2)), ", and ".join(lstRanges))
+		lstReplaced = sorted(plan for plan, swallower in (dictSwallowedBy or {}).items() if swallower == key)
+		if len(lstReplaced) > 0:
+			string += "Plan {} also replaces Plan {} within the cost threshold\n".format(
+				key, ", Plan ".join(str(plan) for plan in lstReplaced))
+		lstSelectivityExplanations.append(string)
 	return lstSelectivityExplanations
 
 
+def formatSelectivityMap(selectivityMap):
+	"""
+	Draw a selectivity map as text, with one symbol per cell (see MAP_PREVIEW_SYMBOLS). Large maps
+	are sampled down to MAP_PREVIEW_CELLS cells along each dimension. The rows follow the first
+	predicate attribute and the columns the second one. Maps with more than two dimensions are
+	shown as the slice through the middle of the other dimensions.
+
+	Parameters
+	----------
+	selectivityMap : numpy.ndarray
+			An N-dimensional array that contains the plan of every cell. 0 denotes a cell without a
+			plan.
+
+	Returns
+	-------
+	szMap : String
+			The map, followed by the coverage of every plan
+
+	"""
+	arrSlice = selectivityMap
+	szMap = ""
+	if arrSlice.ndim > 2:
+		arrSlice = arrSlice[(slice(None), slice(None)) + tuple(size // 2 for size in arrSlice.shape[2:])]
+		szMap += "Slice at 50 % of the selectivity of the other predicates\n"
+	if arrSlice.ndim == 1:
+		arrSlice = arrSlice[np.newaxis, :]
+	arrSlice = arrSlice[np.ix_(*[np.arange(min(size, MAP_PREVIEW_CELLS)) * size // min(size, MAP_PREVIEW_CELLS)
+								for size in arrSlice.shape])]
+	arrSymbols = np.array(["."] + list(MAP_PREVIEW_SYMBOLS) + ["#"])
+	arrSlice = np.minimum(arrSlice, len(MAP_PREVIEW_SYMBOLS) + 1)
+	for row in arrSymbols[arrSlice]:
+		szMap += "".join(row) + "\n"
+	for plan, coverage in sorted(_retrievePlanCoverage(selectivityMap).items()):
+		szMap += "Plan {}: {} %\n".format(plan, "{:g}".format(round(coverage * 100, 2)))
+	return szMap
+
+
+def summarizeQEP(qep):
+	"""
+	Get the few values needed to list a QEP without rendering it
+
+	Parameters
+	----------
+	qep : plan_tree.PlanNode
+			The top operator of a QEP
+
+	Returns
+	-------
+	dictSummary : dict
+			The structural "fingerprint" of the plan, its total "cost" and its number of "nodes"
+
+	"""
+	return {
+		"fingerprint": qep.fingerprint(),
+		"cost": qep.totalCost if qep.totalCost is not None else 0,
+		"nodes": sum(1 for _ in qep.iterNodes()),
+	}
+
+
+def reducePlanDiagram(selectivityMap, costMap, threshold=REDUCTION_THRESHOLD):
+	"""
+	Reduce the number of plans of a selectivity map by letting plans swallow small neighbouring
+	plans, as long as the cost does not increase by more than threshold percent anywhere (the
+	CostGreedy reduction of Picasso). The smallest plans are considered first.
+
+	PostgreSQL cannot cost a plan at a selectivity where it was not chosen, so the cost of a plan
+	at a cell is bounded by plan cost monotonicity instead: the plan costs at most as much as at
+	any of its cells that have higher selectivities along every dimension. A plan can swallow a
+	cell if such a dominating cell exists within the threshold.
+
+	Parameters
+	----------
+	selectivityMap : numpy.ndarray
+			An N-dimensional array that contains the plan of every cell. 0 denotes a cell without a
+			plan.
+
+	costMap : numpy.ndarray
+			Total cost of the plan of every cell, as returned by processQuery()
+
+	threshold : float
+			The largest cost increase allowed at any cell, in percent (lambda)
+
+	Returns
+	-------
+	reducedMap : numpy.ndarray
+			The selectivity map after reduction
+
+	dictSwallowedBy : dict
+			Key: A plan that no longer appears in reducedMap
+			Value: The plan that replaces it
+
+	"""
+	with instrumentation.span("reduce", cells=selectivityMap.size):
+		reducedMap = selectivityMap.copy()
+		dictSwallowedBy = {}
+		if threshold <= 0 or selectivityMap.size == 0:
+			return reducedMap, dictSwallowedBy
+		# Highest cost allowed at every cell. Cells with an unknown cost are never swallowed, because
+		# comparisons with NaN are False.
+		arrLimit = costMap.astype(np.float64) * (1 + threshold / 100)
+		# Upper bound of the cost of the plan that is currently assigned to every cell
+		arrPlanCost = np.where(np.isnan(costMap), np.inf, costMap).astype(np.float64)
+		arrCounts = np.bincount(selectivityMap.ravel())
+		lstPlans = sorted((int(plan) for plan in np.nonzero(arrCounts)[0] if plan != 0),
+						  key=lambda plan: (arrCounts[plan], plan))
+		for plan in lstPlans:
+			arrCells = reducedMap == plan
+			arrCoordinates = np.nonzero(arrCells)
+			# Only cells at or above the lowest cell of the plan can dominate one of its cells
+			region = tuple(slice(int(coordinates.min()), None) for coordinates in arrCoordinates)
+			arrCellLimits = arrLimit[arrCells]
+			arrCounts = np.bincount(reducedMap.ravel())
+			lstCandidates = sorted(
+				[b if a == plan else a for a, b in _retrievePlanAdjacency(reducedMap) if plan in (a, b)],
+				key=lambda candidate: (-arrCounts[candidate], candidate))
+			for candidate in lstCandidates:
+				arrBound = np.where(reducedMap[region] == candidate, arrPlanCost[region], np.inf)
+				# Lowest cost of the candidate over the cells that dominate every cell
+				for axis in range(arrBound.ndim):
+					arrBound = np.flip(np.minimum.accumulate(np.flip(arrBound, axis), axis=axis), axis)
+				arrCellBounds = arrBound[arrCells[region]]
+				if np.all(arrCellBounds <= arrCellLimits):
+					reducedMap[arrCells] = candidate
+					arrPlanCost[arrCells] = arrCellBounds
+					for swallowed, swallower in dictSwallowedBy.items():
+						if swallower == plan:
+							dictSwallowedBy[swallowed] = candidate
+					dictSwallowedBy[plan] = candidate
+					break
+		return reducedMap, dictSwallowedBy
+
+
+def clusterPlans(lstAllQEPs, selectivityMap, threshold=FAMILY_DISTANCE_THRESHOLD):
+	"""
+	Group plans that differ in a few operators only, e.g. an extra Sort or Materialize, into plan
+	families. Every plan is described by the number of operators of each node type and relation
+	it contains, and the distance between two plans is the L1 distance between these vectors.
+
+	Starting with the plan that covers the largest part of the selectivity map, each plan that is
+	not in a family yet starts a new family, which all remaining plans within threshold of it join.
+	Every plan of a family is thus within threshold of its first plan.
+
+	Parameters
+	----------
+	lstAllQEPs : list
+			All possibe QEPs for that Picasso query template, as plan_tree.PlanNode trees
+
+	selectivityMap : numpy.ndarray
+			An N-dimensional array that contains the plan of every cell. 0 denotes a cell without a
+			plan.
+
+	threshold : float
+			The largest distance of a plan from the first plan of its family
+
+	Returns
+	-------
+	familyMap : numpy.ndarray
+			The family of the plan of every cell, starting from 1. 0 denotes a cell without a plan.
+
+	lstFamilies : list
+			The plan numbers of every family, largest family first. The first plan of a family
+			is the plan that covers the largest part of the selectivity map.
+
+	"""
+	with instrumentation.span("cluster", plans=len(lstAllQEPs)):
+		nPlans = len(lstAllQEPs)
+		arrDistances = _computePlanDistances(_countOperators(lstAllQEPs))
+		arrCounts = np.bincount(selectivityMap.ravel(), minlength=nPlans + 1)[1:nPlans + 1]
+		lstFamilies = []
+		arrUnassigned = np.ones(nPlans, dtype=bool)
+		# Largest plans first, and the lowest plan number first among plans of the same size
+		for index in np.lexsort((np.arange(nPlans), -arrCounts)):
+			if not arrUnassigned[index]:
+				continue
+			arrMembers = arrUnassigned & (arrDistances[index] <= threshold)
+			arrMembers[index] = False
+			lstMembers = [int(index)] + sorted(np.nonzero(arrMembers)[0].tolist(),
+												key=lambda member: (-arrCounts[member], member))
+			arrUnassigned[lstMembers] = False
+			lstFamilies.append([member + 1 for member in lstMembers])
+		lstFamilies.sort(key=lambda lstPlans: -sum(arrCounts[plan - 1] for plan in lstPlans))
+		# The family of every plan number, where plan number 0 denotes a cell without a plan
+		arrPlanFamily = np.zeros(nPlans + 1, dtype=_planIndexDtype(len(lstFamilies)))
+		for family, lstPlans in enumerate(lstFamilies):
+			arrPlanFamily[lstPlans] = family + 1
+		return arrPlanFamily[selectivityMap], lstFamilies
+
+
+def generateFamilyExplanation(lstFamilies, familyMap):
+	"""
+	Describe the plan families found by clusterPlans()
+
+	Parameters
+	----------
+	lstFamilies : list
+			The plan numbers of every family, as given by clusterPlans()
+
+	familyMap : numpy.ndarray
+			The family of the plan of every cell, as given by clusterPlans()
+
+	Returns
+	-------
+	lstFamilyExplanations : list
+			One string per family, with its plans and the part of the selectivity space it covers
+
+	"""
+	dictFamilyCoverage = _retrievePlanCoverage(familyMap)
+	lstFamilyExplanations = []
+	for family, lstPlans in enumerate(lstFamilies, start=1):
+		lstFamilyExplanations.append("Family {} ({} % of the selectivity space): Plan {}\n".format(
+			family, "{:g}".format(round(dictFamilyCoverage.get(family, 0) * 100, 2)),
+			", Plan ".join(str(plan) for plan in lstPlans)))
+	return lstFamilyExplanations
+
+
 """
 Private (implementation) methods
 
@@ -180,7 +868,10 @@ Private (implementation) methods
 def _convertToQueryTemplate(query):
 	"""
 	Retrieve the predicate attributes and convert to a Picasso query template by replacing clauses
-	with the predicate token.
+	with parameter slots. Range comparisons of a column with a numeric or date literal are varied
+	as "column <= value", and BETWEEN predicates on their upper bound, from their lower bound up.
+	Equality and inequality predicates keep their value, since sweeping them as a range would
+	explain another query.
 
 	Parameters
 	----------
@@ -190,51 +881,37 @@ def _convertToQueryTemplate(query):
 	Returns
 	-------
 	lstPredicateAttributes : list
-			List of all predicate attributes, maximum of 2 because only 2 dimensions are supported
+			List of all predicate attributes, one dimension of the selectivity map each
 
-	templateQuery : string
-			A Picasso query template after conversion
+	objTemplate : get_predicates_conditions.ProbeTemplate
+			A Picasso query template after conversion, compiled into literal segments and one
+			parameter slot per predicate attribute
 
 
 	"""
 
-	# Parse the normal query to retrieve predicate attributes
-	lstPredicateAttributes, clauses_list = get_predicates_conditions.get_var_column(
-		query)
-	print(lstPredicateAttributes)
-	print(clauses_list)
-	lstClausesToBeRemoved = []
-	for clause in clauses_list:
-		lstCondAndPred = re.split("<|<=|>|>=|!=", clause)
-		testPredicate = re.sub('[^A-Za-z0-9.-]+', '', lstCondAndPred[1])
-		try:
-			fVal = float(testPredicate)
-		except ValueError:
-			# If condition is not a valid integer or float, remove the clause and predicate from lists
-			lstClausesToBeRemoved.append(clause)
-			lstPredicateAttributes = [
-				value for value in lstPredicateAttributes if value != lstCondAndPred[0].strip()]
-	clauses_list = [x for x in clauses_list if x not in lstClausesToBeRemoved]
-	for index, attribute in enumerate(lstPredicateAttributes):
-		# If the attribute contains table name e.g. l1.l_extendedprice, split the string by the dot
-		# char and obtain attribute right side of dot
-		if attribute.find(".") != -1:
-			attribute = attribute.split(".")[-1]
-		lstPredicateAttributes[index] = attribute
+	# Find all predicates in one pass. Compiling the same query again is a cache lookup.
+	objTemplate = get_predicates_conditions.compile_query_template(query)
+	lstSlots = []
+	for slot in objTemplate.slots:
+		# Only numeric and date histograms can be interpolated, other predicates keep their value
+		if slot.kind in ("numeric", "date") and slot.operator not in FIXED_OPERATORS:
+			lstSlots.append(slot)
+		else:
+			print("Predicate {} is not varied".format(slot.text))
+	lstPredicateAttributes = [slot.attribute for slot in lstSlots]
 	if (len(lstPredicateAttributes) == 0):
 		print("ERROR! No predicates found! Check the query again")
 		return RET_CONVERT_QUERY_ERR, None
-	# Replace clauses with predicate token
-	for index, clause in enumerate(clauses_list):
-		query = query.replace(
-			clause, lstPredicateAttributes[index] + PREDICATE_TOKEN)
-	templateQuery = query
+	# Replace each predicate with a parameter slot. The predicates are replaced by position, so the
+	# same predicate text appearing twice is handled correctly.
+	objProbeTemplate = objTemplate.build_probe_template(lstSlots, PREDICATE_TOKEN)
 	print("Predicate attributes: ")
 	print(lstPredicateAttributes)
-	return RET_CONVERT_QUERY_OK, lstPredicateAttributes, templateQuery
+	return RET_CONVERT_QUERY_OK, lstPredicateAttributes, objProbeTemplate
 
 
-def _generatePredicateValues(objCommunicator, lstPredicateAttributes):
+def _generatePredicateValues(objCommunicator, lstPredicateAttributes, lstLowerBounds=None):
 	"""
 	Generates predicate values for all attributes required by retrieving from the histogram in
 	PostgreSQL. Default resolution of predicate values can be changed via the RESOLUTION
@@ -246,35 +923,110 @@ def _generatePredicateValues(objCommunicator, lstPredicateAttributes):
 			For interfacing with database
 
 	lstPredicateAttributes : list
-			List of all predicate attributes, maximum of 2 because only 2 dimensions are supported
+			List of all predicate attributes, one dimension of the selectivity map each
+
+	lstLowerBounds : list
+			The lower bound of every BETWEEN predicate and None for the other attributes, as
+			given by ProbeTemplate.lower_bounds. The dimension of a BETWEEN predicate starts at its
+			lower bound, so its selectivities are those of the rows above the lower bound.
 
 	Returns
 	-------
-	lstSelValsDimension01 : list
-			Selectivity values for first dimension
+	lstSelValsPerDimension : list
+			Selectivity values for every dimension, in the order of lstPredicateAttributes
 
-	lstSelValsDimension02 : list
-			Selectivity values for second dimension. If only one attribute is available, None is returned
+	lstHistogramBounds : list
+			The histogram bounds of every attribute, used by the adaptive and sparse sweeps to find
+			the predicate value for any selectivity
 
 	"""
 
-	lstSelValsDimension01 = []
-	lstSelValsDimension02 = []
-	for index, attribute in enumerate(lstPredicateAttributes):
-		schema = objCommunicator.findRelation(attribute)
-		histogram = objCommunicator.getHistogram(schema, attribute)
-		cardinality = objCommunicator.getCardinality(schema)
-		selVals, predValues = _readHistogram(histogram)
-		if index == 0:
-			lstSelValsDimension01.extend(selVals)
-		elif index == 1:
-			lstSelValsDimension02.extend(selVals)
-		else:
-			print("More than 2 predicates not allowed!")
-			quit()
-	if len(lstSelValsDimension02) == 0:
-		lstSelValsDimension02 = None
-	return lstSelValsDimension01, lstSelValsDimension02
+	if lstLowerBounds is None:
+		lstLowerBounds = [None] * len(lstPredicateAttributes)
+	lstSelValsPerDimension = []
+	lstHistogramBounds = []
+	# Relations, histograms and cardinalities of all attributes are retrieved in one round trip
+	dictAttributeStatistics = objCommunicator.getAttributeStatistics(lstPredicateAttributes)
+	if dictAttributeStatistics is None:
+		raise ValueError("Could not retrieve the statistics of {}".format(
+			", ".join(lstPredicateAttributes)))
+	for attribute, lowerBound in zip(lstPredicateAttributes, lstLowerBounds):
+		dictStatistics = dictAttributeStatistics.get(attribute)
+		# Attributes of relations that were never analysed, or that are not columns of any
+		# relation, have no pg_stats row and so no histogram bounds
+		if dictStatistics is None or dictStatistics["histogram"][0][0] is None:
+			raise ValueError("No statistics for {}, run ANALYZE on its relation".format(attribute))
+		histogram = dictStatistics["histogram"]
+		selVals = _readHistogram(histogram)
+		lstBounds = _readHistogramBounds(histogram)
+		if lowerBound is not None:
+			# "column BETWEEN low AND value" is empty for any value below low
+			low = _parseHistogramValue(str(lowerBound))
+			selVals = [value for value in selVals if value >= low] or [low]
+			lstBounds = [low] + [bound for bound in lstBounds if bound > low]
+		lstSelValsPerDimension.append(selVals)
+		lstHistogramBounds.append(lstBounds)
+	return lstSelValsPerDimension, lstHistogramBounds
+
+
+def _readHistogramBounds(histogram):
+	"""
+	Parses the histogram bounds retrieved from the database. The bounds divide the values of the
+	attribute into buckets with an equal number of rows.
+
+	Parameters
+	----------
+	histogram : list
+			The full histogram information after querying the database
+
+	Returns
+	-------
+	lstBounds : list
+			Histogram bounds in ascending order. Each element is a float, or a day number for dates.
+
+	"""
+	return [_parseHistogramValue(item) for item in histogram[0][0][1:-1].split(",")]
+
+
+def _parseHistogramValue(szValue):
+	"""
+	Parse one value of a histogram into a number that can be interpolated. Dates and timestamps
+	are converted to their day number (date.toordinal()), which ProbeTemplate formats back into a
+	date literal.
+
+	"""
+	szValue = szValue.strip('"')
+	try:
+		return float(szValue)
+	except ValueError:
+		return float(datetime.date.fromisoformat(szValue[:10]).toordinal())
+
+
+def _valueAtSelectivity(lstBounds, selectivity):
+	"""
+	Find the predicate value v such that "attribute <= v" has the given selectivity, by linear
+	interpolation between the histogram bounds
+
+	Parameters
+	----------
+	lstBounds : list
+			Histogram bounds of the attribute, from _readHistogramBounds()
+
+	selectivity : float
+			Selectivity between 0 and 1
+
+	Returns
+	-------
+	value : float
+			The predicate value
+
+	"""
+	position = selectivity * (len(lstBounds) - 1)
+	index = min(int(position), len(lstBounds) - 2)
+	if index < 0:
+		return lstBounds[0]
+	fraction = position - index
+	return lstBounds[index] + (lstBounds[index + 1] - lstBounds[index]) * fraction
 
 
 def _readHistogram(histogram):
@@ -293,32 +1045,21 @@ def _readHistogram(histogram):
 	selValues : list
 			Selectivity values ranging from 0 to 1. Each element is a float.
 
-	predicateValues : list
-			Predicate values for a dimension because histogram contains info for just one attribute.
-
 	"""
 	sumMCV = 0 	# Most common values
 	# Convert histogram values in string into list
 	szHistogramValues = histogram[0][0][1:-1]
 	lstHistogramValues = szHistogramValues.split(",")
 	# Convert MCVs in string into list
-	szMostCommonValues = histogram[0][1][1:-1]
+	# Columns without common values (e.g. unique columns) have no MCVs
+	szMostCommonValues = (histogram[0][1] or "{}")[1:-1]
 	lstMCV = szMostCommonValues.split(",")
 	# Frquencies already in list form
-	lstFreqValues = histogram[0][2][1:-1]
+	lstFreqValues = (histogram[0][2] or [])[1:-1]
 
 	step = int(100 / RESOLUTION)+1
-	histogramValues = [float(item) for item in lstHistogramValues[::step]]
-	histogramNextValues = [float(item) for item in lstHistogramValues[::step]]
-
-	predicateValues = []
-	startpoint = 0
-	endpoint = 1
-	sel = startpoint + ((endpoint - startpoint)/(2*RESOLUTION))
-
-	for i in range(int(RESOLUTION)):
-		predicateValues.append(sel)
-		sel += ((endpoint - startpoint)/RESOLUTION)
+	histogramValues = [_parseHistogramValue(item) for item in lstHistogramValues[::step]]
+	histogramNextValues = [_parseHistogramValue(item) for item in lstHistogramValues[::step]]
 
 	# Find lower bound and upper bound, and get a number between them
 	selValues = []
@@ -328,259 +1069,1022 @@ def _readHistogram(histogram):
 		val = ((upperBound - lowerBound) * 0.5) + lowerBound
 		selValues.append(val)
 
-	return selValues, predicateValues
+	return selValues
 
 
-def _retrieveQEPs_OneDimension(query, lstSelValsDimension01, objCommunicator):
+def _retrieveQEPs_Dense(query, lstSelValsPerDimension, objCommunicator, objMonitor=None):
 	"""
-	Retrieves alternative QEPs for one predicate attribute (i.e one dimension only). This is done
-	by replacing the predicate token with the corresponding selectivity values and then querying
-	the database.
+	Retrieves alternative QEPs for any number of predicate attributes by probing every cell of the
+	grid. This is done by replacing the predicate tokens with the corresponding selectivity values
+	and then querying the database. If the grid has more than DENSE_MAX_POINTS cells, every
+	dimension keeps fewer of its selectivity values, evenly spread over its range.
 
 	Parameters
 	----------
-	query : String
+	query : get_predicates_conditions.ProbeTemplate
 					A valid Picasso template query. Conversion should be done prior to calling this method
 
-	lstSelValsDimension01 : list
-					Selectivity values for first dimension
+	lstSelValsPerDimension : list
+					Selectivity values for every dimension, in the order of the predicate tokens
 
-	objCommunicator : Postgres_Connect object
+	objCommunicator : Postgres_Connect or Postgres_ConnectPool object
 					For interfacing with database
 
+	objMonitor : SweepMonitor object
+					Receives the progress of the sweep, or None
+
 	Returns
 	-------
-	planIndexes : list
-					A list that contains all the plans selected. First plan is denoted by 0 integer, and so on.
+	selectivityMap : numpy.ndarray
+					An N-dimensional array that contains the plan of every cell. First plan is denoted
+					by 1, and so on.
 
 	lstAllQEPs : list
 					All possibe QEPs for that Picasso query template
 
+	costMap : numpy.ndarray
+					Total cost of the plan of every cell, NaN if the plan is unknown
+
+	rowsMap : numpy.ndarray
+					Row estimate of the plan of every cell, NaN if the plan is unknown
+
 	"""
-	planIndexes = []
-	lstAllQEPs = []
-	for index, selectivityValue in enumerate(lstSelValsDimension01):
-		qepCount = index * len(lstSelValsDimension01)
-		if (qepCount % 10 == 0):
-			print("Retrieving QEP {} of {}...".format(
-				qepCount, len(lstSelValsDimension01)))
-		# Always save the original Picasso query template before replacing it within predicate value
-		origQuery = query
-		query = query.replace(PREDICATE_TOKEN, "<= " +
-							  str(selectivityValue), 1)
-		qep = objCommunicator.getQEP(query)[0][0]
-		if (index == 0):
-			# First plan, add it to the list. Compare subsequent plans with this plan
-			lstAllQEPs.append(qep)
-			planIndexes.append(1)
-		else:
-			bAddQEPFlag = True
-			for i, existingQEP in enumerate(lstAllQEPs):
-				dict_qep_difference = _compareQEPs(existingQEP, qep)
-				bIsDifferentPlan = _findValueInNestedDict(
-					dict_qep_difference, "Node Type")
-				# None means a similar plan has been found
-				if bIsDifferentPlan is None:
-					bAddQEPFlag = False
-					planIndexes.append(i+1)
-					# print("Similar plan found in QEP index", i)
-					break
-			if bAddQEPFlag == True:
-				print("New plan found")
-				lstAllQEPs.append(qep)
-				planIndexes.append(len(lstAllQEPs))
-		query = origQuery
-	return planIndexes, lstAllQEPs
+	nCells = max(len(lstSelVals) for lstSelVals in lstSelValsPerDimension)
+	while nCells > 2 and nCells ** len(lstSelValsPerDimension) > DENSE_MAX_POINTS:
+		nCells -= 1
+	lstSelValsPerDimension = [
+		[lstSelVals[int((i + 0.5) * len(lstSelVals) / nCells)] for i in range(nCells)]
+		if len(lstSelVals) > nCells else lstSelVals
+		for lstSelVals in lstSelValsPerDimension]
+	# product() varies the last dimension fastest, which is the row-major order of the map
+	lstPoints = list(itertools.product(*lstSelValsPerDimension))
+	shape = tuple(len(lstSelVals) for lstSelVals in lstSelValsPerDimension)
+	planIndexes, lstAllQEPs, arrCosts, arrRows = _retrieveQEPsForPoints(
+		query, lstPoints, objCommunicator, objMonitor, shape)
+	selectivityMap = np.array(planIndexes, dtype=_planIndexDtype(len(lstAllQEPs))).reshape(shape)
+	return selectivityMap, lstAllQEPs, arrCosts.reshape(shape), arrRows.reshape(shape)
+
+
+def _retrieveQEPs_Sparse(query, lstHistogramBounds, objCommunicator, objMonitor=None):
+	"""
+	Retrieves alternative QEPs for any number of predicate attributes from a Latin hypercube sample
+	of the selectivity space, so that the number of probes does not grow with the number of
+	dimensions. Every cell of the selectivity map is then labelled with the plan of the nearest
+	probed point.
+
+	Parameters
+	----------
+	query : get_predicates_conditions.ProbeTemplate
+					A valid Picasso template query. Conversion should be done prior to calling this method
 
+	lstHistogramBounds : list
+					Histogram bounds of every predicate attribute, in the order of the predicate tokens
 
-def _retrieveQEPs_TwoDimensions(query, lstSelValsDimension01, lstSelValsDimension02, objCommunicator):
+	objCommunicator : Postgres_Connect or Postgres_ConnectPool object
+					For interfacing with database
+
+	objMonitor : SweepMonitor object
+					Receives the progress of the sweep, or None
+
+	Returns
+	-------
+	selectivityMap : numpy.ndarray
+					An N-dimensional array that contains the plan of every cell. First plan is denoted
+					by 1, and so on.
+
+	lstAllQEPs : list
+					All possibe QEPs for that Picasso query template
+
+	costMap : numpy.ndarray
+					Total cost of the plan of every cell, taken from the nearest probed point like the
+					plan itself. NaN if the plan is unknown.
+
+	rowsMap : numpy.ndarray
+					Row estimate of the plan of every cell, taken from the nearest probed point
+
+	"""
+	nDimensions = len(lstHistogramBounds)
+	lstSamples = _latinHypercubeSample(SPARSE_SAMPLE_COUNT, nDimensions, SPARSE_SEED)
+	lstPoints = [tuple(_valueAtSelectivity(lstHistogramBounds[dim], sample[dim])
+					   for dim in range(nDimensions)) for sample in lstSamples]
+	samplePlanIndexes, lstAllQEPs, arrSampleCosts, arrSampleRows = _retrieveQEPsForPoints(
+		query, lstPoints, objCommunicator, objMonitor)
+	# Points that were not retrieved because the sweep was cancelled do not label any cell
+	lstProbed = [i for i, planNumber in enumerate(samplePlanIndexes) if planNumber != 0]
+	if len(lstProbed) > 0:
+		lstSamples = [lstSamples[i] for i in lstProbed]
+		samplePlanIndexes = [samplePlanIndexes[i] for i in lstProbed]
+		arrSampleCosts = arrSampleCosts[lstProbed]
+		arrSampleRows = arrSampleRows[lstProbed]
+
+	nCells = RESOLUTION
+	while nCells > 2 and nCells ** nDimensions > SPARSE_MAX_CELLS:
+		nCells -= 1
+	shape = (nCells,) * nDimensions
+	arrSamples = np.array(lstSamples)
+	arrSamplePlans = np.array(samplePlanIndexes, dtype=_planIndexDtype(len(lstAllQEPs)))
+	# Selectivity at the centre of every cell, one row per cell in row-major order
+	arrCentres = (np.indices(shape).reshape(nDimensions, -1).T + 0.5) / nCells
+	arrNearest = np.empty(len(arrCentres), dtype=np.intp)
+	for start in range(0, len(arrCentres), SPARSE_LABEL_CHUNK):
+		arrChunk = arrCentres[start:start + SPARSE_LABEL_CHUNK]
+		arrDistances = ((arrChunk[:, np.newaxis, :] - arrSamples[np.newaxis, :, :]) ** 2).sum(axis=2)
+		arrNearest[start:start + SPARSE_LABEL_CHUNK] = arrDistances.argmin(axis=1)
+	return (arrSamplePlans[arrNearest].reshape(shape), lstAllQEPs,
+			arrSampleCosts[arrNearest].reshape(shape), arrSampleRows[arrNearest].reshape(shape))
+
+
+def _latinHypercubeSample(nSamples, nDimensions, seed):
 	"""
-	Retrieves alternative QEPs for two predicate attribute (i.e two dimensions only). This is done
-	by replacing the predicate token with the corresponding selectivity values and then querying
-	the database.
+	Draw a Latin hypercube sample of the unit hypercube. Every dimension is divided into nSamples
+	strata of equal width, and every stratum of every dimension contains exactly one sample.
 
 	Parameters
 	----------
-	query : String
+	nSamples : int
+					Number of samples
+
+	nDimensions : int
+					Number of dimensions
+
+	seed : int
+					Seed of the random number generator
+
+	Returns
+	-------
+	lstSamples : list
+					A tuple of nDimensions selectivities between 0 and 1 for every sample
+
+	"""
+	objRandom = random.Random(seed)
+	lstColumns = []
+	for _ in range(nDimensions):
+		lstStrata = list(range(nSamples))
+		objRandom.shuffle(lstStrata)
+		lstColumns.append([(stratum + objRandom.random()) / nSamples for stratum in lstStrata])
+	return list(zip(*lstColumns))
+
+
+def _retrieveQEPs_Adaptive(query, lstHistogramBounds, objCommunicator, objMonitor=None):
+	"""
+	Retrieves alternative QEPs by refining the plan boundaries adaptively. A coarse grid of
+	RESOLUTION cells per dimension is probed first. Every cell whose corners do not all have the
+	same plan is then bisected along every dimension (interval bisection in 1D, quadtree in 2D),
+	until the cells are as small as ADAPTIVE_MIN_CELL_SIZE. Cells whose corners all have the same
+	plan are filled with that plan without being probed.
+
+	All corners of one refinement level are retrieved together, so the probes of a level are still
+	sent concurrently when objCommunicator is a pool.
+
+	Parameters
+	----------
+	query : get_predicates_conditions.ProbeTemplate
 					A valid Picasso template query. Conversion should be done prior to calling this method
 
-	lstSelValsDimension01 : list
-					Selectivity values for first dimension
+	lstHistogramBounds : list
+					Histogram bounds of every predicate attribute, in the order of the predicate tokens
+
+	objCommunicator : Postgres_Connect or Postgres_ConnectPool object
+					For interfacing with database
 
-	lstSelValsDimension02 : list
-					Selectivity values for second dimension
+	objMonitor : SweepMonitor object
+					Receives the progress of the sweep, or None
 
-	objCommunicator : Postgres_Connect object
+	Returns
+	-------
+	selectivityMap : numpy.ndarray
+					An N-dimensional array that contains the plan of every smallest cell. First plan is
+					denoted by 1, and so on.
+
+	lstAllQEPs : list
+					All possibe QEPs for that Picasso query template
+
+	costMap : numpy.ndarray
+					Total cost of the plan of every smallest cell. Cells that were not probed take the
+					cost of the lowest corner of their cell, NaN if the plan is unknown.
+
+	rowsMap : numpy.ndarray
+					Row estimate of the plan of every smallest cell, filled in the same way
+
+	"""
+	nDimensions = len(lstHistogramBounds)
+	# Number of smallest cells along each dimension. Every coarse cell spans nStride smallest cells.
+	nStride = 1
+	while (RESOLUTION * nStride * ADAPTIVE_MIN_CELL_SIZE < 1
+		   and (RESOLUTION * nStride * 2) ** nDimensions <= ADAPTIVE_MAX_CELLS):
+		nStride *= 2
+	nCells = RESOLUTION * nStride
+	lstCoarseCorners = [min(i * nStride, nCells - 1) for i in range(RESOLUTION + 1)]
+
+	def _pointOfCell(cellIndex):
+		# Probe each cell at the selectivity of its centre
+		return tuple(_valueAtSelectivity(lstHistogramBounds[dim], (cellIndex[dim] + 0.5) / nCells)
+					 for dim in range(nDimensions))
+
+	dictCornerPlans = {}
+	# Key: Probed corner, Value: (total cost, row estimate) of its plan
+	dictCornerCosts = {}
+	lstAllQEPs = []
+	dictPlanIndex = {}
+	arrMap = np.zeros((nCells,) * nDimensions, dtype=np.uint32)
+	arrCosts = np.full(arrMap.shape, np.nan, dtype=np.float32)
+	arrRows = np.full(arrMap.shape, np.nan, dtype=np.float32)
+	objProbes = _SweepProbes(query, objCommunicator)
+
+	def _probeCorners(lstCorners):
+		lstCorners = sorted(set(lstCorners) - set(dictCornerPlans))
+		if len(lstCorners) == 0:
+			return
+		lstPoints = [_pointOfCell(corner) for corner in lstCorners]
+		if objMonitor is not None:
+			objMonitor.addPoints(len(lstPoints))
+		for start in range(0, len(lstPoints), SWEEP_BATCH_SIZE):
+			if objMonitor is not None and objMonitor.isCancelled():
+				return
+			lstQEPs = _fetchQEPs(query, lstPoints[start:start + SWEEP_BATCH_SIZE],
+								 objCommunicator, objProbes, objMonitor)
+			with instrumentation.span("index_plans", qeps=len(lstQEPs)):
+				for corner, qep in zip(lstCorners[start:start + SWEEP_BATCH_SIZE], lstQEPs):
+					dictCornerPlans[corner] = _indexQEP(qep, dictPlanIndex, lstAllQEPs)
+					dictCornerCosts[corner] = _readCostAndRows(qep)
+			if objMonitor is not None:
+				objMonitor.plansFound(lstAllQEPs)
+
+	def _cornersOfCell(cell):
+		return list(itertools.product(*[(low, high) for low, high in cell]))
+
+	# Each cell is a tuple of (low, high) smallest-cell indexes for every dimension, both inclusive
+	lstCells = list(itertools.product(
+		*[list(zip(lstCoarseCorners[:-1], lstCoarseCorners[1:]))] * nDimensions))
+	try:
+		while lstCells:
+			_probeCorners([corner for cell in lstCells for corner in _cornersOfCell(cell)])
+			bCancelled = objMonitor is not None and objMonitor.isCancelled()
+			lstNextCells = []
+			for cell in lstCells:
+				setPlans = set(dictCornerPlans.get(corner, 0) for corner in _cornersOfCell(cell))
+				bSplittable = any(high - low > 1 for low, high in cell)
+				if len(setPlans) == 1 or not bSplittable or bCancelled:
+					_fillCell(arrMap, cell, dictCornerPlans, arrCosts, arrRows, dictCornerCosts)
+					continue
+				lstHalves = []
+				for low, high in cell:
+					if high - low > 1:
+						middle = (low + high) // 2
+						lstHalves.append([(low, middle), (middle, high)])
+					else:
+						lstHalves.append([(low, high)])
+				lstNextCells.extend(itertools.product(*lstHalves))
+			lstCells = lstNextCells
+			if objMonitor is not None and objMonitor.wantsMapUpdate():
+				objMonitor.mapUpdated(arrMap)
+			if bCancelled:
+				break
+	finally:
+		objProbes.finish()
+
+	print("Adaptive sweep probed {} of {} cells".format(len(dictCornerPlans), arrMap.size))
+	return arrMap.astype(_planIndexDtype(len(lstAllQEPs))), lstAllQEPs, arrCosts, arrRows
+
+
+def _fillCell(arrMap, cell, dictCornerPlans, arrCosts, arrRows, dictCornerCosts):
+	"""
+	Assign a plan to every smallest cell within a cell of the adaptive sweep. If all corners have
+	the same plan, the whole cell takes that plan. Otherwise the cell cannot be split any further
+	(or the sweep was cancelled), so only its corners take their own plan. Corners that were not
+	probed are left as 0.
+
+	The cost surface is filled alongside. Under plan cost monotonicity, the cost of a plan grows
+	with the selectivities, so a uniform cell takes the cost of its lowest corner.
+
+	Parameters
+	----------
+	arrMap : numpy.ndarray
+					Plan of every smallest cell. Updated in place.
+
+	cell : tuple
+					(low, high) smallest-cell indexes for every dimension, both inclusive
+
+	dictCornerPlans : dict
+					Key: Tuple of smallest-cell indexes of a probed corner
+					Value: Plan number at that corner
+
+	arrCosts : numpy.ndarray
+	arrRows : numpy.ndarray
+					Total cost and row estimate of every smallest cell. Updated in place.
+
+	dictCornerCosts : dict
+					Key: Tuple of smallest-cell indexes of a probed corner
+					Value: (total cost, row estimate) of the plan at that corner
+
+	"""
+	lstCorners = list(itertools.product(*cell))
+	setPlans = set(dictCornerPlans.get(corner, 0) for corner in lstCorners)
+	if len(setPlans) == 1:
+		region = tuple(slice(low, high + 1) for low, high in cell)
+		arrMap[region] = setPlans.pop()
+		arrCosts[region], arrRows[region] = dictCornerCosts.get(lstCorners[0], (np.nan, np.nan))
+		return
+	for corner in lstCorners:
+		arrMap[corner] = dictCornerPlans.get(corner, 0)
+		arrCosts[corner], arrRows[corner] = dictCornerCosts.get(corner, (np.nan, np.nan))
+
+
+def _retrieveQEPsForPoints(query, lstPoints, objCommunicator, objMonitor=None, mapShape=None):
+	"""
+	Retrieves the QEPs for all grid points of a sweep and assigns a plan number to each of them.
+	The queries are sent to the database with getQEPs(), which fans them out over all sessions
+	when objCommunicator is a Postgres_ConnectPool. The plan numbers are always assigned in grid
+	order, so the result does not depend on which session answers first. The points are retrieved
+	in batches of SWEEP_BATCH_SIZE so that the sweep can report progress and be cancelled.
+
+	Parameters
+	----------
+	query : get_predicates_conditions.ProbeTemplate
+					A valid Picasso template query
+
+	lstPoints : list
+					A tuple of predicate values for every grid point, in grid order. Each tuple has one
+					value per predicate token in the template
+
+	objCommunicator : Postgres_Connect or Postgres_ConnectPool object
 					For interfacing with database
 
+	objMonitor : SweepMonitor object
+					Receives the progress of the sweep, or None
+
+	mapShape : tuple
+					Shape of the selectivity map if the points are its cells in row-major order, so that
+					the partial map can be sent to objMonitor. None otherwise.
+
 	Returns
 	-------
 	planIndexes : list
-					A list that contains all the plans selected. First plan is denoted by 0 integer, and so on.
+					A list that contains all the plans selected. First plan is denoted by 1, and so on.
+					Points without a QEP are denoted by 0.
 
 	lstAllQEPs : list
 					All possibe QEPs for that Picasso query template
 
+	arrCosts : numpy.ndarray
+					Total cost of the plan of every point, NaN for points without a QEP
+
+	arrRows : numpy.ndarray
+					Row estimate of the plan of every point, NaN for points without a QEP
+
 	"""
 	planIndexes = []
 	lstAllQEPs = []
-	for index, selectivityValue in enumerate(lstSelValsDimension01):
-		for index2, selectivityValue2 in enumerate(lstSelValsDimension02):
-			qepCount = index * len(lstSelValsDimension01) + (index2 + 1)
-			if (qepCount % 10 == 0):
-				print("Retrieving QEP {} of {}...".format(qepCount, len(
-					lstSelValsDimension01)*len(lstSelValsDimension02)))
-			# Always save the original Picasso query template before replacing it within predicate value
-			origQuery = query
-			query = query.replace(
-				PREDICATE_TOKEN, "<= " + str(selectivityValue), 1)
-			query = query.replace(
-				PREDICATE_TOKEN, "<= " + str(selectivityValue2), 1)
-			qep = objCommunicator.getQEP(query)[0][0]
-			if (index == 0 and index2 == 0):
-				# First plan, add it to the list. Compare subsequent plans with this plan
-				lstAllQEPs.append(qep)
-				planIndexes.append(1)
+	dictPlanIndex = {}
+	arrCosts = np.full(len(lstPoints), np.nan, dtype=np.float32)
+	arrRows = np.full(len(lstPoints), np.nan, dtype=np.float32)
+	objProbes = _SweepProbes(query, objCommunicator)
+	if objMonitor is not None:
+		objMonitor.addPoints(len(lstPoints))
+	try:
+		for start in range(0, len(lstPoints), SWEEP_BATCH_SIZE):
+			if objMonitor is not None and objMonitor.isCancelled():
+				print("Sweep cancelled after {} of {} QEPs".format(start, len(lstPoints)))
+				planIndexes.extend([0] * (len(lstPoints) - start))
+				break
+			lstQEPs = _fetchQEPs(query, lstPoints[start:start + SWEEP_BATCH_SIZE],
+								 objCommunicator, objProbes, objMonitor)
+			with instrumentation.span("index_plans", qeps=len(lstQEPs)):
+				for qep in lstQEPs:
+					arrCosts[len(planIndexes)], arrRows[len(planIndexes)] = _readCostAndRows(qep)
+					planIndexes.append(_indexQEP(qep, dictPlanIndex, lstAllQEPs))
+			if objMonitor is not None:
+				objMonitor.plansFound(lstAllQEPs)
+				if mapShape is not None and objMonitor.wantsMapUpdate():
+					arrPartialMap = np.zeros(len(lstPoints), dtype=np.uint32)
+					arrPartialMap[:len(planIndexes)] = planIndexes
+					objMonitor.mapUpdated(arrPartialMap.reshape(mapShape))
+	finally:
+		objProbes.finish()
+	return planIndexes, lstAllQEPs, arrCosts, arrRows
+
+
+def _fetchQEPs(query, lstPoints, objCommunicator, objProbes, objMonitor=None):
+	"""
+	Get the QEPs of a Picasso query template for several grid points. QEPs found in the on-disk
+	cache are reused as long as the statistics of the relations used by the query have not changed
+	since they were retrieved. Only the remaining points are sent to the database.
+
+	Parameters
+	----------
+	query : get_predicates_conditions.ProbeTemplate
+					A valid Picasso template query
+
+	lstPoints : list
+					A tuple of predicate values for every grid point
+
+	objCommunicator : Postgres_Connect or Postgres_ConnectPool object
+					For interfacing with database
+
+	objProbes : _SweepProbes object
+					What the sweep has set up to send its probes, started when the first QEP is
+					retrieved from the database
+
+	objMonitor : SweepMonitor object
+					Receives the progress of the sweep, or None
+
+	Returns
+	-------
+	lstQEPs : list
+					The plan_tree.PlanNode of every grid point, in the same order as lstPoints. None
+					if the QEP of a point could not be retrieved.
+
+	"""
+	objCache = None
+	templateKey = None
+	statsVersion = None
+	dictQEPs = {}
+	if USE_QEP_CACHE:
+		with instrumentation.span("cache_lookup", points=len(lstPoints)):
+			templateKey = objProbes.getTemplateKey()
+			if templateKey is not None:
+				objCache = _getQEPCache()
+				if objProbes.bStatsVersionRetrieved:
+					statsVersion = objProbes.statsVersion
+				else:
+					lstRelations = objCache.getRelations(templateKey)
+					if lstRelations is not None:
+						statsVersion = objProbes.getStatisticsVersion(lstRelations)
+			if statsVersion is not None:
+				if not objProbes.bCacheExpired:
+					objCache.expire(templateKey, statsVersion)
+					objProbes.bCacheExpired = True
+				dictQEPs = objCache.lookup(templateKey, statsVersion, lstPoints)
+		instrumentation.count("qeps_cached", len(dictQEPs))
+
+	nCachedPoints = sum(1 for point in lstPoints if point in dictQEPs)
+	# Several corners of the adaptive sweep can have the same predicate values, which are only
+	# explained once
+	lstMissingPoints = list(dict.fromkeys(point for point in lstPoints if point not in dictQEPs))
+	if len(lstMissingPoints) > 0:
+		start = time.perf_counter()
+		dictNewQEPs = {}
+		if objCache is not None and not objProbes.bStatsVersionRetrieved:
+			# The statistics version is read before the QEPs it is stored with are retrieved, so
+			# that an ANALYZE during the sweep cannot store stale QEPs under a fresh version. Every
+			# plan of the query scans the same relations, so the relations of a first template are
+			# found by explaining one point. Its QEP is kept but, retrieved before the version, not
+			# cached.
+			point = lstMissingPoints[0]
+			with instrumentation.span("explain_batch", queries=1):
+				qep = _explainPoints(query, [point], objCommunicator, None)[0]
+			if qep is not None:
+				dictNewQEPs[point] = qep
+				objProbes.getStatisticsVersion(_findRelations(plan_tree.fromQEP(qep)))
+		lstBatchPoints = [point for point in lstMissingPoints if point not in dictNewQEPs]
+		objProbes.start()
+		print("Retrieving {} QEPs...".format(len(lstMissingPoints)))
+		with instrumentation.span("explain_batch", queries=len(lstBatchPoints)):
+			if len(lstBatchPoints) == 0:
+				lstResults, lstRebuilt = [], []
+			elif objProbes.dictServerPlans is not None:
+				lstResults, lstRebuilt = _explainOnServer(
+					query, lstBatchPoints, objCommunicator, objProbes.dictServerPlans)
+				lstFailedPoints = [point for point, result in zip(lstBatchPoints, lstResults) if result is None]
+				if len(lstFailedPoints) > 0 and (objMonitor is None or not objMonitor.isCancelled()):
+					# statement_timeout applied to the batch of a whole session, which may have
+					# been cut short by a single slow point
+					print("Retrieving {} QEPs of failed batches one at a time...".format(len(lstFailedPoints)))
+					dictRetried = dict(zip(lstFailedPoints,
+										   _explainPoints(query, lstFailedPoints, objCommunicator, None)))
+					lstResults = [dictRetried.get(point, result) for point, result in zip(lstBatchPoints, lstResults)]
 			else:
-				bAddQEPFlag = True
-				for i, existingQEP in enumerate(lstAllQEPs):
-					dict_qep_difference = _compareQEPs(existingQEP, qep)
-					bIsDifferentPlan = _findValueInNestedDict(
-						dict_qep_difference, "Node Type")
-					# None means a similar plan has been found
-					if bIsDifferentPlan is None:
-						bAddQEPFlag = False
-						planIndexes.append(i+1)
-						# print("Similar plan found in QEP index", i)
-						break
-				if bAddQEPFlag == True:
-					print("New plan found")
-					lstAllQEPs.append(qep)
-					planIndexes.append(len(lstAllQEPs))
-			query = origQuery
-	return planIndexes, lstAllQEPs
+				lstResults = _explainPoints(query, lstBatchPoints, objCommunicator, objProbes.statementName)
+				lstRebuilt = [False for _ in lstBatchPoints]
+		dictStoredQEPs = {}
+		for point, result, bRebuilt in zip(lstBatchPoints, lstResults, lstRebuilt):
+			# Points that timed out are not cached, so they are retried by the next sweep
+			if result is not None:
+				dictNewQEPs[point] = result
+				# A rebuilt QEP has the operator costs of another point, so it is not cached
+				if not bRebuilt:
+					dictStoredQEPs[point] = result
+		dictQEPs.update(dictNewQEPs)
+		# Distinct points whose EXPLAIN timed out or failed
+		nUnknown = len(lstMissingPoints) - len(dictNewQEPs)
+		instrumentation.count("qeps_explained", len(dictNewQEPs))
+		instrumentation.count("qeps_unknown", nUnknown)
+		# The progress counts every point of the batch, like SweepMonitor.addPoints()
+		if objMonitor is not None and objMonitor.isCancelled():
+			# The missing QEPs were cancelled rather than timed out
+			objMonitor.pointsDone(sum(1 for point in lstPoints if point in dictNewQEPs), objMonitor.nPlansFound,
+								  len(dictNewQEPs), time.perf_counter() - start)
+		elif objMonitor is not None:
+			objMonitor.pointsDone(len(lstPoints) - nCachedPoints, objMonitor.nPlansFound,
+								  len(lstMissingPoints), time.perf_counter() - start, nUnknown)
+
+		if objCache is not None and len(dictStoredQEPs) > 0 and objProbes.statsVersion is not None:
+			with instrumentation.span("cache_store", qeps=len(dictStoredQEPs)):
+				objCache.store(templateKey, objProbes.statsVersion, objProbes.lstRelations, dictStoredQEPs)
+	if objMonitor is not None and nCachedPoints > 0:
+		objMonitor.pointsDone(nCachedPoints, objMonitor.nPlansFound, nCached=nCachedPoints)
+	# The cache stores the raw JSON, the sweep only keeps the compact trees
+	return [plan_tree.fromQEP(dictQEPs[point], KEEP_RAW_QEPS) if point in dictQEPs else None
+			for point in lstPoints]
+
+
+def _installBatchExplain(objCommunicator):
+	"""
+	Create the functions of db_connection_manager.BATCH_EXPLAIN_FUNCTIONS on every session. They
+	are created again for every sweep, since a session of the pool may have been reconnected in
+	between.
+
+	Parameters
+	----------
+	objCommunicator : Postgres_Connect or Postgres_ConnectPool object
+					For interfacing with database
+
+	Returns
+	-------
+	dictServerPlans : dict
+					An empty dict to keep the plans received during the sweep in, or None if the
+					points have to be explained one request at a time
+
+	"""
+	if not objCommunicator.executeStatement(db_connect.BATCH_EXPLAIN_FUNCTIONS):
+		print("Unable to create the batch EXPLAIN function, sending one request per point instead")
+		return None
+	return {}
+
+
+def _explainOnServer(query, lstPoints, objCommunicator, dictServerPlans):
+	"""
+	Get the QEPs of several grid points with the batch EXPLAIN function, in a few round trips.
+	The server sends the QEP of every plan that was not received earlier in the sweep. For the
+	other points, it sends only the fingerprint, total cost and row estimate of their plan, and
+	their QEP is rebuilt from the QEP of the same plan received before.
+
+	Parameters
+	----------
+	query : get_predicates_conditions.ProbeTemplate
+					A valid Picasso template query
+
+	lstPoints : list
+					A tuple of predicate values for every grid point
+
+	objCommunicator : Postgres_Connect or Postgres_ConnectPool object
+					For interfacing with database
+
+	dictServerPlans : dict
+					Key: Fingerprint of a plan computed by the server
+					Value: The first QEP in JSON format received with that plan. Plans received by
+					this call are added.
+
+	Returns
+	-------
+	lstQEPs : list
+					The QEP in JSON format of every grid point, in the same order as lstPoints. None
+					if the QEP of a point could not be retrieved. A rebuilt QEP has the total cost and
+					row estimate of its point, but the costs of the operators below the top one are
+					those of the point the plan was first received for.
+
+	lstRebuilt : list
+					True for every grid point whose QEP was rebuilt rather than sent by the server
+
+	"""
+	lstParameters = [[query.format_value(kind, value) for kind, value in zip(query.kinds, point)]
+					 for point in lstPoints]
+	lstResults = objCommunicator.explainBatch(query.format_template(), lstParameters, list(dictServerPlans))
+	lstQEPs = []
+	lstRebuilt = []
+	nPlansSent = 0
+	for result in lstResults:
+		lstRebuilt.append(result is not None and result[3] is None)
+		if result is None:
+			lstQEPs.append(None)
+			continue
+		fingerprint, totalCost, rows, qep = result
+		if qep is not None:
+			nPlansSent += 1
+			dictServerPlans.setdefault(fingerprint, qep)
+			lstQEPs.append(qep)
+			continue
+		# The server only leaves out QEPs that are in dictServerPlans, or that were sent for an
+		# earlier point of the same batch
+		qep = dictServerPlans[fingerprint]
+		dictPlan = dict(qep[0]["Plan"])
+		dictPlan["Total Cost"] = totalCost
+		dictPlan["Plan Rows"] = rows
+		lstQEPs.append([dict(qep[0], Plan=dictPlan)])
+	instrumentation.count("qeps_sent_by_server", nPlansSent)
+	return lstQEPs, lstRebuilt
+
+
+def _explainPoints(query, lstPoints, objCommunicator, statementName):
+	"""
+	Get the QEPs of several grid points with one EXPLAIN request per point
+
+	Parameters
+	----------
+	query : get_predicates_conditions.ProbeTemplate
+					A valid Picasso template query
+
+	lstPoints : list
+					A tuple of predicate values for every grid point
+
+	objCommunicator : Postgres_Connect or Postgres_ConnectPool object
+					For interfacing with database
+
+	statementName : String
+					Name of the prepared statement of the template, or None to substitute the
+					predicate values into the query text
+
+	Returns
+	-------
+	lstQEPs : list
+					The QEP in JSON format of every grid point, in the same order as lstPoints. None
+					if the QEP of a point could not be retrieved.
+
+	"""
+	return [result[0][0] if result is not None else None
+			for result in objCommunicator.getQEPs(
+				[_bindQueryTemplate(query, point, statementName) for point in lstPoints])]
+
+
+def _getQEPCache():
+	"""
+	Get the on-disk QEP cache, opening it on first use
+
+	"""
+	global _objQEPCache
+	if _objQEPCache is None:
+		_objQEPCache = qep_cache.QEPCache()
+	return _objQEPCache
+
+
+def _findRelations(qep):
+	"""
+	Find the names of all relations scanned by a QEP
+
+	Parameters
+	----------
+	qep : plan_tree.PlanNode
+					The top operator of a QEP
+
+	Returns
+	-------
+	lstRelations : list
+					Sorted names of the relations, without duplicates
+
+	"""
+	return sorted(set(node.relation for node in qep.iterNodes() if node.relation is not None))
+
+
+def _prepareQueryTemplate(query, objCommunicator):
+	"""
+	Turn the Picasso query template into a server-side prepared statement on every session, with one
+	parameter per slot of the template. The server then parses and analyses the query only once
+	instead of at every grid point. plan_cache_mode is set to force_custom_plan so that the
+	planner still sees the actual predicate values when planning each EXECUTE. Both are undone by
+	_SweepProbes.finish().
+
+	Parameters
+	----------
+	query : get_predicates_conditions.ProbeTemplate
+					A valid Picasso template query
+
+	objCommunicator : Postgres_Connect or Postgres_ConnectPool object
+					For interfacing with database
+
+	Returns
+	-------
+	statementName : String
+					Name of the prepared statement, or None if it could not be prepared. In that case
+					the predicate values have to be substituted into the query text instead.
+
+	"""
+	statementName = "qpv_probe_{}".format(next(_preparedStatementCounter))
+	# Numeric and date parameters have the same semantics as the literals substituted in "literal"
+	# mode
+	szParameterizedQuery, lstTypes = query.parameterize()
+	# plan_cache_mode is only available from PostgreSQL 12. Older servers would switch to a generic
+	# plan after five executions, which does not depend on the predicate values at all.
+	if not objCommunicator.executeStatement("SET plan_cache_mode = force_custom_plan"):
+		print("The server does not support plan_cache_mode, substituting predicate values instead")
+		return None
+	bPrepared = objCommunicator.executeStatement("PREPARE {}({}) AS {}".format(
+		statementName, ", ".join(lstTypes), szParameterizedQuery))
+	if not bPrepared:
+		objCommunicator.executeStatement("RESET plan_cache_mode")
+		print("Unable to prepare query template, substituting predicate values instead")
+		return None
+	return statementName
+
+
+def _bindQueryTemplate(query, point, statementName=None):
+	"""
+	Build the statement to be explained for one grid point. The template is already split around
+	its slots, so this is a single join over the slots whatever the length of the query.
+
+	Parameters
+	----------
+	query : get_predicates_conditions.ProbeTemplate
+					A valid Picasso template query
+
+	point : tuple
+					One predicate value per slot in the template
+
+	statementName : String
+					Name of the prepared statement from _prepareQueryTemplate(). If None, the predicate
+					values are substituted into the query text.
+
+	Returns
+	-------
+	probeQuery : String
+					The statement to be appended to EXPLAIN
+
+	"""
+	if statementName is not None:
+		return "EXECUTE {}({})".format(statementName, ", ".join(
+			[query.format_value(kind, value) for kind, value in zip(query.kinds, point)]))
+	return query.bind(point)
+
+
+def _readCostAndRows(qep):
+	"""
+	Read the total cost and the row estimate of the top node of a QEP
+
+	Parameters
+	----------
+	qep : plan_tree.PlanNode
+					The top operator of a QEP, or None
+
+	Returns
+	-------
+	cost : float
+					Total cost of the plan, NaN if qep is None
+
+	rows : float
+					Number of rows the planner expects the plan to return, NaN if qep is None
+
+	"""
+	if qep is None:
+		return np.nan, np.nan
+	return (qep.totalCost if qep.totalCost is not None else np.nan,
+			qep.rows if qep.rows is not None else np.nan)
+
+
+def _indexQEP(qep, dictPlanIndex, lstAllQEPs):
+	"""
+	Look up a QEP in the fingerprint index, adding it as a new plan if its fingerprint has not
+	been seen before. This costs a single hash lookup regardless of the number of plans found.
+	Missing QEPs are given the plan number 0.
+
+	Parameters
+	----------
+	qep : plan_tree.PlanNode
+					The top operator of a QEP, or None
+
+	dictPlanIndex : dict
+					Key: Fingerprint of a plan, as given by plan_tree.PlanNode.fingerprint()
+					Value: The plan number, starting from 1
+
+	lstAllQEPs : list
+					All QEPs found so far. New plans are appended to this list
+
+	Returns
+	-------
+	planNumber : int
+					The plan number of the QEP, starting from 1
+
+	"""
+	if qep is None:
+		return 0
+	fingerprint = qep.fingerprint()
+	planNumber = dictPlanIndex.get(fingerprint)
+	if planNumber is None:
+		print("New plan found")
+		lstAllQEPs.append(qep)
+		planNumber = len(lstAllQEPs)
+		dictPlanIndex[fingerprint] = planNumber
+	return planNumber
+
+
+def _buildPlanIndex(lstAllQEPs):
+	"""
+	Build the fingerprint index for a list of distinct QEPs
+
+	Parameters
+	----------
+	lstAllQEPs : list
+					All possibe QEPs for that Picasso query template
+
+	Returns
+	-------
+	dictPlanIndex : dict
+					Key: Fingerprint of a plan, as given by plan_tree.PlanNode.fingerprint()
+					Value: The plan number, starting from 1
+
+	"""
+	dictPlanIndex = {}
+	for index, qep in enumerate(lstAllQEPs):
+		dictPlanIndex.setdefault(qep.fingerprint(), index + 1)
+	return dictPlanIndex
 
 
 def _compareQEPs(qep1, qep2):
 	"""
-	Compare two QEPs for any difference using JSONdiff library
+	Compare two QEPs for any difference in their operators
 
 	Parameters
 	----------
-	qep1 : list
-	qep2 : list
-					Two possible QEPs in JSON format retrieved from PostgreSQL
+	qep1 : plan_tree.PlanNode
+	qep2 : plan_tree.PlanNode
+					Two possible QEPs
 
 	Returns
 	-------
 	result : dict
-					A dictionary containing all differences between two QEPs
+					The operators inserted, removed and changed from qep1 to qep2, as given by
+					plan_diff.diffPlans()
 
 	"""
-	result = diff(qep1, qep2, syntax="explicit")
+	result = plan_diff.diffPlans(qep1, qep2)
 	return result
 
 
-def _retrieveSelectivityRanges(planIndexes):
+def _retrieveSelectivityRanges(selectivityMap):
 	"""
-	Retrieves selectivity range for all dimensions based on the plans taken.
+	Retrieves selectivity range for all dimensions based on the plans taken, i.e. the bounding box
+	of the region of every plan in the selectivity map.
 
 	Parameters
 	----------
-	planIndexes : list
-			A list that contains all the plans selected. First plan is denoted by 0 integer, and so on.
+	selectivityMap : numpy.ndarray
+			An N-dimensional array that contains the plan of every cell. First plan is denoted by 1,
+			and so on. 0 denotes a cell without a plan.
 
 	Returns
 	-------
 	dictSelectvityRanges : dict
-			Key: The plan index number, starting from 0
-			Value: A tuple containing the min and max of selectivity values for each dimension
-
-	"""
-	lstSelectivityTuples = []
-	planIndexes = _convert2DArray(planIndexes, RESOLUTION)
-	# print("\nSelectivity Map: ")
-	# print('\n'.join([''.join(['{:4}'.format(item) for item in row]) for row in planIndexes]))
-	for rowIndex, row in enumerate(planIndexes):
-		for colIndex, col in enumerate(row):
-			lstSelectivityTuples.append(
-				(planIndexes[rowIndex][colIndex], rowIndex, colIndex))
-	lstSelectivityTuples.sort(key=lambda x: x[0])
-	temp = _splitListOfTuplesByKey(lstSelectivityTuples)
-	temp = list(temp.values())
+			Key: The plan index number, starting from 1
+			Value: A tuple containing the min and max cell index of each dimension
+
+	"""
 	dictSelectvityRanges = {}
-	# For one dimensions, the tuples are found in tupleMinMaxDim2 instead
-	for index, lst in enumerate(temp):
-		tupleMinMaxDim1 = (min(lst)[1], max(lst)[1])
-		tupleMinMaxDim2 = (min(lst)[2], max(lst)[2])
-		dictSelectvityRanges[index+1] = (tupleMinMaxDim1, tupleMinMaxDim2)
+	for plan in np.unique(selectivityMap):
+		if plan == 0:
+			continue
+		# Only one boolean mask of the map is allocated at a time, no coordinates of every cell
+		arrMask = selectivityMap == plan
+		lstRanges = []
+		for dim in range(selectivityMap.ndim):
+			# True at every index of the dimension where the plan is taken in some cell
+			arrPresent = np.any(arrMask, axis=tuple(axis for axis in range(selectivityMap.ndim) if axis != dim))
+			arrIndexes = np.flatnonzero(arrPresent)
+			lstRanges.append((int(arrIndexes[0]), int(arrIndexes[-1])))
+		dictSelectvityRanges[int(plan)] = tuple(lstRanges)
 	return dictSelectvityRanges
 
 
-"""
-Utility functions
+def _retrievePlanCoverage(selectivityMap):
+	"""
+	Retrieves the fraction of the selectivity space covered by each plan
 
-"""
+	Parameters
+	----------
+	selectivityMap : numpy.ndarray
+			An N-dimensional array that contains the plan of every cell
+
+	Returns
+	-------
+	dictPlanCoverage : dict
+			Key: The plan index number, starting from 1
+			Value: Fraction of the cells of the selectivity map that take the plan
+
+	"""
+	arrCounts = np.bincount(selectivityMap.ravel())
+	dictPlanCoverage = {}
+	for plan in np.nonzero(arrCounts)[0]:
+		if plan != 0:
+			dictPlanCoverage[int(plan)] = arrCounts[plan] / selectivityMap.size
+	return dictPlanCoverage
 
 
-def _splitListOfTuplesByKey(items, idx=0):
+def _retrievePlanAdjacency(selectivityMap):
 	"""
-	Split a list of tuples into sublists based on first values of tuple. This is used for 
-	determining the selectivity ranges for all predicate attributes.
+	Retrieves all pairs of plans whose regions touch in the selectivity map, i.e. the plans that
+	the optimiser switches between when a single selectivity changes
 
 	Parameters
-	---------- 
-	items : list
-			A list of tuples to be sorted and split by key
+	----------
+	selectivityMap : numpy.ndarray
+			An N-dimensional array that contains the plan of every cell
+
+	Returns
+	-------
+	setAdjacentPlans : set
+			Tuples (plan A, plan B) with plan A < plan B
 
 	"""
-	result = {}
-	for item in items:
-		key = item[idx]
-		if key not in result:
-			result[key] = []
-		result[key].append(item)
-	return result
+	nPlans = int(selectivityMap.max()) if selectivityMap.size > 0 else 0
+	# arrAdjacent[a, b] is True if plans a and b are neighbours somewhere in the map
+	arrAdjacent = np.zeros((nPlans + 1, nPlans + 1), dtype=bool)
+	for dim in range(selectivityMap.ndim):
+		arrLow = np.take(selectivityMap, range(selectivityMap.shape[dim] - 1), axis=dim).ravel()
+		arrHigh = np.take(selectivityMap, range(1, selectivityMap.shape[dim]), axis=dim).ravel()
+		arrAdjacent[arrLow, arrHigh] = True
+	arrAdjacent |= arrAdjacent.T
+	arrAdjacent[0, :] = False
+	arrAdjacent[:, 0] = False
+	return set((int(a), int(b)) for a, b in zip(*np.nonzero(np.triu(arrAdjacent, k=1))))
+
+
+def _countOperators(lstAllQEPs):
+	"""
+	Describe every plan by the number of times each operator occurs in it (a node multiset)
 
+	Parameters
+	----------
+	lstAllQEPs : list
+			The QEPs, as plan_tree.PlanNode trees
+
+	Returns
+	-------
+	arrFeatures : numpy.ndarray
+			Array of shape (number of plans, number of distinct operators). Element [p, o] is the
+			number of operators o in plan p, where an operator is a node type and a relation.
 
-def _convert2DArray(lstOrigList, nElementsInList):
 	"""
-	Split the list of column names into several lists like a 2D array. his is used for 
-	determining the selectivity ranges for all predicate attributes.
+	dictOperators = {}
+	lstPlanIndexes = []
+	lstOperatorIndexes = []
+	for index, qep in enumerate(lstAllQEPs):
+		for node in qep.iterNodes():
+			lstPlanIndexes.append(index)
+			lstOperatorIndexes.append(dictOperators.setdefault((node.nodeType, node.relation), len(dictOperators)))
+	arrFeatures = np.zeros((len(lstAllQEPs), len(dictOperators)), dtype=np.int32)
+	np.add.at(arrFeatures, (np.array(lstPlanIndexes, dtype=np.intp), np.array(lstOperatorIndexes, dtype=np.intp)), 1)
+	return arrFeatures
+
+
+def _computePlanDistances(arrFeatures):
+	"""
+	Compute the L1 distance between the operator counts of every pair of plans. The matrix is
+	computed in blocks of rows, so that at most FAMILY_DISTANCE_BLOCK_ELEMENTS differences are
+	held in memory at once.
 
 	Parameters
-	---------- 
-	lstOrigList: list
-			Original 1D list to be split
+	----------
+	arrFeatures : numpy.ndarray
+			Operator counts of every plan, as given by _countOperators()
+
+	Returns
+	-------
+	arrDistances : numpy.ndarray
+			Symmetric array of shape (number of plans, number of plans)
 
-	nElementsInList: int
-			Set the number of elements per list
+	"""
+	nPlans, nOperators = arrFeatures.shape
+	arrDistances = np.zeros((nPlans, nPlans), dtype=np.int32)
+	blockSize = max(1, FAMILY_DISTANCE_BLOCK_ELEMENTS // max(nPlans * nOperators, 1))
+	for start in range(0, nPlans, blockSize):
+		arrBlock = arrFeatures[start:start + blockSize]
+		arrDistances[start:start + blockSize] = np.abs(arrBlock[:, np.newaxis, :] - arrFeatures[np.newaxis, :, :]).sum(axis=2)
+	return arrDistances
+
+
+def _planIndexDtype(nPlans):
+	"""
+	Choose the smallest unsigned integer type that can hold all plan numbers of a selectivity map
+
+	Parameters
+	----------
+	nPlans : int
+			Number of distinct plans
 
 	"""
-	return [lstOrigList[i: i + nElementsInList] for i in range(0, len(lstOrigList), nElementsInList)]
+	for dtype in (np.uint8, np.uint16):
+		if nPlans <= np.iinfo(dtype).max:
+			return dtype
+	return np.uint32
+
+
+"""
+Utility functions
+
+"""
 
 
-def _findValueInNestedDict(obj, key):
+def _formatSelectivity(cellIndex, nCells):
 	"""
-	Find a value within a nested dictionary recursively. This is used to check the results after finding the 
-	difference in QEPs.
+	Format the selectivity at the lower edge of a cell of the selectivity map as a percentage
 
 	Parameters
 	---------- 
-	obj: dict
-			The nested dictionary
+	cellIndex: int
+			Index of the cell along a dimension
 
-	key: string
-			The key to be found
+	nCells: int
+			Number of cells along the dimension
 
 	"""
-	if key in obj:
-		return obj[key]
-	for k, v in obj.items():
-		if isinstance(v, dict):
-			item = _findValueInNestedDict(v, key)
-			if item is not None:
-				return item
+	return "{:g}".format(round(cellIndex * 100 / nCells, 2))
 
 
 if __name__ == '__main__':
@@ -591,7 +2095,6 @@ if __name__ == '__main__':
 	username = "postgres"
 	password = "root"
 
-	import db_connection_manager as db_connect
 	import query_plan_visualizer as visualiser
 
 	# Attempt to fetch QEP for sample query and display it
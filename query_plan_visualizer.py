@@ -1,6 +1,20 @@
+import collections
 import json
+import threading
 
-from anytree import Node, RenderTree
+import instrumentation
+import plan_tree
+
+# Branches drawn in front of a plan node, and in front of the nodes below it
+BRANCH = "\u251c\u2500\u2500 "
+BRANCH_LAST = "\u2514\u2500\u2500 "
+INDENT = "\u2502   "
+INDENT_LAST = "    "
+
+# Number of rendered plans kept, so that showing a plan again does not render it again
+RENDER_CACHE_SIZE = 64
+_render_cache = collections.OrderedDict()
+_render_cache_lock = threading.Lock()
 
 
 class Cost(float):
@@ -13,112 +27,93 @@ class Cost(float):
         return super().__new__(cls, x)
 
 
-def _generate_ids_and_cost(current_plan, name_counter=None):
+def _get_operator_cost(plan_node):
     """
-    Traverse through a subplan and put a human-readable ID on each subplan root
-    Also gets the cost of current plan's root operator itself, without child costs
+    Get the cost of a plan node's operator itself, without child costs
     """
-    # Start a new dict if this is a non-recursive call
-    if name_counter is None:
-        name_counter = {}
-    current_plan_name = current_plan.get('Node Type')
-
-    # increment is used to prevent duplicate names
-    current_name_increment = name_counter.get(current_plan_name, 1)
-
-    # Use the plan's name and its current increment to generate a human readable ID
-    current_plan['id'] = "{}_{}".format(
-        current_plan_name, current_name_increment)
-
-    # increment the counter
-    name_counter[current_plan_name] = current_name_increment + 1
-
-    # traverse children plans and do the same
-    children_plans = current_plan.get('Plans')
     children_costs = 0
-    if children_plans:
-        for child_plan in children_plans:
-            _generate_ids_and_cost(child_plan, name_counter)
-            children_costs += Cost(child_plan.get('Total Cost'))
-    current_plan_cost = current_plan.get('Total Cost') - children_costs
-    # Get cost of current operator
-    current_plan['cost'] = Cost(current_plan_cost)
+    for child_node in plan_node.children:
+        children_costs += Cost(child_node.totalCost)
+    return Cost(plan_node.totalCost - children_costs)
 
 
-def _generate_children_nodes(current_plan, children_plans, plan_nodes):
+def _get_render_key(query_plan):
     """
-    Traverse through a subplan and place children nodes
+    Get the key of a plan in the render cache. Plans with the same fingerprint can still differ
+    in the costs, cardinalities and filters shown, so these are part of the key. Collecting them
+    walks the whole tree, so the key is computed once per tree and kept on its root: showing the
+    same PlanNode again only costs a lookup, while a tree newly built from JSON pays one walk.
     """
-    current_plan_id = current_plan.get('id')
-
-    if (not children_plans):  # if this plan is a leaf plan
-        current_plan_relation_name = current_plan.get('Relation Name')
-        if (current_plan_relation_name):
-            current_plan_node = plan_nodes[current_plan_id]
-            plan_nodes[current_plan_relation_name] = Node(
-                current_plan_relation_name, parent=current_plan_node, is_relation=True)
-        return
-
-    # this has to be pre-order traversal or the plan generated will not be accurate
-    for child_plan in children_plans:
-        child_plan_id = child_plan.get('id')
-        plan_nodes[child_plan_id] = Node(
-            child_plan_id, parent=plan_nodes[current_plan_id], is_relation=False, raw_plan=child_plan)
-        grandchildren_plans = child_plan.get('Plans')
-        _generate_children_nodes(child_plan, grandchildren_plans, plan_nodes)
+    if query_plan._renderKey is None:
+        query_plan._renderKey = (
+            query_plan.fingerprint(),
+            tuple((plan_node.totalCost, plan_node.rows, plan_node.filter) for plan_node in query_plan.iterNodes()))
+    return query_plan._renderKey
 
 
 def visualize_query_plan(query_plan):
     """
-    Provide a query plan as a JSON array with only one element
+    Provide a query plan as a plan_tree.PlanNode, or as a JSON array with only one element
     """
-    # Get the first plan
-    first_plan = query_plan[0].get('Plan')
-
-    # Store the total cost of the plan first
-    plan_total_cost = first_plan.get('Total Cost', 0)
-
-    # generate a unique ID and get cost for each operator in the query plan
-    _generate_ids_and_cost(first_plan)
-
-    # Get the ID of the first plan
-    first_plan_id = first_plan.get('id')
-
-    # Initialize a dictionary to store all nodes in the query plan
-    plan_nodes = {}
-
-    # Store first plan in the dictionary
-    plan_nodes[first_plan_id] = Node(
-        first_plan_id, is_relation=False, raw_plan=first_plan)
-
-    # Get the children of the first plan
-    children_plans = first_plan.get('Plans')
-
-    # Traverse the children with the context of first plan
-    _generate_children_nodes(first_plan, children_plans, plan_nodes)
-
-    # Get the node for the first plan
-    first_plan_node = plan_nodes[first_plan_id]
-
-    # print(RenderTree(first_plan_node))
-    # Print the plan as a normal Python string for fewer dependencies
-    # Optionally, the plan can be converted and exported as an image for visualisation 
-    # (requires Graphviz to be installed)
-    szQEPTree = str()
-    for pre, _, node in RenderTree(first_plan_node):
-        if (not node.is_relation):
-            current_operator_name = node.raw_plan.get('Node Type')
-            current_node_cost = node.raw_plan.get('cost')
-            current_node_cardinality = node.raw_plan.get('Plan Rows')
-            current_node_filter = node.raw_plan.get("Filter")
-            node_label = "{} || Cost: {} || Cardinality: {} || Filter: {}".format(
-                current_operator_name, current_node_cost, current_node_cardinality, current_node_filter)
-            szQEPTree += "{}{}\n".format(pre, node_label)
-        else:
-            szQEPTree += "{} Relation: {}\n".format(pre, node.name)
+    if not isinstance(query_plan, plan_tree.PlanNode):
+        query_plan = plan_tree.fromQEP(query_plan)
+    render_key = _get_render_key(query_plan)
+    with _render_cache_lock:
+        szQEPTree = _render_cache.get(render_key)
+        if szQEPTree is not None:
+            _render_cache.move_to_end(render_key)
+    if szQEPTree is not None:
+        instrumentation.count("render_cache_hits")
+        return szQEPTree
+    with instrumentation.span("render"):
+        szQEPTree = _visualize_query_plan(query_plan)
+    with _render_cache_lock:
+        _render_cache[render_key] = szQEPTree
+        if len(_render_cache) > RENDER_CACHE_SIZE:
+            # Evict the plan that was rendered least recently
+            _render_cache.popitem(last=False)
     return szQEPTree
 
 
+def _visualize_query_plan(query_plan):
+    # Print the plan as a normal Python string for fewer dependencies, drawn with the same
+    # branches as anytree's ContStyle. Optionally, the plan can be converted and exported as an
+    # image for visualisation (requires Graphviz to be installed)
+    lines = []
+    # Pre-order traversal without recursion, so that long join chains can be rendered.
+    # Each entry is the plan node, the branch in front of it and the indent of its children.
+    stack = [(query_plan, "", "")]
+    while stack:
+        plan_node, pre, indent = stack.pop()
+        lines.append("{}{} || Cost: {} || Cardinality: {} || Filter: {}".format(
+            pre, plan_node.nodeType, _get_operator_cost(plan_node), plan_node.rows, plan_node.filter))
+        if not plan_node.children:  # if this plan is a leaf plan
+            if plan_node.relation:
+                lines.append("{}{} Relation: {}".format(indent, BRANCH_LAST, plan_node.relation))
+            continue
+        last_child = len(plan_node.children) - 1
+        for index in range(last_child, -1, -1):
+            if index == last_child:
+                stack.append((plan_node.children[index], indent + BRANCH_LAST, indent + INDENT_LAST))
+            else:
+                stack.append((plan_node.children[index], indent + BRANCH, indent + INDENT))
+    lines.append("")
+    return "\n".join(lines)
+
+
+def get_line_plan_nodes(query_plan):
+    """
+    Get the plan node shown on each line of the rendered plan, e.g. to highlight plan nodes.
+    The relation scanned by a leaf plan is shown on its own line, which belongs to the leaf plan.
+    """
+    line_plan_nodes = []
+    for plan_node in query_plan.iterNodes():
+        line_plan_nodes.append(plan_node)
+        if not plan_node.children and plan_node.relation:
+            line_plan_nodes.append(plan_node)
+    return line_plan_nodes
+
+
 if __name__ == '__main__':
     # Get the sample query plan as a Python object
     with open('sample_query_plan.json') as f:
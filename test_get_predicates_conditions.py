@@ -0,0 +1,58 @@
+"""
+test_get_predicates_conditions.py
+
+Tests of the predicates found by get_predicates_conditions.compile_query_template()
+
+Usage:
+    python -m unittest test_get_predicates_conditions
+
+"""
+import unittest
+
+import get_predicates_conditions
+
+
+def _findPredicates(szWhere):
+    objTemplate = get_predicates_conditions.compile_query_template("select * from t where " + szWhere)
+    return [(slot.column, slot.operator, slot.values) for slot in objTemplate.slots]
+
+
+class CompileQueryTemplateTest(unittest.TestCase):
+
+    def test_column_compared_with_literal(self):
+        self.assertEqual(_findPredicates("col < 5"), [("col", "<", (5.0,))])
+        self.assertEqual(_findPredicates("5 < col"), [("col", ">", (5.0,))])
+
+    def test_between(self):
+        self.assertEqual(_findPredicates("col between 1 and 9"), [("col", "between", (1.0, 9.0))])
+
+    def test_between_keeps_lower_bound(self):
+        objTemplate = get_predicates_conditions.compile_query_template(
+            "select * from t where a between 1 and 9 and b < 5")
+        objProbeTemplate = objTemplate.build_probe_template(objTemplate.slots, "$$")
+        self.assertEqual(objProbeTemplate.lower_bounds, (1.0, None))
+        self.assertEqual(objProbeTemplate.bind((4.0, 2.0)),
+                         "select * from t where a BETWEEN 1.0 AND 4.0 and b <= 2.0")
+
+    def test_literal_in_arithmetic_expression_is_not_a_predicate(self):
+        # "*" is lexed as a wildcard rather than an operator
+        self.assertEqual(_findPredicates("col < 5 * 3"), [])
+        self.assertEqual(_findPredicates("5 * 3 < col"), [])
+        self.assertEqual(_findPredicates("col < 5 + 3"), [])
+        self.assertEqual(_findPredicates("col < 2 % 3"), [])
+        self.assertEqual(_findPredicates("col < 5 * 3 and other <= 7"), [("other", "<=", (7.0,))])
+
+    def test_predicates_after_scalar_subquery(self):
+        objTemplate = get_predicates_conditions.compile_query_template(
+            "select * from part, partsupp where p_partkey = ps_partkey and ps_supplycost = "
+            "(select min(ps_supplycost) from partsupp) and p_size < 15")
+        self.assertEqual([(slot.column, slot.operator, slot.values) for slot in objTemplate.slots],
+                         [("p_size", "<", (15.0,))])
+
+    def test_subquery_predicates_are_found(self):
+        self.assertEqual(_findPredicates("col in (select x from u where x < 3) and y > 4"),
+                         [("x", "<", (3.0,)), ("y", ">", (4.0,))])
+
+
+if __name__ == '__main__':
+    unittest.main()
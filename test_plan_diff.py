@@ -0,0 +1,87 @@
+"""
+test_plan_diff.py
+
+Tests of the operators found by plan_diff.diffPlans() and of the numbering of subtrees
+
+Usage:
+    python -m unittest test_plan_diff
+
+"""
+import unittest
+
+import plan_diff
+from plan_tree import PlanNode
+
+
+def _makeJoin(innerScanType):
+    return PlanNode("Hash Join", children=(
+        PlanNode("Seq Scan", relation="orders"),
+        PlanNode("Hash", children=(PlanNode(innerScanType, relation="lineitem"),))))
+
+
+def _numberSubtrees(*lstRoots):
+    dictNodeIds = {}
+    dictSubtrees = {}
+    for root in lstRoots:
+        plan_diff._numberSubtrees(root, dictSubtrees, dictNodeIds)
+    return dictNodeIds
+
+
+class DiffPlansTest(unittest.TestCase):
+
+    def test_identical_plans(self):
+        qep1 = _makeJoin("Seq Scan")
+        qep2 = _makeJoin("Seq Scan")
+        dictDiff = plan_diff.diffPlans(qep1, qep2)
+
+        self.assertEqual(dictDiff, {"inserted": [], "removed": [], "changed": [], "distance": 0})
+        dictNodeIds = _numberSubtrees(qep1, qep2)
+        self.assertEqual([dictNodeIds[id(node)] for node in qep1.iterNodes()],
+                         [dictNodeIds[id(node)] for node in qep2.iterNodes()])
+
+    def test_one_subtree_changed(self):
+        qep1 = _makeJoin("Seq Scan")
+        qep2 = _makeJoin("Index Scan")
+        dictDiff = plan_diff.diffPlans(qep1, qep2)
+
+        scan1 = qep1.children[1].children[0]
+        scan2 = qep2.children[1].children[0]
+        self.assertEqual(dictDiff["changed"], [(scan1, scan2)])
+        self.assertEqual(dictDiff["inserted"], [])
+        self.assertEqual(dictDiff["removed"], [])
+        self.assertEqual(dictDiff["distance"], 1)
+
+        dictNodeIds = _numberSubtrees(qep1, qep2)
+        # The unchanged outer side keeps its number, every subtree above the change gets a new one
+        self.assertEqual(dictNodeIds[id(qep1.children[0])], dictNodeIds[id(qep2.children[0])])
+        self.assertNotEqual(dictNodeIds[id(scan1)], dictNodeIds[id(scan2)])
+        self.assertNotEqual(dictNodeIds[id(qep1.children[1])], dictNodeIds[id(qep2.children[1])])
+        self.assertNotEqual(dictNodeIds[id(qep1)], dictNodeIds[id(qep2)])
+        # Numbers are given bottom-up, so a subtree is numbered after its children
+        self.assertLess(dictNodeIds[id(scan1)], dictNodeIds[id(qep1.children[1])])
+        self.assertLess(dictNodeIds[id(qep1.children[1])], dictNodeIds[id(qep1)])
+
+    def test_child_added(self):
+        qep1 = PlanNode("Append", children=(
+            PlanNode("Seq Scan", relation="orders"), PlanNode("Seq Scan", relation="lineitem")))
+        qep2 = PlanNode("Append", children=(
+            PlanNode("Seq Scan", relation="orders"), PlanNode("Seq Scan", relation="customer"),
+            PlanNode("Seq Scan", relation="lineitem")))
+        dictDiff = plan_diff.diffPlans(qep1, qep2)
+
+        self.assertEqual(dictDiff["inserted"], [qep2.children[1]])
+        self.assertEqual(dictDiff["removed"], [])
+        self.assertEqual(dictDiff["changed"], [])
+        self.assertEqual(dictDiff["distance"], 1)
+
+    def test_operator_added_on_top(self):
+        qep1 = _makeJoin("Seq Scan")
+        qep2 = PlanNode("Sort", children=(_makeJoin("Seq Scan"),))
+        dictDiff = plan_diff.diffPlans(qep1, qep2)
+
+        self.assertEqual(dictDiff["inserted"], [qep2])
+        self.assertEqual(dictDiff["distance"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+"""
+test_qep_processor.py
+
+Tests of the sweeps of qep_processor.py, run without a database server against the synthetic
+TPC-H-like planner of benchmark_suite.py.
+
+Usage:
+    python -m unittest test_qep_processor
+
+"""
+import contextlib
+import io
+import unittest
+
+import numpy as np
+
+import benchmark_suite
+import qep_processor
+from plan_tree import PlanNode
+
+
+def _discardOutput(testCase):
+    """
+    Discard what the sweep prints until the end of the test, also if the test fails
+
+    """
+    objRedirect = contextlib.redirect_stdout(io.StringIO())
+    objRedirect.__enter__()
+    testCase.addCleanup(objRedirect.__exit__, None, None, None)
+
+
+class CountingCommunicator(benchmark_suite.SyntheticCommunicator):
+    """
+    Synthetic communicator that counts the EXPLAIN requests it receives
+
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.nExplained = 0
+
+    def getQEP(self, query):
+        self.nExplained += 1
+        return super().getQEP(query)
+
+
+class FetchQEPsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.previousSettings = (qep_processor.SWEEP_MODE, qep_processor.USE_QEP_CACHE)
+        qep_processor.USE_QEP_CACHE = False
+        _discardOutput(self)
+
+    def tearDown(self):
+        qep_processor.SWEEP_MODE, qep_processor.USE_QEP_CACHE = self.previousSettings
+
+    def test_duplicate_points_are_explained_once(self):
+        _, _, query = qep_processor._convertToQueryTemplate(benchmark_suite.SYNTHETIC_QUERY)
+        lstPoints = [(10.0, 50000.0), (10.0, 50000.0), (40.0, 400000.0), (10.0, 50000.0)]
+        objCommunicator = CountingCommunicator()
+        objMonitor = qep_processor.SweepMonitor()
+        objMonitor.addPoints(len(lstPoints))
+        objProbes = qep_processor._SweepProbes(query, objCommunicator)
+        lstQEPs = qep_processor._fetchQEPs(query, lstPoints, objCommunicator, objProbes, objMonitor)
+
+        self.assertTrue(all(qep is not None for qep in lstQEPs))
+        self.assertEqual(objCommunicator.nExplained, 2)
+        dictProgress = objMonitor.getProgress()
+        self.assertEqual(dictProgress["unknown"], 0)
+        self.assertEqual(dictProgress["done"], dictProgress["total"])
+
+    def test_adaptive_sweep_has_no_unknown_points(self):
+        qep_processor.SWEEP_MODE = qep_processor.SWEEP_MODE_ADAPTIVE
+        objMonitor = qep_processor.SweepMonitor()
+        result = qep_processor.processQuery(
+            benchmark_suite.SYNTHETIC_QUERY, benchmark_suite.SyntheticCommunicator(), objMonitor)
+
+        self.assertEqual(result[0], qep_processor.RET_ALL_QEPS)
+        self.assertTrue((result[3] > 0).all())
+        self.assertEqual(objMonitor.getProgress()["unknown"], 0)
+
+    def test_server_probe_mode_replays_same_map(self):
+        dictFixture = benchmark_suite.buildSyntheticFixture()
+        literalResult = benchmark_suite._processQuery(
+            dictFixture["query"], benchmark_suite.ReplayCommunicator(dictFixture), qep_processor.SWEEP_MODE_GRID)
+        serverResult = benchmark_suite._processQuery(
+            dictFixture["query"], benchmark_suite.ReplayCommunicator(dictFixture), qep_processor.SWEEP_MODE_GRID,
+            qep_processor.PROBE_MODE_SERVER)
+
+        self.assertEqual(serverResult[0], qep_processor.RET_ALL_QEPS)
+        self.assertEqual(serverResult[3].tolist(), literalResult[3].tolist())
+        self.assertEqual(len(serverResult[1]), len(literalResult[1]))
+
+
+class MissingStatisticsCommunicator(benchmark_suite.SyntheticCommunicator):
+    """
+    Synthetic communicator for which one attribute has no pg_stats row
+
+    """
+
+    def __init__(self, szMissingAttribute):
+        super().__init__()
+        self.szMissingAttribute = szMissingAttribute
+
+    def getAttributeStatistics(self, lstAttributes):
+        dictStatistics = super().getAttributeStatistics(lstAttributes)
+        dictStatistics[self.szMissingAttribute]["histogram"] = [(None, None, None)]
+        return dictStatistics
+
+
+class GeneratePredicateValuesTest(unittest.TestCase):
+
+    def test_attribute_without_statistics(self):
+        lstAttributes = sorted(benchmark_suite.SYNTHETIC_ATTRIBUTES)
+        objCommunicator = MissingStatisticsCommunicator(lstAttributes[-1])
+        with self.assertRaisesRegex(ValueError, "No statistics for {}, run ANALYZE".format(lstAttributes[-1])):
+            qep_processor._generatePredicateValues(objCommunicator, lstAttributes)
+
+    def test_between_starts_at_lower_bound(self):
+        lstSelValsPerDimension, lstHistogramBounds = qep_processor._generatePredicateValues(
+            benchmark_suite.SyntheticCommunicator(), ["l_quantity", "o_totalprice"], [20.0, None])
+
+        self.assertEqual(lstHistogramBounds[0][0], 20.0)
+        self.assertTrue(all(bound >= 20.0 for bound in lstHistogramBounds[0]))
+        self.assertTrue(all(value >= 20.0 for value in lstSelValsPerDimension[0]))
+        # Dimensions of other predicates keep the whole histogram
+        self.assertEqual(lstHistogramBounds[1][0], 857.71)
+
+    def test_statistics_not_retrieved(self):
+        objCommunicator = benchmark_suite.SyntheticCommunicator()
+        objCommunicator.getAttributeStatistics = lambda lstAttributes: None
+        with self.assertRaisesRegex(ValueError, "Could not retrieve the statistics"):
+            qep_processor._generatePredicateValues(objCommunicator, ["l_quantity"])
+
+
+class ReducePlanDiagramTest(unittest.TestCase):
+
+    def setUp(self):
+        # Plan 2 covers one cell between plan 1 and plan 3. Plan 3 costs 5 % more at the cell
+        # above it than plan 2 costs at its own cell.
+        self.selectivityMap = np.array([1, 1, 1, 2, 3, 3, 3, 3], dtype=np.uint8)
+        self.costMap = np.array([10.0, 20.0, 30.0, 100.0, 105.0, 110.0, 120.0, 130.0])
+
+    def test_plan_swallowed_within_threshold(self):
+        reducedMap, dictSwallowedBy = qep_processor.reducePlanDiagram(
+            self.selectivityMap, self.costMap, 5.0)
+
+        # Plan 3 dominates the cell of plan 2, plan 1 is much cheaper than plan 3 and is kept
+        self.assertEqual(dictSwallowedBy, {2: 3})
+        self.assertEqual(reducedMap.tolist(), [1, 1, 1, 3, 3, 3, 3, 3])
+        self.assertEqual(self.selectivityMap.tolist(), [1, 1, 1, 2, 3, 3, 3, 3])
+
+    def test_plan_kept_above_threshold(self):
+        reducedMap, dictSwallowedBy = qep_processor.reducePlanDiagram(
+            self.selectivityMap, self.costMap, 4.0)
+
+        self.assertEqual(dictSwallowedBy, {})
+        self.assertEqual(reducedMap.tolist(), self.selectivityMap.tolist())
+
+    def test_no_reduction_without_threshold(self):
+        reducedMap, dictSwallowedBy = qep_processor.reducePlanDiagram(
+            self.selectivityMap, self.costMap, 0)
+
+        self.assertEqual(dictSwallowedBy, {})
+        self.assertEqual(reducedMap.tolist(), self.selectivityMap.tolist())
+
+
+class ClusterPlansTest(unittest.TestCase):
+
+    def setUp(self):
+        hashJoin = PlanNode("Hash Join", children=(
+            PlanNode("Seq Scan", relation="orders"),
+            PlanNode("Hash", children=(PlanNode("Seq Scan", relation="lineitem"),))))
+        # Plan 2 only adds a Sort on top of plan 1, plan 3 has different scans and join
+        self.lstAllQEPs = [
+            hashJoin,
+            PlanNode("Sort", children=(hashJoin,)),
+            PlanNode("Nested Loop", children=(
+                PlanNode("Index Scan", relation="orders"), PlanNode("Index Scan", relation="lineitem"))),
+        ]
+
+    def test_distance_matrix(self):
+        arrDistances = qep_processor._computePlanDistances(qep_processor._countOperators(self.lstAllQEPs))
+
+        self.assertEqual(arrDistances.tolist(), [[0, 1, 7], [1, 0, 8], [7, 8, 0]])
+
+    def test_cluster_assignment(self):
+        # Plan 2 covers more cells than plan 1, so it is the first plan of their family
+        selectivityMap = np.array([[1, 2, 2], [3, 2, 0]], dtype=np.uint8)
+        familyMap, lstFamilies = qep_processor.clusterPlans(self.lstAllQEPs, selectivityMap, threshold=2)
+
+        self.assertEqual(lstFamilies, [[2, 1], [3]])
+        self.assertEqual(familyMap.tolist(), [[1, 1, 1], [2, 1, 0]])
+
+    def test_plans_apart_without_threshold(self):
+        selectivityMap = np.array([1, 2, 2, 3], dtype=np.uint8)
+        _, lstFamilies = qep_processor.clusterPlans(self.lstAllQEPs, selectivityMap, threshold=0)
+
+        self.assertEqual(lstFamilies, [[2], [1], [3]])
+
+
+if __name__ == '__main__':
+    unittest.main()